@@ -9,7 +9,7 @@ from PyPDF2 import PdfReader
 import pandas as pd
 import json
 import os
-from model_service import create_model_service
+from model_service import create_model_service, CachedModelService, default_response_cache
 # 配置页面
 st.set_page_config(
     page_title="产品文档解析工具",
@@ -32,7 +32,7 @@ def get_model_service():
     service_type = st.session_state.get("model_service_type", "qianfan")
     
     if service_type == "qianfan":
-        return create_model_service(
+        service = create_model_service(
             service_type="qianfan",
             authorization=authorization,
             model=model
@@ -41,11 +41,13 @@ def get_model_service():
         # Ollama模型服务
         host = st.session_state.get("ollama_host", "http://127.0.0.1:11434")
         model = st.session_state.get("ollama_model", "llama3")
-        return create_model_service(
+        service = create_model_service(
             service_type="ollama",
             host=host,
             model=model
         )
+    # 提取信息以温度0进行，同一文档重复解析时直接使用缓存的提取结果；温度为0的聊天也使用缓存
+    return CachedModelService(service, default_response_cache())
 #  docx文件处理函数，增加了表格解析
 def extract_text_from_docx(file):
     """
@@ -238,15 +240,82 @@ def setup_sidebar():
         "- PDF文档 (.pdf)\n"
         "- 文本文件 (.txt)"
     )
+def extract_product_info_many(contents):
+    """
+    并发提取多个文档的产品信息，同时进行的请求数受模型服务的并发上限限制
+    :param contents: 各文档的内容
+    :return: 与 contents 顺序一致的结构化信息列表，提取失败的为None
+    """
+    try:
+        model_service = get_model_service()
+        results = model_service.extract_info_many(contents, extraction_type="product")
+    except Exception as e:
+        st.error(f"提取产品信息失败：{e}")
+        return [None] * len(contents)
+    product_infos = []
+    for result in results:
+        if isinstance(result, Exception):
+            st.error(f"提取产品信息失败：{result}")
+            result = None
+        product_infos.append(result)
+    return product_infos
+def show_product_info(uploaded_file, product_info):
+    """
+    显示提取的产品信息
+    :param uploaded_file: 上传的文件对象
+    :param product_info: 提取的结构化信息，提取失败时为None
+    """
+    if product_info:
+        st.subheader("提取的产品信息")
+        
+        # 显示产品名称
+        st.markdown(f"### 产品名称：{product_info.get('product_name', '未提取到')}")
+        
+        # 显示产品参数
+        st.markdown("### 产品参数")
+        if product_info.get('parameters'):
+            params_df = pd.DataFrame(product_info['parameters'])
+            st.table(params_df)
+        else:
+            st.write("未提取到产品参数")
+        
+        # 显示卖点描述
+        st.markdown("### 产品卖点")
+        if product_info.get('selling_points'):
+            for i, point in enumerate(product_info['selling_points'], 1):
+                st.markdown(f"{i}. {point}")
+        else:
+            st.write("未提取到产品卖点")
+        
+        # 显示技术指标
+        st.markdown("### 技术指标")
+        if product_info.get('technical_specs'):
+            tech_df = pd.DataFrame(product_info['technical_specs'])
+            st.table(tech_df)
+        else:
+            st.write("未提取到技术指标")
+        
+        # 提供下载功能
+        st.download_button(
+            label="下载提取的信息 (JSON)",
+            data=json.dumps(product_info, ensure_ascii=False, indent=2),
+            file_name=f"{uploaded_file.name.split('.')[0]}_提取信息.json",
+            mime="application/json",
+            key=f"download_{uploaded_file.name}",
+        )
+    else:
+        st.error("无法提取产品信息，请检查文档内容或尝试其他文档")
 def main():
     st.title("产品文档解析工具")
     st.write("上传产品文档，自动提取产品参数、卖点描述和技术指标。")
     
     # 设置侧边栏
     setup_sidebar()
-    # 文件上传
-    uploaded_file = st.file_uploader("上传文件", type=["docx", "pdf", "png", "jpg", "txt", "xlsx", "pptx"])
-    if uploaded_file is not None:
+    # 文件上传，可以一次上传多个文档
+    uploaded_files = st.file_uploader("上传文件", type=["docx", "pdf", "png", "jpg", "txt", "xlsx", "pptx"],
+                                      accept_multiple_files=True)
+    documents = []
+    for uploaded_file in uploaded_files or []:
         st.write("文件上传成功！")
         st.write(f"文件名：{uploaded_file.name}")
         st.write(f"文件类型：{uploaded_file.type}")
@@ -257,54 +326,25 @@ def main():
             if uploaded_file.type.startswith("image/"):  # 如果是用户上传的图片文件，显示图片和提取的文字
                 st.image(uploaded_file, caption="上传的图片", use_column_width=True)
                 st.write("提取的文字如下：")
-                st.text_area("文件内容", content, height=300)
+                st.text_area("文件内容", content, height=300, key=f"content_{uploaded_file.name}")
             else:
                 # 创建一个可折叠的部分来显示原始内容
                 with st.expander("查看原始文件内容"):
-                    st.text_area("文件内容", content, height=300)
-            
-            # 使用模型提取产品信息
-            with st.spinner("正在使用AI提取产品信息..."):
-                product_info = extract_product_info(content)
-            
-            if product_info:
-                st.subheader("提取的产品信息")
-                
-                # 显示产品名称
-                st.markdown(f"### 产品名称：{product_info.get('product_name', '未提取到')}")
-                
-                # 显示产品参数
-                st.markdown("### 产品参数")
-                if product_info.get('parameters'):
-                    params_df = pd.DataFrame(product_info['parameters'])
-                    st.table(params_df)
-                else:
-                    st.write("未提取到产品参数")
-                
-                # 显示卖点描述
-                st.markdown("### 产品卖点")
-                if product_info.get('selling_points'):
-                    for i, point in enumerate(product_info['selling_points'], 1):
-                        st.markdown(f"{i}. {point}")
-                else:
-                    st.write("未提取到产品卖点")
-                
-                # 显示技术指标
-                st.markdown("### 技术指标")
-                if product_info.get('technical_specs'):
-                    tech_df = pd.DataFrame(product_info['technical_specs'])
-                    st.table(tech_df)
-                else:
-                    st.write("未提取到技术指标")
-                
-                # 提供下载功能
-                st.download_button(
-                    label="下载提取的信息 (JSON)",
-                    data=json.dumps(product_info, ensure_ascii=False, indent=2),
-                    file_name=f"{uploaded_file.name.split('.')[0]}_提取信息.json",
-                    mime="application/json",
-                )
+                    st.text_area("文件内容", content, height=300, key=f"content_{uploaded_file.name}")
+            documents.append((uploaded_file, content))
+    
+    if documents:
+        # 使用模型提取产品信息，多个文档并发提取
+        with st.spinner(f"正在使用AI提取 {len(documents)} 个文档的产品信息..."):
+            if len(documents) == 1:
+                product_infos = [extract_product_info(documents[0][1])]
             else:
-                st.error("无法提取产品信息，请检查文档内容或尝试其他文档")
+                product_infos = extract_product_info_many([content for _, content in documents])
+        
+        for (uploaded_file, _), product_info in zip(documents, product_infos):
+            if len(documents) > 1:
+                st.divider()
+                st.header(uploaded_file.name)
+            show_product_info(uploaded_file, product_info)
 if __name__ == "__main__":
     main()
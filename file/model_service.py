@@ -1,294 +1,16 @@
-import json
-import requests
+"""
+产品文档解析工具使用的模型服务，与主应用共用 modules/model_service.py
+本工具以 streamlit run file/file_app.py 单独运行，导入前先把项目根目录加入模块搜索路径
+"""
 import os
-from typing import Dict, Any, List, Optional, Union
+import sys
 
-class ModelService:
-    """模型服务基类，定义通用接口"""
-    
-    def extract_info(self, content: str, extraction_type: str = "product") -> Dict[Any, Any]:
-        """
-        从内容中提取信息
-        :param content: 要分析的文本内容
-        :param extraction_type: 提取类型，如"product"表示产品信息
-        :return: 提取的结构化信息
-        """
-        raise NotImplementedError("Subclasses must implement this method")
-    
-class QianfanModelService(ModelService):
-    """百度千帆大模型服务"""
-    
-    def __init__(self, api_key: str = None, authorization: str = None, model: str = "ernie-4.5-turbo-vl-32k"):
-        """
-        初始化千帆大模型服务
-        :param api_key: API密钥（可选）
-        :param authorization: 授权令牌（必须提供）
-        :param model: 使用的模型名称
-        """
-        self.authorization = authorization or os.environ.get("QIANFAN_AUTHORIZATION")
-        self.model = model
-        
-        if not self.authorization:
-            raise ValueError("千帆授权令牌未设置，请设置QIANFAN_AUTHORIZATION环境变量或在初始化时提供")
-    
-    def chat(self, messages: List[Dict[str, Any]], temperature: float = 0.7, stream: bool = False) -> Dict[str, Any]:
-        """
-        调用千帆大模型聊天接口
-        :param messages: 消息列表
-        :param temperature: 温度参数，控制响应的随机性
-        :param stream: 是否使用流式响应
-        :return: 模型响应
-        """
-        url = "https://qianfan.baidubce.com/v2/chat/completions"
-        
-        # 处理消息格式
-        formatted_messages = []
-        for msg in messages:
-            if isinstance(msg["content"], str):
-                # 如果内容是字符串，转换为千帆API所需的格式
-                formatted_messages.append({
-                    "role": msg["role"],
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": msg["content"]
-                        }
-                    ]
-                })
-            else:
-                # 如果已经是正确格式，直接使用
-                formatted_messages.append(msg)
-        
-        # 构建请求体
-        payload = {
-            "model": self.model,
-            "messages": formatted_messages,
-            "stream": stream
-        }
-        
-        # 添加可选参数
-        if temperature is not None:
-            payload["temperature"] = temperature
-        
-        # 构建请求头
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": self.authorization
-        }
-        
-        # 发送请求
-        response = requests.post(
-            url, 
-            headers=headers, 
-            data=json.dumps(payload, ensure_ascii=False).encode("utf-8")
-        )
-        
-        # 解析响应
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception(f"API请求失败: {response.status_code} {response.text}")
-    
-    def extract_info(self, content: str, extraction_type: str = "product") -> Dict[Any, Any]:
-        """
-        使用千帆大模型从内容中提取信息
-        :param content: 要分析的文本内容
-        :param extraction_type: 提取类型，如"product"表示产品信息
-        :return: 提取的结构化信息
-        """
-        # 根据提取类型构建不同的提示词
-        if extraction_type == "product":
-            prompt = self._build_product_extraction_prompt(content)
-        else:
-            raise ValueError(f"不支持的提取类型: {extraction_type}")
-        
-        # 调用模型
-        messages = [{
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": prompt
-                }
-            ]
-        }]
-        
-        response = self.chat(messages)
-        
-        # 解析响应
-        try:
-            if "choices" in response and len(response["choices"]) > 0:
-                text_response = response["choices"][0]["message"]["content"]
-                
-                # 尝试从文本中提取JSON
-                start_pos = text_response.find('{')
-                end_pos = text_response.rfind('}') + 1
-                
-                if start_pos >= 0 and end_pos > start_pos:
-                    json_str = text_response[start_pos:end_pos]
-                    result = json.loads(json_str)
-                    return result
-                else:
-                    raise ValueError("无法从响应中提取有效的JSON")
-            else:
-                raise ValueError(f"模型响应错误: {response}")
-        except Exception as e:
-            print(f"解析模型响应失败: {e}")
-            print(f"原始响应: {response}")
-            # 返回一个空结构，避免程序崩溃
-            return {
-                "product_name": "",
-                "parameters": [],
-                "selling_points": [],
-                "technical_specs": []
-            }
-    
-    def _build_product_extraction_prompt(self, content: str) -> str:
-        """
-        构建产品信息提取的提示词
-        :param content: 文档内容
-        :return: 提示词
-        """
-        return f"""
-        请从以下文档中提取产品相关信息，并以JSON格式返回。需要提取的信息包括：
-        1. 产品名称
-        2. 产品参数（如尺寸、重量、材质等）
-        3. 产品卖点描述
-        4. 技术指标（如性能参数、规格标准等）
-        
-        请以以下JSON格式返回：
-        {{
-            "product_name": "产品名称",
-            "parameters": [
-                {{"name": "参数名称1", "value": "参数值1"}},
-                {{"name": "参数名称2", "value": "参数值2"}},
-                ...
-            ],
-            "selling_points": [
-                "卖点1",
-                "卖点2",
-                ...
-            ],
-            "technical_specs": [
-                {{"name": "指标名称1", "value": "指标值1"}},
-                {{"name": "指标名称2", "value": "指标值2"}},
-                ...
-            ]
-        }}
-        
-        文档内容：
-        {content}
-        """
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-
-class OllamaModelService(ModelService):
-    """Ollama模型服务"""
-    
-    def __init__(self, host: str = "http://127.0.0.1:11434", model: str = "llama3"):
-        """
-        初始化Ollama模型服务
-        :param host: Ollama服务器地址
-        :param model: 使用的模型名称
-        """
-        try:
-            import ollama
-            self.client = ollama.Client(host=host)
-            self.model = model
-        except ImportError:
-            raise ImportError("请安装ollama包: pip install ollama")
-    
-    def extract_info(self, content: str, extraction_type: str = "product") -> Dict[Any, Any]:
-        """
-        使用Ollama模型从内容中提取信息
-        :param content: 要分析的文本内容
-        :param extraction_type: 提取类型，如"product"表示产品信息
-        :return: 提取的结构化信息
-        """
-        # 根据提取类型构建不同的提示词
-        if extraction_type == "product":
-            prompt = self._build_product_extraction_prompt(content)
-        else:
-            raise ValueError(f"不支持的提取类型: {extraction_type}")
-        
-        # 调用模型
-        response = self.client.chat(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            stream=False
-        )
-        
-        # 解析响应
-        try:
-            # 尝试直接解析JSON
-            text_response = response['message']['content']
-            
-            # 尝试从文本中提取JSON
-            start_pos = text_response.find('{')
-            end_pos = text_response.rfind('}') + 1
-            
-            if start_pos >= 0 and end_pos > start_pos:
-                json_str = text_response[start_pos:end_pos]
-                result = json.loads(json_str)
-                return result
-            else:
-                raise ValueError("无法从响应中提取有效的JSON")
-        except Exception as e:
-            print(f"解析模型响应失败: {e}")
-            # 返回一个空结构，避免程序崩溃
-            return {
-                "product_name": "",
-                "parameters": [],
-                "selling_points": [],
-                "technical_specs": []
-            }
-    
-    def _build_product_extraction_prompt(self, content: str) -> str:
-        """
-        构建产品信息提取的提示词
-        :param content: 文档内容
-        :return: 提示词
-        """
-        return f"""
-        请从以下文档中提取产品相关信息，并以JSON格式返回。需要提取的信息包括：
-        1. 产品名称
-        2. 产品参数（如尺寸、重量、材质等）
-        3. 产品卖点描述
-        4. 技术指标（如性能参数、规格标准等）
-        
-        请以以下JSON格式返回：
-        {{
-            "product_name": "产品名称",
-            "parameters": [
-                {{"name": "参数名称1", "value": "参数值1"}},
-                {{"name": "参数名称2", "value": "参数值2"}},
-                ...
-            ],
-            "selling_points": [
-                "卖点1",
-                "卖点2",
-                ...
-            ],
-            "technical_specs": [
-                {{"name": "指标名称1", "value": "指标值1"}},
-                {{"name": "指标名称2", "value": "指标值2"}},
-                ...
-            ]
-        }}
-        
-        文档内容：
-        {content}
-        """
-# 工厂函数，用于创建模型服务实例
-def create_model_service(service_type: str = "qianfan", **kwargs) -> ModelService:
-    """
-    创建模型服务实例
-    :param service_type: 服务类型，支持"qianfan"和"ollama"
-    :param kwargs: 其他参数，将传递给相应的模型服务构造函数
-    :return: 模型服务实例
-    """
-    if service_type.lower() == "qianfan":
-        return QianfanModelService(**kwargs)
-    elif service_type.lower() == "ollama":
-        return OllamaModelService(**kwargs)
-    else:
-        raise ValueError(f"不支持的服务类型: {service_type}")
+from modules.model_service import (  # noqa: E402
+    ModelService, QianfanModelService, OllamaModelService,
+    AsyncModelService, AsyncQianfanModelService, AsyncOllamaModelService,
+    create_model_service, create_async_model_service,
+    ModelServiceError, ModelConnectionError, ModelAPIError, RateLimitError, CircuitOpenError, TransportConfig
+)
+from modules.model_cache import CachedModelService, ResponseCache, default_response_cache  # noqa: E402
@@ -3,7 +3,7 @@ import re
 import streamlit as st
 import requests
 from modules.file_processing import read_file
-from modules.rag_module import enhance_query_with_rag
+from modules.rag_module import enhance_query_with_rag, search_session_documents
 
 
 def preprocess_output(output):
@@ -37,7 +37,7 @@ def display_conversation(prompt, file_content, client, selected_model, use_strea
     # RAG增强查询
     if use_rag:
         with st.spinner("正在搜索相关文档..."):
-            enhanced_prompt, relevant_chunks = enhance_query_with_rag(prompt, use_rag)
+            enhanced_prompt, relevant_chunks = enhance_query_with_rag(prompt, use_rag, model=selected_model)
 
             # 显示搜索到的相关文档
             if relevant_chunks:
@@ -214,18 +214,30 @@ def show_rag_debug_info():
         stats = rag_system.get_document_stats()
 
         # 显示索引统计
+        cache_stats = rag_system.query_cache.stats()
         st.json({
             "文档统计": stats,
-            "关键词示例": list(rag_system.index.keyword_index.keys())[:10] if rag_system.index.keyword_index else []
+            "关键词示例": rag_system.index.sample_keywords(10),
+            "检索缓存": {
+                "命中": cache_stats['hits'],
+                "未命中": cache_stats['misses'],
+                "命中率": f"{cache_stats['hit_rate']:.1%}",
+                "缓存条目": f"{cache_stats['size']}/{cache_stats['max_size']}",
+                "索引代数": rag_system.generation
+            }
         })
 
         # 测试查询
         test_query = st.text_input("测试查询", placeholder="输入测试查询...")
         if test_query:
-            results = rag_system.search_documents(test_query, top_k=5)
+            timings = {}
+            # 与提问时相同，在本会话选择的检索范围内检索
+            results = search_session_documents(test_query, top_k=5, timings=timings)
+            # 各检索阶段耗时，用于权衡召回率和延迟
+            st.write("各阶段耗时 (ms): " + ", ".join(f"{stage}={ms:.1f}" for stage, ms in timings.items()))
             st.write(f"找到 {len(results)} 个相关文档块:")
             for i, result in enumerate(results):
                 st.write(f"**结果 {i + 1}** (相关性: {result['relevance_score']:.2f})")
-                st.write(f"来源: {result['filename']}")
+                st.write(f"来源: {result['filename']}（集合: {result.get('collection', '')}）")
                 st.write(f"内容: {result['content'][:200]}...")
                 st.write("---")
@@ -6,6 +6,7 @@ from pptx import Presentation  # 用于处理PowerPoint文件
 from PIL import Image
 import pytesseract  # 用于OCR文字识别
 import io
+import codecs
 
 # Ollama 客户端
 client = ollama.Client(host="http://127.0.0.1:11434")
@@ -109,6 +110,46 @@ def read_file(file):
         return None
 
 
+def iter_file_text(file, file_type=None, block_size=64 * 1024):
+    """
+    按片段逐步读取文件内容，供流式分块使用，不一次性生成全文字符串
+    文本文件按块增量解码；PDF按页、Word按段落、Excel按行、PowerPoint按幻灯片产出
+    :param file: 文件对象（上传的文件或以二进制方式打开的本地文件）
+    :param file_type: MIME类型，为空时使用 file.type
+    :param block_size: 文本文件每次读取的字节数
+    :return: 文本片段的生成器，读取失败时抛出异常
+    """
+    file_type = file_type or file.type
+    file.seek(0)
+    if file_type == "application/pdf":  # PDF 文件
+        import PyPDF2
+        for page in PyPDF2.PdfReader(file).pages:
+            yield (page.extract_text() or "") + "\n"
+    elif file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":  # Word文件
+        for paragraph in docx.Document(file).paragraphs:
+            yield paragraph.text + "\n"
+    elif file_type == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":  # Excel文件
+        wb = openpyxl.load_workbook(file, read_only=True)
+        for sheet in wb.worksheets:
+            yield f"Sheet: {sheet.title}\n"
+            for row in sheet.iter_rows(values_only=True):
+                yield "\t".join(str(cell) for cell in row) + "\n"
+        wb.close()
+    elif file_type == "application/vnd.openxmlformats-officedocument.presentationml.presentation":  # PowerPoint文件
+        prs = Presentation(file)
+        for slide_number, slide in enumerate(prs.slides, start=1):
+            texts = [shape.text + "\n" for shape in slide.shapes if hasattr(shape, "text")]
+            yield f"Slide {slide_number}:\n" + "".join(texts)
+    else:  # 文本文件及其他类型按UTF-8文本处理
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            yield decoder.decode(block)
+        yield decoder.decode(b"", final=True)
+
+
 def get_file_content(uploaded_files):
     if uploaded_files is None:
         return None
@@ -0,0 +1,397 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import numpy as np
+
+from modules.model_service import ModelService, build_product_extraction_prompt
+from modules.rag_context import estimate_tokens
+from modules.rag_vector import default_embedder, normalize
+
+
+def normalize_messages(messages: List[Dict[str, Any]]) -> List[List[str]]:
+    """规范化消息列表：角色小写，文本内容合并连续空白并去掉首尾空白，非文本内容按排序后的JSON表示"""
+    normalized = []
+    for msg in messages:
+        content = msg.get("content")
+        if isinstance(content, str):
+            content = " ".join(content.split())
+        else:
+            content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+        normalized.append([str(msg.get("role", "")).lower(), content])
+    return normalized
+
+
+def _digest(value) -> str:
+    return hashlib.blake2b(json.dumps(value, ensure_ascii=False).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def chat_cache_key(model: str, messages: List[Dict[str, Any]], temperature: Optional[float]) -> str:
+    """聊天响应的缓存键：模型 + 规范化后的消息 + 温度"""
+    return _digest(["chat", model, normalize_messages(messages), temperature])
+
+
+def _semantic_parts(model: str, messages: List[Dict[str, Any]], temperature: Optional[float]):
+    """
+    语义匹配的 (上下文键, 问题文本)：之前的消息完全相同时才比较最后一条用户消息的相似度
+    最后一条不是文本用户消息时返回 (None, None)
+    """
+    if not messages or messages[-1].get("role") != "user" or not isinstance(messages[-1].get("content"), str):
+        return None, None
+    return _digest(["context", model, normalize_messages(messages[:-1]), temperature]), messages[-1]["content"]
+
+
+def response_content(response: Dict[str, Any]) -> str:
+    choices = response.get("choices") or []
+    return choices[0]["message"]["content"] if choices else ""
+
+
+class ResponseCache:
+    """
+    模型响应缓存：内存LRU + SQLite持久化，两层都按TTL过期
+    可选地用向量相似度匹配语义相近的问题（之前的对话必须完全相同）
+    线程安全，进程内的所有会话可以共用一个实例
+    """
+
+    def __init__(self, path: Optional[str] = None, max_size: int = 1024, ttl: Optional[float] = 7 * 24 * 3600,
+                 embedder=None, similarity: float = 0.95, max_candidates: int = 1000):
+        """
+        :param path: SQLite文件路径，为空时只使用内存缓存
+        :param max_size: 内存中最多缓存的响应数
+        :param ttl: 条目存活时间（秒），为None时不过期
+        :param embedder: 向量化实例（见 modules.rag_vector），为空时只做精确匹配
+        :param similarity: 语义命中需要达到的余弦相似度
+        :param max_candidates: 语义匹配时最多比较的最近条目数
+        """
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.embedder = embedder
+        self.similarity = similarity
+        self.max_candidates = max_candidates
+        self._entries = OrderedDict()  # 键 -> (写入时间, 响应JSON, token数, 上下文键, 向量)
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self._db = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    context TEXT,
+                    created REAL NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    response TEXT NOT NULL,
+                    embedding BLOB
+                )""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_context ON responses (context, created)")
+            self.purge_expired()
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created >= self.ttl
+
+    def _remember(self, key, created, payload, tokens, context, vector):
+        """写入内存层（需持有锁），超出容量时淘汰最久未使用的条目"""
+        self._entries[key] = (created, payload, tokens, context, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _hit(self, payload: str, tokens: int):
+        self.saved_tokens += tokens
+        return json.loads(payload)
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """计算问题的向量；向量化失败（如模型服务不可用）时返回None，按未命中处理，不影响调用"""
+        if self.embedder is None or not text:
+            return None
+        try:
+            return normalize(self.embedder.embed([text]))[0]
+        except Exception as e:
+            print(f"计算缓存向量失败: {e}")
+            return None
+
+    def get(self, key: str, context: Optional[str] = None, text: Optional[str] = None):
+        """
+        读取缓存
+        :param key: 精确匹配的缓存键
+        :param context: 语义匹配的上下文键，为空时不做语义匹配
+        :param text: 语义匹配的问题文本
+        :return: 缓存的值（副本），未命中时返回None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return self._hit(entry[1], entry[2])
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT created, tokens, response, context, embedding FROM responses "
+                                       "WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    created, tokens, payload, row_context, embedding = row
+                    if not self._expired(created, now):
+                        vector = np.frombuffer(embedding, dtype=np.float32) if embedding else None
+                        self._remember(key, created, payload, tokens, row_context, vector)
+                        self.disk_hits += 1
+                        return self._hit(payload, tokens)
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+
+        if context is not None and self.embedder is not None:
+            # 计算向量时不持有锁
+            value = self._semantic_get(context, self._embed(text), now)
+            if value is not None:
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _semantic_get(self, context: str, query: Optional[np.ndarray], now: float):
+        if query is None:
+            return None
+        with self._lock:
+            candidates = {key: (payload, tokens, vector) for key, (created, payload, tokens, entry_context, vector)
+                          in self._entries.items()
+                          if entry_context == context and vector is not None and not self._expired(created, now)}
+            if self._db is not None:
+                since = now - self.ttl if self.ttl is not None else float("-inf")
+                rows = self._db.execute("SELECT key, tokens, response, embedding FROM responses "
+                                        "WHERE context = ? AND embedding IS NOT NULL AND created > ? "
+                                        "ORDER BY created DESC LIMIT ?", (context, since, self.max_candidates))
+                for key, tokens, payload, embedding in rows:
+                    candidates.setdefault(key, (payload, tokens, np.frombuffer(embedding, dtype=np.float32)))
+            candidates = [entry for entry in candidates.values() if len(entry[2]) == len(query)]
+            if not candidates:
+                return None
+            scores = np.stack([vector for _, _, vector in candidates]) @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity:
+                return None
+            self.semantic_hits += 1
+            payload, tokens, _ = candidates[best]
+            return self._hit(payload, tokens)
+
+    def put(self, key: str, value, tokens: int, context: Optional[str] = None, text: Optional[str] = None):
+        """
+        写入缓存
+        :param value: 可JSON序列化的值
+        :param tokens: 一次调用消耗的token数，命中时计入节省的token
+        :param context: 语义匹配的上下文键，与 text 一起提供时保存问题的向量（向量化失败时只保存精确匹配的条目）
+        """
+        payload = json.dumps(value, ensure_ascii=False)
+        vector = self._embed(text) if context is not None else None
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, payload, tokens, context, vector)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, context, created, tokens, response, embedding) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)",
+                                 (key, context, created, tokens, payload,
+                                  vector.astype(np.float32).tobytes() if vector is not None else None))
+                self._db.commit()
+
+    def purge_expired(self):
+        """删除持久化层中过期的条目"""
+        if self._db is None or self.ttl is None:
+            return
+        with self._lock:
+            self._db.execute("DELETE FROM responses WHERE created <= ?", (time.time() - self.ttl,))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """命中统计和节省的token数"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits + self.semantic_hits
+            lookups = hits + self.misses
+            stored = None
+            if self._db is not None:
+                stored = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                'hits': hits,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'saved_tokens': self.saved_tokens,
+                'size': len(self._entries),
+                'stored': stored
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class CachedModelService(ModelService):
+    """
+    带响应缓存的模型服务，包装任意 ModelService
+    聊天只在温度为0或显式开启时使用缓存，较高温度下用户通常期望每次得到不同的回答；
+    提取信息按文档内容缓存，同样默认只在被包装的服务以温度0提取时开启，否则同一文档会一直返回第一次的结果
+    其他属性和方法（如 chat_many、close）直接转发给被包装的服务
+    """
+
+    def __init__(self, service: ModelService, cache: ResponseCache, cache_all_temperatures: bool = False,
+                 cache_extraction: Optional[bool] = None):
+        """
+        :param service: 被包装的模型服务
+        :param cache: 响应缓存，多个服务可以共用
+        :param cache_all_temperatures: 为True时任意温度的聊天都使用缓存
+        :param cache_extraction: 是否缓存 extract_info 的结果，为空时只在服务的 extraction_temperature 为0时缓存
+        """
+        self.service = service
+        self.cache = cache
+        self.cache_all_temperatures = cache_all_temperatures
+        self.cache_extraction = cache_extraction
+
+    def __getattr__(self, name):
+        if name == "service":
+            raise AttributeError(name)
+        return getattr(self.service, name)
+
+    @property
+    def model(self) -> str:
+        return self.service.model
+
+    def _cacheable(self, temperature: Optional[float], use_cache: Optional[bool]) -> bool:
+        if use_cache is not None:
+            return use_cache
+        return self.cache_all_temperatures or temperature == 0
+
+    def _extraction_cacheable(self) -> bool:
+        if self.cache_extraction is not None:
+            return self.cache_extraction
+        service = getattr(self.service, "async_service", self.service)
+        return getattr(service, "extraction_temperature", None) == 0
+
+    def chat(self, messages: List[Dict[str, Any]], temperature: float = 0.7, stream: bool = False,
+             use_cache: Optional[bool] = None) -> Union[Dict[str, Any], Iterator[Dict[str, Any]]]:
+        """
+        聊天接口，参数和返回值与被包装服务相同
+        :param use_cache: 是否使用缓存，为空时按温度决定
+        """
+        if not self._cacheable(temperature, use_cache):
+            return self.service.chat(messages, temperature=temperature, stream=stream)
+
+        key = chat_cache_key(self.model, messages, temperature)
+        context, text = _semantic_parts(self.model, messages, temperature)
+        cached = self.cache.get(key, context, text)
+        if cached is not None:
+            return self._replay(cached) if stream else cached
+
+        if stream:
+            return self._record(self.service.chat(messages, temperature=temperature, stream=True),
+                                messages, key, context, text)
+        response = self.service.chat(messages, temperature=temperature)
+        self.cache.put(key, response, self._tokens(messages, response), context, text)
+        return response
+
+    def _tokens(self, messages: List[Dict[str, Any]], response: Dict[str, Any]) -> int:
+        """一次调用消耗的token数，响应没有用量时按文本估算"""
+        used = (response.get("usage") or {}).get("total_tokens")
+        if used:
+            return used
+        prompt = sum(estimate_tokens(msg["content"]) for msg in messages if isinstance(msg.get("content"), str))
+        return prompt + estimate_tokens(response_content(response))
+
+    def _replay(self, response: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """把缓存的完整响应按流式响应的结构输出"""
+        yield {"model": self.model, "message": {"role": "assistant", "content": response_content(response)},
+               "done": False}
+        yield {"model": self.model, "message": {"role": "assistant", "content": ""}, "done": True,
+               "done_reason": "cache"}
+
+    def _record(self, chunks: Iterator[Dict[str, Any]], messages, key, context, text) -> Iterator[Dict[str, Any]]:
+        """透传流式响应，完整结束后把拼接的回答写入缓存；中途停止或出错时不缓存"""
+        output = []
+        for chunk in chunks:
+            output.append(chunk["message"]["content"])
+            yield chunk
+            if chunk.get("done"):
+                response = {"choices": [{"message": {"content": "".join(output)}}]}
+                self.cache.put(key, response, self._tokens(messages, response), context, text)
+
+    def _extraction_key(self, content: str, extraction_type: str) -> str:
+        return _digest(["extract", self.model, extraction_type, " ".join(content.split())])
+
+    def _put_extraction(self, key: str, content: str, result: Dict[Any, Any]):
+        # 解析失败时返回的是空结构，不缓存，下次重新提取
+        if any(result.values()):
+            tokens = (estimate_tokens(build_product_extraction_prompt(content))
+                      + estimate_tokens(json.dumps(result, ensure_ascii=False)))
+            self.cache.put(key, result, tokens)
+
+    def extract_info(self, content: str, extraction_type: str = "product") -> Dict[Any, Any]:
+        if not self._extraction_cacheable():
+            return self.service.extract_info(content, extraction_type)
+        key = self._extraction_key(content, extraction_type)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        result = self.service.extract_info(content, extraction_type)
+        self._put_extraction(key, content, result)
+        return result
+
+    def extract_info_many(self, contents: List[str], extraction_type: str = "product",
+                          timeout: Optional[float] = None) -> List[Any]:
+        """并发从多段内容中提取信息，只有未命中缓存的内容发送给模型"""
+        if not self._extraction_cacheable():
+            return self.service.extract_info_many(contents, extraction_type, timeout)
+        keys = [self._extraction_key(content, extraction_type) for content in contents]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            fresh = self.service.extract_info_many([contents[i] for i in missing], extraction_type, timeout)
+            for i, result in zip(missing, fresh):
+                results[i] = result
+                if not isinstance(result, Exception):
+                    self._put_extraction(keys[i], contents[i], result)
+        return results
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_response_cache() -> ResponseCache:
+    """
+    进程内共享的响应缓存
+    持久化文件由环境变量 MODEL_CACHE_PATH 指定（默认 model_cache/responses.sqlite，设为空字符串时只用内存）；
+    设置 MODEL_CACHE_SIMILARITY（如 0.95）且配置了 RAG_EMBEDDING_MODEL 时启用语义匹配
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            similarity = os.environ.get("MODEL_CACHE_SIMILARITY")
+            embedder = default_embedder() if similarity else None
+            path = os.environ.get("MODEL_CACHE_PATH", "model_cache/responses.sqlite") or None
+            _default_cache = ResponseCache(path=path, embedder=embedder,
+                                           similarity=float(similarity) if similarity else 0.95)
+        return _default_cache
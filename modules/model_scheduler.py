@@ -0,0 +1,222 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+# 优先级，数值越小越先放行
+INTERACTIVE = 0  # 界面中的聊天
+BATCH = 1  # 批量提取等后台任务
+
+PRIORITY_LABELS = {INTERACTIVE: "交互", BATCH: "批量"}
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """单个模型的调用配额，为None的项不限制"""
+    requests_per_second: Optional[float] = None  # 每秒请求数（QPS）
+    tokens_per_minute: Optional[int] = None  # 每分钟token数（TPM），按请求前的估算预扣，响应后按实际用量结算
+    burst: Optional[int] = None  # 允许的瞬时请求数，为空时等于 requests_per_second（至少为1）
+
+
+# 常用模型的配额，未列出的模型使用 DEFAULT_RATE_LIMIT；按账号实际配额用 RequestScheduler.set_limit 调整
+MODEL_RATE_LIMITS = {
+    "ernie-4.5-turbo-vl-32k": RateLimit(requests_per_second=5, tokens_per_minute=100000),
+    "ernie-4.0-turbo-8k": RateLimit(requests_per_second=5, tokens_per_minute=100000),
+    "ernie-3.5-8k": RateLimit(requests_per_second=5, tokens_per_minute=100000),
+    "ernie-lite-8k": RateLimit(requests_per_second=5, tokens_per_minute=100000),
+}
+DEFAULT_RATE_LIMIT = RateLimit()  # 其他模型（如本地Ollama模型）不限流，只按优先级排队
+
+
+class TokenBucket:
+    """
+    令牌桶：以 rate 个/秒的速度补充，最多存 capacity 个
+    余量可以为负（实际用量超过预扣时补扣），之后的请求需要等余量补回
+    """
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.level = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """取出 amount 个令牌还需等待的秒数；超过容量的请求按容量计算，否则永远无法放行"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def give(self, amount: float):
+        """退回预扣多出的令牌（amount 为负时补扣）"""
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class _ModelQueue:
+    """一个模型的配额和等待队列：队首（优先级最高、最早提交）的请求放行后才轮到后面的请求"""
+
+    def __init__(self, limit: RateLimit, clock):
+        self.limit = limit
+        self.requests = None
+        self.tokens = None
+        if limit.requests_per_second:
+            burst = limit.burst or max(1, int(limit.requests_per_second))
+            self.requests = TokenBucket(limit.requests_per_second, burst, clock)
+        if limit.tokens_per_minute:
+            self.tokens = TokenBucket(limit.tokens_per_minute / 60, limit.tokens_per_minute, clock)
+        self.waiters = []  # 堆：(优先级, 提交序号, 预扣token数, future)
+        self.changed = asyncio.Event()
+        self.task = None
+        self.granted = 0
+        self.waited = 0.0
+
+    def wait_time(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = self.requests.wait_time(1)
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def take(self, tokens: int):
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+    async def dispatch(self):
+        """依次放行队首请求，配额不足时等待补充；有新请求加入时重新检查队首"""
+        try:
+            while self.waiters:
+                priority, sequence, tokens, future, submitted = self.waiters[0]
+                if future.done():
+                    # 等待中的调用已取消（如超过截止时间）
+                    heapq.heappop(self.waiters)
+                    continue
+                wait = self.wait_time(tokens)
+                if wait <= 0:
+                    heapq.heappop(self.waiters)
+                    self.take(tokens)
+                    self.granted += 1
+                    self.waited += time.monotonic() - submitted
+                    future.set_result(None)
+                    continue
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.task = None
+
+
+class RequestScheduler:
+    """
+    模型请求调度器：按模型分别用令牌桶限制每秒请求数和每分钟token数，
+    超出配额的请求按优先级排队等待而不是直接失败，交互聊天排在批量任务前面，同一优先级先到先得
+    只在一个事件循环中使用；同步接口的请求都在后台事件循环中执行，进程内的所有会话共用一个调度器
+    """
+
+    def __init__(self, limits: Optional[Dict[str, RateLimit]] = None, default: RateLimit = DEFAULT_RATE_LIMIT,
+                 clock=time.monotonic):
+        """
+        :param limits: 模型名称 -> 配额，为空时使用 MODEL_RATE_LIMITS
+        :param default: 未列出的模型使用的配额
+        """
+        self.limits = dict(MODEL_RATE_LIMITS if limits is None else limits)
+        self.default = default
+        self.clock = clock
+        self._queues = {}
+        self._sequence = itertools.count()
+
+    def set_limit(self, model: str, limit: RateLimit):
+        """调整模型的配额，已排队的请求按新配额放行"""
+        self.limits[model] = limit
+        old = self._queues.pop(model, None)
+        if old is not None and old.waiters:
+            queue = self._queue(model)
+            for waiter in old.waiters:
+                heapq.heappush(queue.waiters, waiter)
+            self._wake(queue)
+
+    def _queue(self, model: str) -> _ModelQueue:
+        if model not in self._queues:
+            self._queues[model] = _ModelQueue(self.limits.get(model, self.default), self.clock)
+        return self._queues[model]
+
+    def _wake(self, queue: _ModelQueue):
+        if queue.task is None:
+            queue.task = asyncio.get_running_loop().create_task(queue.dispatch())
+        queue.changed.set()
+
+    async def acquire(self, model: str, tokens: int = 0, priority: int = INTERACTIVE):
+        """
+        排队等待配额，放行时预扣1个请求和 tokens 个token
+        :param model: 模型名称
+        :param tokens: 预计消耗的token数（提示词加回答）
+        :param priority: INTERACTIVE 或 BATCH
+        """
+        queue = self._queue(model)
+        if not queue.waiters and queue.wait_time(tokens) <= 0:
+            # 无需等待时直接放行
+            queue.take(tokens)
+            queue.granted += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(queue.waiters, (priority, next(self._sequence), tokens, future, time.monotonic()))
+        self._wake(queue)
+        await future
+
+    def settle(self, model: str, reserved: int, used: Optional[int]):
+        """
+        响应后按实际用量结算预扣的token
+        :param reserved: 预扣的token数
+        :param used: 实际消耗的token数，未知时不结算
+        """
+        queue = self._queues.get(model)
+        if queue is None or queue.tokens is None or used is None:
+            return
+        queue.tokens.give(reserved - used)
+        if queue.waiters:
+            self._wake(queue)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """各模型的排队情况：等待数（按优先级）、已放行数、平均排队秒数"""
+        result = {}
+        for model, queue in self._queues.items():
+            waiting = {}
+            for priority, _, _, future, _ in queue.waiters:
+                if not future.done():
+                    waiting[priority] = waiting.get(priority, 0) + 1
+            result[model] = {
+                'waiting': waiting,
+                'granted': queue.granted,
+                'average_wait': queue.waited / queue.granted if queue.granted else 0.0
+            }
+        return result
+
+
+_shared_scheduler = None
+_shared_lock = threading.Lock()
+
+
+def shared_scheduler() -> RequestScheduler:
+    """进程内共享的调度器（只能在后台事件循环中使用）"""
+    global _shared_scheduler
+    with _shared_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = RequestScheduler()
+        return _shared_scheduler
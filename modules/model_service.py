@@ -1,81 +1,405 @@
+import asyncio
 import json
-import requests
 import os
-from typing import Dict, Any, List, Optional, Union
-import urllib3
+import queue
+import re
+import threading
+from typing import Dict, Any, AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional, Tuple, Union
 
-# 禁用SSL警告
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from modules.model_scheduler import INTERACTIVE, BATCH, RateLimit, RequestScheduler, shared_scheduler
+from modules.model_transport import (
+    ModelServiceError, ModelConnectionError, ModelAPIError, RateLimitError, CircuitOpenError,
+    ModelTransport, TransportConfig, shared_transport
+)
+from modules.rag_context import estimate_tokens
 
+_SSE_LINE_BREAK = re.compile(rb'\r\n|\r|\n')
 
-class ModelService:
-    """模型服务基类，定义通用接口"""
 
-    def extract_info(self, content: str, extraction_type: str = "product") -> Dict[Any, Any]:
+class SSEParser:
+    """
+    增量解析 server-sent events 流：每收到一个完整事件（以空行结束）就立即产出，不等待整个响应
+    块边界可以落在任意位置；流在事件中途结束时丢弃未完成的事件
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._event = "message"
+        self._data = []
+
+    def feed(self, chunk: bytes) -> List[Tuple[str, str]]:
         """
-        从内容中提取信息
-        :param content: 要分析的文本内容
-        :param extraction_type: 提取类型，如"product"表示产品信息
-        :return: 提取的结构化信息
+        输入一段字节
+        :return: 这段字节补全的 (事件类型, 数据) 列表，多行 data 以换行连接
         """
+        buffer = self._buffer + chunk
+        # 末尾的 \r 可能是被块边界切开的 \r\n，留到下一块再判断
+        end = len(buffer) - 1 if buffer.endswith(b"\r") else len(buffer)
+        lines = _SSE_LINE_BREAK.split(buffer[:end])
+        self._buffer = lines.pop() + buffer[end:]
+
+        events = []
+        for line in lines:
+            line = line.decode("utf-8")
+            if not line:
+                if self._data:
+                    events.append((self._event, "\n".join(self._data)))
+                self._event, self._data = "message", []
+            elif line.startswith(":"):
+                continue  # 注释行，服务端常用作心跳
+            else:
+                field, _, value = line.partition(":")
+                value = value[1:] if value.startswith(" ") else value
+                if field == "data":
+                    self._data.append(value)
+                elif field == "event":
+                    self._event = value
+        return events
+
+
+def iter_sse_events(chunks: Iterable[bytes]) -> Iterator[Tuple[str, str]]:
+    """逐块解析SSE字节流，产出 (事件类型, 数据)"""
+    parser = SSEParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+
+
+async def aiter_sse_events(chunks: AsyncIterable[bytes]) -> AsyncIterator[Tuple[str, str]]:
+    """iter_sse_events 的异步版本，如 aiter_sse_events(response.aiter_bytes())"""
+    parser = SSEParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+
+
+# 同步接口共用的后台事件循环：异步客户端的连接池绑定在创建它的事件循环上，
+# 同步调用全部提交到同一个常驻循环，既能复用连接，也能在已有事件循环的线程中调用
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="model-service-loop", daemon=True).start()
+        return _loop
+
+
+def run_sync(coroutine):
+    """在后台事件循环中执行协程并等待结果"""
+    return asyncio.run_coroutine_threadsafe(coroutine, _background_loop()).result()
+
+
+def iter_sync(async_iterator: AsyncIterator) -> Iterator:
+    """
+    把异步迭代器转换为同步生成器：后台事件循环中的一个任务迭代到底，元素经队列交给调用线程
+    调用方提前停止迭代时取消该任务，异步迭代器随之关闭并释放连接
+    """
+    items = queue.SimpleQueue()
+
+    async def pump():
+        try:
+            async for item in async_iterator:
+                items.put((True, item))
+            items.put((False, None))
+        except Exception as e:
+            items.put((False, e))
+        finally:
+            if hasattr(async_iterator, "aclose"):
+                await async_iterator.aclose()
+
+    future = asyncio.run_coroutine_threadsafe(pump(), _background_loop())
+    try:
+        while True:
+            has_item, value = items.get()
+            if not has_item:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        future.cancel()
+
+
+def parse_extraction_response(text_response: str) -> Dict[Any, Any]:
+    """
+    从模型回复中提取JSON结构
+    :param text_response: 模型回复的文本
+    :return: 提取的结构化信息，解析失败时返回空结构，避免程序崩溃
+    """
+    try:
+        # 尝试从文本中提取JSON
+        start_pos = text_response.find('{')
+        end_pos = text_response.rfind('}') + 1
+
+        if start_pos >= 0 and end_pos > start_pos:
+            json_str = text_response[start_pos:end_pos]
+            result = json.loads(json_str)
+            return result
+        else:
+            raise ValueError("无法从响应中提取有效的JSON")
+    except Exception as e:
+        print(f"解析模型响应失败: {e}")
+        print(f"原始响应: {text_response}")
+        return {
+            "product_name": "",
+            "parameters": [],
+            "selling_points": [],
+            "technical_specs": []
+        }
+
+
+def build_product_extraction_prompt(content: str) -> str:
+    """
+    构建产品信息提取的提示词
+    :param content: 文档内容
+    :return: 提示词
+    """
+    return f"""
+        请从以下文档中提取产品相关信息，并以JSON格式返回。需要提取的信息包括：
+        1. 产品名称
+        2. 产品参数（如尺寸、重量、材质等）
+        3. 产品卖点描述
+        4. 技术指标（如性能参数、规格标准等）
+
+        请以以下JSON格式返回：
+        {{
+            "product_name": "产品名称",
+            "parameters": [
+                {{"name": "参数名称1", "value": "参数值1"}},
+                {{"name": "参数名称2", "value": "参数值2"}},
+                ...
+            ],
+            "selling_points": [
+                "卖点1",
+                "卖点2",
+                ...
+            ],
+            "technical_specs": [
+                {{"name": "指标名称1", "value": "指标值1"}},
+                {{"name": "指标名称2", "value": "指标值2"}},
+                ...
+            ]
+        }}
+
+        文档内容：
+        {content}
+        """
+
+
+class AsyncModelService:
+    """
+    异步模型服务基类：并发请求数由信号量限制，每次调用可以设置截止时间
+    一个实例只在一个事件循环中使用（连接池和信号量都绑定在该循环上）
+    """
+
+    extraction_temperature = 0  # 提取信息时使用的温度，为None时使用模型默认值；提取结构化结果用0，同一文档的结果稳定，可以缓存
+    expected_output_tokens = 512  # 按每分钟token数限流时预扣的回答token数，响应后按实际用量结算
+
+    def __init__(self, model: str, max_concurrency: int = 4, timeout: Optional[float] = 30.0,
+                 scheduler: Optional[RequestScheduler] = None):
+        """
+        :param model: 使用的模型名称
+        :param max_concurrency: 最多同时进行的请求数，超出的请求排队等待
+        :param timeout: 默认的单次调用截止时间（秒），包括排队等待的时间，为None时不限制
+        :param scheduler: 限流调度器，为空时不限流
+        """
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self._semaphore = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # 在事件循环中首次使用时创建
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _deadline(self, timeout: Optional[float]) -> Optional[float]:
+        return self.timeout if timeout is None else timeout
+
+    def _reserve_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        """限流时预扣的token数：提示词的估算值加预计的回答长度"""
+        prompt = sum(estimate_tokens(msg["content"]) for msg in messages if isinstance(msg.get("content"), str))
+        return prompt + self.expected_output_tokens
+
+    async def _schedule(self, tokens: int, priority: int):
+        """按优先级排队等待调度器的配额"""
+        if self.scheduler is not None:
+            await self.scheduler.acquire(self.model, tokens, priority)
+
+    def _settle(self, reserved: int, used: Optional[int]):
+        if self.scheduler is not None:
+            self.scheduler.settle(self.model, reserved, used)
+
+    async def _limited(self, call, timeout: Optional[float], tokens: int = 0, priority: int = INTERACTIVE):
+        """
+        依次取得调度器配额和并发名额后执行 call() 返回的协程，排队和执行合计超过截止时间时抛出 TimeoutError
+        协程在取得名额后才创建，排队期间超时不会留下未执行的协程；
+        取得配额后调用失败、超时或被取消时，预扣的回答token按没有输出结算退回
+        """
+        async def run():
+            await self._schedule(tokens, priority)
+            try:
+                async with self.semaphore:
+                    return await call()
+            except BaseException:
+                self._settle(tokens, max(0, tokens - self.expected_output_tokens))
+                raise
+
+        deadline = self._deadline(timeout)
+        try:
+            return await asyncio.wait_for(run(), deadline)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"模型调用超过截止时间（{deadline}秒）")
+
+    async def _request(self, messages: List[Dict[str, Any]], temperature: Optional[float]) -> Dict[str, Any]:
+        """发送一次非流式聊天请求，返回统一格式的响应（子类实现）"""
         raise NotImplementedError("Subclasses must implement this method")
 
-    def chat(self, messages: List[Dict[str, Any]], temperature: float = 0.7, stream: bool = False) -> Dict[str, Any]:
+    def _stream(self, messages: List[Dict[str, Any]], temperature: Optional[float]) -> AsyncIterator[Dict[str, Any]]:
+        """发送一次流式聊天请求，产出与Ollama流式响应结构相同的增量消息（子类实现）"""
+        raise NotImplementedError("Subclasses must implement this method")
+
+    async def achat(self, messages: List[Dict[str, Any]], temperature: Optional[float] = 0.7,
+                    timeout: Optional[float] = None, priority: int = INTERACTIVE) -> Dict[str, Any]:
         """
         聊天接口
         :param messages: 消息列表
         :param temperature: 温度参数
-        :param stream: 是否流式输出
-        :return: 模型响应
+        :param timeout: 截止时间（秒），为空时使用实例的默认值
+        :param priority: 限流排队时的优先级，INTERACTIVE 或 BATCH
+        :return: 模型响应，结构为 {"choices": [{"message": {"content": ...}}], "usage": {...}}
         """
-        raise NotImplementedError("Subclasses must implement this method")
+        reserved = self._reserve_tokens(messages)
+        response = await self._limited(lambda: self._request(messages, temperature), timeout, reserved, priority)
+        self._settle(reserved, (response.get("usage") or {}).get("total_tokens"))
+        return response
+
+    async def astream(self, messages: List[Dict[str, Any]], temperature: Optional[float] = 0.7,
+                      timeout: Optional[float] = None, priority: int = INTERACTIVE) -> AsyncIterator[Dict[str, Any]]:
+        """
+        流式聊天接口，整个流（包括排队）占用一个并发名额
+        :param timeout: 截止时间（秒），从调用开始计算到流结束；为空时不限制总时长，
+                        长回答可以一直输出，每次读取仍受连接的读超时限制
+        :param priority: 限流排队时的优先级
+        :return: 增量消息的异步生成器，结构与Ollama流式响应相同
+        """
+        loop = asyncio.get_running_loop()
+        expires = None if timeout is None else loop.time() + timeout
+        reserved = self._reserve_tokens(messages)
+
+        scheduled = False
+
+        async def admit():
+            nonlocal scheduled
+            await self._schedule(reserved, priority)
+            scheduled = True
+            await self.semaphore.acquire()
+
+        try:
+            await asyncio.wait_for(admit(), timeout)
+        except BaseException as e:
+            # 取得配额后等待并发名额时超时或被取消，没有输出
+            if scheduled:
+                self._settle(reserved, reserved - self.expected_output_tokens)
+            if isinstance(e, asyncio.TimeoutError):
+                raise TimeoutError(f"模型调用超过截止时间（{timeout}秒）")
+            raise
+        output = []
+        try:
+            # 逐条检查截止时间而不是用 wait_for 包装每次读取：流在同一个任务中迭代，连接的上下文不跨任务
+            async for chunk in self._stream(messages, temperature):
+                if expires is not None and loop.time() > expires:
+                    raise TimeoutError(f"模型调用超过截止时间（{timeout}秒）")
+                output.append(chunk["message"]["content"])
+                yield chunk
+        finally:
+            self.semaphore.release()
+            # 流式响应不一定带用量，按实际输出的文本估算
+            self._settle(reserved, reserved - self.expected_output_tokens + estimate_tokens("".join(output)))
+
+    async def achat_many(self, conversations: List[List[Dict[str, Any]]], temperature: Optional[float] = 0.7,
+                         timeout: Optional[float] = None, return_exceptions: bool = True,
+                         priority: int = BATCH) -> List[Any]:
+        """
+        并发进行多组对话，同时进行的请求数不超过 max_concurrency
+        :param conversations: 每组对话的消息列表
+        :param timeout: 每组对话各自的截止时间（秒）
+        :param return_exceptions: 为True时失败的对话在结果中以异常对象表示，不影响其他对话
+        :param priority: 限流排队时的优先级，默认排在交互聊天之后
+        :return: 与 conversations 顺序一致的响应列表
+        """
+        return await asyncio.gather(*(self.achat(messages, temperature, timeout, priority)
+                                      for messages in conversations),
+                                    return_exceptions=return_exceptions)
+
+    async def aextract_info(self, content: str, extraction_type: str = "product",
+                            timeout: Optional[float] = None, priority: int = BATCH) -> Dict[Any, Any]:
+        """
+        从内容中提取信息
+        :param content: 要分析的文本内容
+        :param extraction_type: 提取类型，如"product"表示产品信息
+        :param priority: 限流排队时的优先级，默认排在交互聊天之后
+        :return: 提取的结构化信息
+        """
+        # 根据提取类型构建不同的提示词
+        if extraction_type == "product":
+            prompt = build_product_extraction_prompt(content)
+        else:
+            raise ValueError(f"不支持的提取类型: {extraction_type}")
+
+        response = await self.achat([{"role": "user", "content": prompt}], self.extraction_temperature, timeout,
+                                    priority)
+        if "choices" in response and len(response["choices"]) > 0:
+            return parse_extraction_response(response["choices"][0]["message"]["content"])
+        return parse_extraction_response("")
+
+    async def aextract_many(self, contents: List[str], extraction_type: str = "product",
+                            timeout: Optional[float] = None, return_exceptions: bool = True) -> List[Any]:
+        """并发从多段内容中提取信息，结果顺序与 contents 一致"""
+        return await asyncio.gather(*(self.aextract_info(content, extraction_type, timeout, BATCH)
+                                      for content in contents),
+                                    return_exceptions=return_exceptions)
 
+    async def aclose(self):
+        """关闭连接池"""
 
-class QianfanModelService(ModelService):
-    """百度千帆大模型服务"""
 
-    def __init__(self, api_key: str = None, authorization: str = None, model: str = "ernie-4.5-turbo-vl-32k"):
+class AsyncQianfanModelService(AsyncModelService):
+    """百度千帆大模型服务（异步，请求经 ModelTransport 发送，带连接池、重试和熔断）"""
+
+    url = "https://qianfan.baidubce.com/v2/chat/completions"
+
+    def __init__(self, api_key: str = None, authorization: str = None, model: str = "ernie-4.5-turbo-vl-32k",
+                 max_concurrency: int = 4, timeout: float = 30.0, transport: Optional[ModelTransport] = None,
+                 transport_config: Optional[TransportConfig] = None, scheduler: Optional[RequestScheduler] = None):
         """
         初始化千帆大模型服务
         :param api_key: API密钥（可选）
         :param authorization: 授权令牌（必须提供）
         :param model: 使用的模型名称
+        :param max_concurrency: 最多同时进行的请求数
+        :param timeout: 默认的单次调用截止时间（秒），包括失败重试的时间
+        :param transport: 共用的传输层，为空时按 transport_config 创建本实例专用的传输层
+        :param transport_config: 连接池、重试和熔断配置，为空时使用默认值
+        :param scheduler: 限流调度器，为空时不限流
         """
+        super().__init__(model, max_concurrency, timeout, scheduler)
         self.authorization = authorization or os.environ.get("QIANFAN_AUTHORIZATION")
-        self.model = model
 
         if not self.authorization:
             raise ValueError("千帆授权令牌未设置，请设置QIANFAN_AUTHORIZATION环境变量或在初始化时提供")
 
-        # 配置请求会话，处理代理问题
-        self.session = requests.Session()
-
-        # 尝试禁用代理
-        self.session.proxies = {
-            'http': None,
-            'https': None
-        }
-
-        # 设置超时和重试
-        self.session.timeout = 30
-
-        # 设置请求头
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'application/json',
-            'Content-Type': 'application/json'
-        })
-
-    def chat(self, messages: List[Dict[str, Any]], temperature: float = 0.7, stream: bool = False) -> Dict[str, Any]:
-        """
-        调用千帆大模型聊天接口
-        :param messages: 消息列表
-        :param temperature: 温度参数，控制响应的随机性
-        :param stream: 是否使用流式响应
-        :return: 模型响应
-        """
-        url = "https://qianfan.baidubce.com/v2/chat/completions"
+        self._owns_transport = transport is None
+        self.transport = transport or ModelTransport(transport_config)
 
+    def _payload(self, messages: List[Dict[str, Any]], temperature: Optional[float], stream: bool) -> Dict[str, Any]:
+        """构建请求体：千帆接口不支持 system 角色，系统消息合并到第一条用户消息中"""
         # 处理消息格式 - 兼容不同的输入格式
         formatted_messages = []
         for msg in messages:
@@ -114,265 +438,191 @@ class QianfanModelService(ModelService):
         # 添加可选参数
         if temperature is not None:
             payload["temperature"] = temperature
+        return payload
 
-        # 构建请求头
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": self.authorization
+    def _headers(self, stream: bool) -> Dict[str, str]:
+        # 传输层可能由多个实例共用，请求头随每个请求发送
+        return {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Accept': 'text/event-stream' if stream else 'application/json',
+            'Content-Type': 'application/json',
+            'Authorization': self.authorization
         }
 
-        try:
-            # 发送请求
-            response = self.session.post(
-                url,
-                headers=headers,
-                json=payload,
-                timeout=30,
-                verify=False  # 忽略SSL验证
-            )
-
-            # 解析响应
-            if response.status_code == 200:
-                result = response.json()
-                return result
-            else:
-                raise Exception(f"API请求失败: {response.status_code} {response.text}")
-
-        except requests.exceptions.ProxyError as e:
-            # 如果是代理错误，尝试使用备用方法
-            print(f"代理错误，尝试直接连接: {e}")
-
-            # 创建新的会话，完全禁用代理
-            backup_session = requests.Session()
-            backup_session.trust_env = False  # 忽略环境变量中的代理设置
-
-            response = backup_session.post(
-                url,
-                headers=headers,
-                json=payload,
-                timeout=30,
-                verify=False
-            )
-
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise Exception(f"API请求失败: {response.status_code} {response.text}")
-
-        except Exception as e:
-            raise Exception(f"网络请求失败: {str(e)}")
+    async def _request(self, messages: List[Dict[str, Any]], temperature: Optional[float]) -> Dict[str, Any]:
+        # 网络错误、限流和服务端错误由传输层重试，仍失败时抛出 ModelServiceError 的子类
+        response = await self.transport.request("POST", self.url, headers=self._headers(False),
+                                                json=self._payload(messages, temperature, False))
+        return response.json()
 
-    def extract_info(self, content: str, extraction_type: str = "product") -> Dict[Any, Any]:
+    async def _stream(self, messages: List[Dict[str, Any]], temperature: Optional[float]) -> AsyncIterator[Dict[str, Any]]:
         """
-        使用千帆大模型从内容中提取信息
-        :param content: 要分析的文本内容
-        :param extraction_type: 提取类型，如"product"表示产品信息
-        :return: 提取的结构化信息
-        """
-        # 根据提取类型构建不同的提示词
-        if extraction_type == "product":
-            prompt = self._build_product_extraction_prompt(content)
-        else:
-            raise ValueError(f"不支持的提取类型: {extraction_type}")
-
-        # 调用模型
-        messages = [{
-            "role": "user",
-            "content": prompt
-        }]
-
-        response = self.chat(messages)
-
-        # 解析响应
-        try:
-            if "choices" in response and len(response["choices"]) > 0:
-                text_response = response["choices"][0]["message"]["content"]
-
-                # 尝试从文本中提取JSON
-                start_pos = text_response.find('{')
-                end_pos = text_response.rfind('}') + 1
-
-                if start_pos >= 0 and end_pos > start_pos:
-                    json_str = text_response[start_pos:end_pos]
-                    result = json.loads(json_str)
-                    return result
-                else:
-                    raise ValueError("无法从响应中提取有效的JSON")
-            else:
-                raise ValueError(f"模型响应错误: {response}")
-        except Exception as e:
-            print(f"解析模型响应失败: {e}")
-            print(f"原始响应: {response}")
-            # 返回一个空结构，避免程序崩溃
-            return {
-                "product_name": "",
-                "parameters": [],
-                "selling_points": [],
-                "technical_specs": []
-            }
-
-    def _build_product_extraction_prompt(self, content: str) -> str:
-        """
-        构建产品信息提取的提示词
-        :param content: 文档内容
-        :return: 提示词
-        """
-        return f"""
-        请从以下文档中提取产品相关信息，并以JSON格式返回。需要提取的信息包括：
-        1. 产品名称
-        2. 产品参数（如尺寸、重量、材质等）
-        3. 产品卖点描述
-        4. 技术指标（如性能参数、规格标准等）
-
-        请以以下JSON格式返回：
-        {{
-            "product_name": "产品名称",
-            "parameters": [
-                {{"name": "参数名称1", "value": "参数值1"}},
-                {{"name": "参数名称2", "value": "参数值2"}},
-                ...
-            ],
-            "selling_points": [
-                "卖点1",
-                "卖点2",
-                ...
-            ],
-            "technical_specs": [
-                {{"name": "指标名称1", "value": "指标值1"}},
-                {{"name": "指标名称2", "value": "指标值2"}},
-                ...
-            ]
-        }}
-
-        文档内容：
-        {content}
+        逐个事件解析千帆的SSE流式响应，转换为与Ollama流式响应相同结构的增量消息：
+        {"model", "message": {"role": "assistant", "content": 本次新增的文本}, "done": False}，
+        最后产出一条 content 为空、done 为 True 的结束消息
         """
-
-
-class OllamaModelService(ModelService):
-    """Ollama模型服务"""
-
-    def __init__(self, host: str = "http://127.0.0.1:11434", model: str = "deepseek-r1:7b"):
+        done_reason = None
+        # 只在收到响应头之前重试，已经输出的内容不会重复
+        async with self.transport.stream("POST", self.url, headers=self._headers(True),
+                                         json=self._payload(messages, temperature, True)) as response:
+            # aiter_bytes 每收到一段数据就产出，不等凑满固定大小的块
+            async for event, data in aiter_sse_events(response.aiter_bytes()):
+                if data == "[DONE]":
+                    break
+                result = json.loads(data)
+                if "error" in result or "error_code" in result:
+                    raise ModelAPIError(f"API请求失败: {result.get('error') or result}", response.status_code, result)
+                for choice in result.get("choices", []):
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        yield {"model": self.model, "message": {"role": "assistant", "content": content},
+                               "done": False}
+                    done_reason = choice.get("finish_reason") or done_reason
+
+        yield {"model": self.model, "message": {"role": "assistant", "content": ""}, "done": True,
+               "done_reason": done_reason}
+
+    async def aclose(self):
+        # 共用的传输层由创建者负责关闭
+        if self._owns_transport:
+            await self.transport.aclose()
+
+
+class AsyncOllamaModelService(AsyncModelService):
+    """Ollama模型服务（异步，基于 ollama.AsyncClient）"""
+
+    def __init__(self, host: str = "http://127.0.0.1:11434", model: str = "deepseek-r1:7b",
+                 max_concurrency: int = 4, timeout: Optional[float] = None,
+                 scheduler: Optional[RequestScheduler] = None):
         """
         初始化Ollama模型服务
         :param host: Ollama服务器地址
         :param model: 使用的模型名称
+        :param max_concurrency: 最多同时进行的请求数（本地模型通常一次只能处理少量请求）
+        :param timeout: 默认的单次调用截止时间（秒），为None时不限制（本地模型生成较慢，与原先的同步客户端一致）
+        :param scheduler: 限流调度器，为空时不限流
         """
+        super().__init__(model, max_concurrency, timeout, scheduler)
         try:
             import ollama
-            self.client = ollama.Client(host=host)
-            self.model = model
+            self.client = ollama.AsyncClient(host=host)
         except ImportError:
             raise ImportError("请安装ollama包: pip install ollama")
 
+    def _options(self, temperature: Optional[float]) -> Optional[Dict[str, Any]]:
+        return {"temperature": temperature} if temperature is not None else None
+
+    async def _request(self, messages: List[Dict[str, Any]], temperature: Optional[float]) -> Dict[str, Any]:
+        response = await self.client.chat(model=self.model, messages=messages, stream=False,
+                                          options=self._options(temperature))
+        # 转换为统一格式
+        prompt_tokens = response.get('prompt_eval_count') or 0
+        completion_tokens = response.get('eval_count') or 0
+        return {
+            "choices": [{
+                "message": {
+                    "content": response['message']['content']
+                }
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+    async def _stream(self, messages: List[Dict[str, Any]], temperature: Optional[float]) -> AsyncIterator[Dict[str, Any]]:
+        async for chunk in await self.client.chat(model=self.model, messages=messages, stream=True,
+                                                  options=self._options(temperature)):
+            yield chunk
+
+
+class ModelService:
+    """模型服务基类，定义通用接口"""
+
+    def extract_info(self, content: str, extraction_type: str = "product") -> Dict[Any, Any]:
+        """
+        从内容中提取信息
+        :param content: 要分析的文本内容
+        :param extraction_type: 提取类型，如"product"表示产品信息
+        :return: 提取的结构化信息
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
     def chat(self, messages: List[Dict[str, Any]], temperature: float = 0.7, stream: bool = False) -> Dict[str, Any]:
         """
-        Ollama聊天接口
+        聊天接口
         :param messages: 消息列表
         :param temperature: 温度参数
         :param stream: 是否流式输出
         :return: 模型响应
         """
-        response = self.client.chat(
-            model=self.model,
-            messages=messages,
-            stream=stream,
-            options={"temperature": temperature}
-        )
+        raise NotImplementedError("Subclasses must implement this method")
 
-        if stream:
-            return response
-        else:
-            # 转换为统一格式
-            return {
-                "choices": [{
-                    "message": {
-                        "content": response['message']['content']
-                    }
-                }]
-            }
 
-    def extract_info(self, content: str, extraction_type: str = "product") -> Dict[Any, Any]:
+class SyncModelService(ModelService):
+    """
+    异步模型服务的同步包装：请求在后台事件循环中执行，多个线程（会话）的请求共享连接池、并发限制和限流调度器
+    chat 按交互优先级排队，extract_info 和批量接口按批量优先级排队
+    """
+
+    def __init__(self, async_service: AsyncModelService):
+        self.async_service = async_service
+
+    @property
+    def model(self) -> str:
+        return self.async_service.model
+
+    def chat(self, messages: List[Dict[str, Any]], temperature: float = 0.7,
+             stream: bool = False) -> Union[Dict[str, Any], Iterator[Dict[str, Any]]]:
         """
-        使用Ollama模型从内容中提取信息
-        :param content: 要分析的文本内容
-        :param extraction_type: 提取类型，如"product"表示产品信息
-        :return: 提取的结构化信息
+        聊天接口
+        :param messages: 消息列表
+        :param temperature: 温度参数，控制响应的随机性
+        :param stream: 是否使用流式响应
+        :return: 模型响应；流式时为增量消息的生成器，结构与Ollama流式响应相同
         """
-        # 根据提取类型构建不同的提示词
-        if extraction_type == "product":
-            prompt = self._build_product_extraction_prompt(content)
-        else:
-            raise ValueError(f"不支持的提取类型: {extraction_type}")
+        if stream:
+            return iter_sync(self.async_service.astream(messages, temperature))
+        return run_sync(self.async_service.achat(messages, temperature))
 
-        # 调用模型
-        response = self.client.chat(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            stream=False
-        )
+    def extract_info(self, content: str, extraction_type: str = "product") -> Dict[Any, Any]:
+        return run_sync(self.async_service.aextract_info(content, extraction_type))
 
-        # 解析响应
-        try:
-            # 尝试直接解析JSON
-            text_response = response['message']['content']
+    def chat_many(self, conversations: List[List[Dict[str, Any]]], temperature: float = 0.7,
+                  timeout: Optional[float] = None) -> List[Any]:
+        """并发进行多组对话（见 AsyncModelService.achat_many），失败的对话以异常对象表示"""
+        return run_sync(self.async_service.achat_many(conversations, temperature, timeout))
 
-            # 尝试从文本中提取JSON
-            start_pos = text_response.find('{')
-            end_pos = text_response.rfind('}') + 1
+    def extract_info_many(self, contents: List[str], extraction_type: str = "product",
+                          timeout: Optional[float] = None) -> List[Any]:
+        """并发从多段内容中提取信息，失败的以异常对象表示"""
+        return run_sync(self.async_service.aextract_many(contents, extraction_type, timeout))
 
-            if start_pos >= 0 and end_pos > start_pos:
-                json_str = text_response[start_pos:end_pos]
-                result = json.loads(json_str)
-                return result
-            else:
-                raise ValueError("无法从响应中提取有效的JSON")
-        except Exception as e:
-            print(f"解析模型响应失败: {e}")
-            # 返回一个空结构，避免程序崩溃
-            return {
-                "product_name": "",
-                "parameters": [],
-                "selling_points": [],
-                "technical_specs": []
-            }
+    def close(self):
+        run_sync(self.async_service.aclose())
+
+
+class QianfanModelService(SyncModelService):
+    """百度千帆大模型服务（同步接口，见 AsyncQianfanModelService）"""
 
-    def _build_product_extraction_prompt(self, content: str) -> str:
+    def __init__(self, api_key: str = None, authorization: str = None, model: str = "ernie-4.5-turbo-vl-32k",
+                 max_concurrency: int = 4, timeout: float = 30.0, transport_config: Optional[TransportConfig] = None):
         """
-        构建产品信息提取的提示词
-        :param content: 文档内容
-        :return: 提示词
+        :param transport_config: 连接池、重试和熔断配置；配置相同的实例共用一个传输层，
+                                 各会话的请求复用长连接，熔断状态也一致
         """
-        return f"""
-        请从以下文档中提取产品相关信息，并以JSON格式返回。需要提取的信息包括：
-        1. 产品名称
-        2. 产品参数（如尺寸、重量、材质等）
-        3. 产品卖点描述
-        4. 技术指标（如性能参数、规格标准等）
+        super().__init__(AsyncQianfanModelService(api_key, authorization, model, max_concurrency, timeout,
+                                                  transport=shared_transport(transport_config),
+                                                  scheduler=shared_scheduler()))
 
-        请以以下JSON格式返回：
-        {{
-            "product_name": "产品名称",
-            "parameters": [
-                {{"name": "参数名称1", "value": "参数值1"}},
-                {{"name": "参数名称2", "value": "参数值2"}},
-                ...
-            ],
-            "selling_points": [
-                "卖点1",
-                "卖点2",
-                ...
-            ],
-            "technical_specs": [
-                {{"name": "指标名称1", "value": "指标值1"}},
-                {{"name": "指标名称2", "value": "指标值2"}},
-                ...
-            ]
-        }}
 
-        文档内容：
-        {content}
-        """
+class OllamaModelService(SyncModelService):
+    """Ollama模型服务（同步接口，见 AsyncOllamaModelService）"""
+
+    def __init__(self, host: str = "http://127.0.0.1:11434", model: str = "deepseek-r1:7b",
+                 max_concurrency: int = 4, timeout: Optional[float] = None):
+        super().__init__(AsyncOllamaModelService(host, model, max_concurrency, timeout, scheduler=shared_scheduler()))
 
 
 # 工厂函数，用于创建模型服务实例
@@ -389,3 +639,18 @@ def create_model_service(service_type: str = "qianfan", **kwargs) -> ModelServic
         return OllamaModelService(**kwargs)
     else:
         raise ValueError(f"不支持的服务类型: {service_type}")
+
+
+def create_async_model_service(service_type: str = "qianfan", **kwargs) -> AsyncModelService:
+    """
+    创建异步模型服务实例
+    :param service_type: 服务类型，支持"qianfan"和"ollama"
+    :param kwargs: 其他参数，将传递给相应的异步模型服务构造函数
+    :return: 异步模型服务实例
+    """
+    if service_type.lower() == "qianfan":
+        return AsyncQianfanModelService(**kwargs)
+    elif service_type.lower() == "ollama":
+        return AsyncOllamaModelService(**kwargs)
+    else:
+        raise ValueError(f"不支持的服务类型: {service_type}")
@@ -0,0 +1,267 @@
+import asyncio
+import email.utils
+import importlib.util
+import math
+import random
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+import httpx
+
+
+class ModelServiceError(Exception):
+    """模型服务调用失败"""
+
+
+class ModelConnectionError(ModelServiceError):
+    """网络连接失败或读取超时"""
+
+
+class ModelAPIError(ModelServiceError):
+    """接口返回错误"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, body: Any = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+class RateLimitError(ModelAPIError):
+    """请求被限流（HTTP 429）"""
+
+    def __init__(self, message: str, status_code: Optional[int] = 429, body: Any = None,
+                 retry_after: Optional[float] = None):
+        super().__init__(message, status_code, body)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(ModelServiceError):
+    """熔断器打开，请求未发送"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class TransportConfig:
+    """模型服务HTTP传输层配置（不可变，可作为共享连接池的键）"""
+    max_connections: int = 20  # 连接池最大连接数
+    max_keepalive_connections: int = 10  # 空闲时保持的长连接数
+    keepalive_expiry: float = 60.0  # 空闲长连接的保持时间（秒）
+    http2: bool = True  # 使用HTTP/2，需要安装 h2 包，未安装时使用HTTP/1.1
+    connect_timeout: float = 10.0  # 建立连接的超时时间（秒）
+    read_timeout: float = 60.0  # 每次读取的超时时间（秒），整个调用的截止时间由模型服务控制
+    max_retries: int = 3  # 失败后的最大重试次数
+    backoff_base: float = 0.5  # 第一次重试的退避时间上限（秒），之后每次翻倍
+    backoff_max: float = 8.0  # 退避时间上限（秒）
+    max_retry_after: float = 60.0  # 服务端要求等待更久时不再重试，直接抛出 RateLimitError
+    retry_statuses: Tuple[int, ...] = (429, 500, 502, 503, 504)  # 需要重试的状态码
+    failure_threshold: int = 5  # 连续失败多少次后熔断
+    reset_timeout: float = 30.0  # 熔断后多久放行一个试探请求（秒）
+    verify: bool = False  # 是否验证SSL证书
+    trust_env: bool = False  # 是否使用环境变量中的代理设置
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+def create_http_client(config: TransportConfig, headers: Optional[Dict[str, str]] = None) -> httpx.AsyncClient:
+    """按配置创建带连接池的 httpx.AsyncClient，长连接复用避免每次请求重新进行TLS握手"""
+    return httpx.AsyncClient(
+        headers=headers,
+        limits=httpx.Limits(max_connections=config.max_connections,
+                            max_keepalive_connections=config.max_keepalive_connections,
+                            keepalive_expiry=config.keepalive_expiry),
+        timeout=httpx.Timeout(config.read_timeout, connect=config.connect_timeout),
+        http2=config.http2 and http2_available(),
+        verify=config.verify,
+        trust_env=config.trust_env
+    )
+
+
+def parse_retry_after(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    """
+    解析 Retry-After 响应头
+    :param value: 秒数或HTTP日期
+    :param now: 当前时间戳，为空时使用 time.time()
+    :return: 需要等待的秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - (time.time() if now is None else now))
+
+
+def backoff_delay(attempt: int, config: TransportConfig, retry_after: Optional[float] = None) -> Optional[float]:
+    """
+    第 attempt 次重试（从0开始）前的等待时间
+    指数退避加全随机抖动，避免大量请求同时重试；服务端给出 Retry-After 时至少等待该时长
+    :return: 等待秒数，不应再重试时返回None
+    """
+    if attempt >= config.max_retries:
+        return None
+    if retry_after is not None:
+        if retry_after > config.max_retry_after:
+            return None
+        return retry_after + random.uniform(0, config.backoff_base)
+    return random.uniform(0, min(config.backoff_max, config.backoff_base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败 failure_threshold 次后打开，期间的请求直接抛出 CircuitOpenError 而不再访问服务端；
+    reset_timeout 秒后进入半开状态放行一个试探请求，成功则关闭，失败则重新打开
+    只在后台事件循环中使用，不需要加锁
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None  # 半开状态下试探请求的开始时间
+
+    def before_call(self):
+        """发送请求前调用，熔断期间抛出 CircuitOpenError"""
+        if self.state == self.CLOSED:
+            return
+        now = self.clock()
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.reset_timeout - now
+            if remaining > 0:
+                raise CircuitOpenError(f"模型服务连续失败，已暂停请求，{math.ceil(remaining)}秒后重试", remaining)
+            self.state = self.HALF_OPEN
+            self.probe_started = None
+        # 半开状态只放行一个试探请求；试探请求被取消而没有结果时，超过 reset_timeout 再放行下一个
+        if self.probe_started is not None and now - self.probe_started < self.reset_timeout:
+            raise CircuitOpenError("模型服务正在恢复，请稍后重试", self.reset_timeout - (now - self.probe_started))
+        self.probe_started = now
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+            self.probe_started = None
+
+
+def api_error(response: httpx.Response) -> ModelAPIError:
+    """把失败的响应转换为对应的异常（响应内容需已读取）"""
+    message = f"API请求失败: {response.status_code} {response.text}"
+    if response.status_code == 429:
+        return RateLimitError(message, body=response.text,
+                              retry_after=parse_retry_after(response.headers.get("Retry-After")))
+    return ModelAPIError(message, response.status_code, response.text)
+
+
+class ModelTransport:
+    """
+    模型服务的HTTP传输层：连接池和长连接、HTTP/2、失败重试和熔断
+    连接失败、读取超时和 retry_statuses 中的状态码会按退避策略重试，其他4xx直接抛出；
+    流式请求只在收到响应头之前重试，已开始输出的流不会重放
+    """
+
+    def __init__(self, config: Optional[TransportConfig] = None, headers: Optional[Dict[str, str]] = None):
+        """
+        :param config: 传输层配置，为空时使用默认值
+        :param headers: 每个请求都携带的请求头
+        """
+        self.config = config or TransportConfig()
+        self.client = create_http_client(self.config, headers)
+        self.breaker = CircuitBreaker(self.config.failure_threshold, self.config.reset_timeout)
+
+    async def _send(self, method: str, url: str, stream: bool, **kwargs) -> httpx.Response:
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            retry_after = None
+            try:
+                response = await self.client.send(self.client.build_request(method, url, **kwargs), stream=stream)
+            except httpx.TransportError as e:
+                self.breaker.record_failure()
+                error = ModelConnectionError(f"网络请求失败: {str(e)}")
+            else:
+                if response.is_success:
+                    self.breaker.record_success()
+                    return response
+                if stream:
+                    await response.aread()
+                    await response.aclose()
+                error = api_error(response)
+                # 5xx说明服务端异常，计入熔断；限流和其他4xx说明服务端正常响应
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if response.status_code not in self.config.retry_statuses:
+                    raise error
+                retry_after = getattr(error, "retry_after", None)
+
+            # 本次失败触发熔断时不再重试，抛出实际的错误
+            delay = None if self.breaker.state == CircuitBreaker.OPEN else backoff_delay(attempt, self.config,
+                                                                                          retry_after)
+            if delay is None:
+                raise error
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        发送请求，失败时按策略重试
+        :param kwargs: 传给 httpx.AsyncClient.build_request 的参数，如 headers、json
+        :return: 状态码为2xx的响应
+        """
+        return await self._send(method, url, False, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """流式请求，在上下文中读取响应内容；读取中途的网络错误转换为 ModelConnectionError"""
+        response = await self._send(method, url, True, **kwargs)
+        try:
+            yield response
+        except httpx.TransportError as e:
+            self.breaker.record_failure()
+            raise ModelConnectionError(f"网络请求失败: {str(e)}")
+        finally:
+            await response.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+_shared_transports = {}
+_shared_lock = threading.Lock()
+
+
+def shared_transport(config: Optional[TransportConfig] = None) -> ModelTransport:
+    """进程内按配置共享的传输层：所有会话复用同一个连接池和熔断器（只能在后台事件循环中使用）"""
+    config = config or TransportConfig()
+    with _shared_lock:
+        if config not in _shared_transports:
+            _shared_transports[config] = ModelTransport(config)
+        return _shared_transports[config]
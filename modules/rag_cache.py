@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    检索结果缓存：LRU淘汰 + TTL过期
+    每个条目记录写入时的索引代数，索引增删文档后代数变化，旧条目在下次读取时失效
+    """
+
+    def __init__(self, max_size=1024, ttl=600):
+        """
+        :param max_size: 最多缓存的查询数量
+        :param ttl: 条目存活时间（秒），为None时不过期
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # 键 -> (索引代数, 写入时间, 结果)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        """
+        读取缓存结果
+        :param key: 缓存键
+        :param generation: 当前索引代数
+        :return: 结果列表的副本，未命中时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, created, results = entry
+                if entry_generation == generation and (self.ttl is None or time.monotonic() - created < self.ttl):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return [dict(chunk) for chunk in results]
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, results):
+        """写入检索结果，超出容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._entries[key] = (generation, time.monotonic(), [dict(chunk) for chunk in results])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """命中统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'max_size': self.max_size
+            }
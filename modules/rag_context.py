@@ -0,0 +1,165 @@
+import math
+import re
+
+# 常用模型的上下文窗口（token数），未列出的模型按名称中的"-8k"/"-32k"等后缀推断
+MODEL_CONTEXT_WINDOWS = {
+    "ernie-4.5-turbo-vl-32k": 32768,
+    "ernie-4.0-turbo-8k": 8192,
+    "ernie-3.5-8k": 8192,
+    "ernie-lite-8k": 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 4096  # 无法推断时的保守默认值（如本地Ollama模型）
+
+_WINDOW_SUFFIX = re.compile(r'(\d+)k\b', re.IGNORECASE)
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')  # 中日韩字符和全角标点
+_SPACE = re.compile(r'\s')
+
+
+def estimate_tokens(text):
+    """
+    估算文本的token数：中文字符和全角标点按1个token计，其余非空白字符按3个字符1个token计
+    各模型分词器不同，这里偏保守地高估，保证按预算组装的上下文不会超出窗口
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    others = len(text) - cjk - len(_SPACE.findall(text))
+    return cjk + math.ceil(others / 3)
+
+
+def context_window(model):
+    """模型的上下文窗口（token数）"""
+    if model in MODEL_CONTEXT_WINDOWS:
+        return MODEL_CONTEXT_WINDOWS[model]
+    match = _WINDOW_SUFFIX.search(model or "")
+    if match:
+        return int(match.group(1)) * 1024
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def context_budget(model, context_ratio=0.5):
+    """
+    检索上下文可用的token预算
+    :param model: 模型名称
+    :param context_ratio: 上下文窗口中分给检索文档的比例，其余留给系统提示词、历史消息和回答
+    """
+    return int(context_window(model) * context_ratio)
+
+
+def chunk_tokens(chunk):
+    """文档块的token数，优先使用入库时算好的值"""
+    token_count = chunk.get('token_count')
+    if token_count is None:
+        token_count = estimate_tokens(chunk['content'])
+    return token_count
+
+
+def _chunk_position(chunk):
+    """文档块在文件中的序号（chunk_id 为 "{文件名}_{序号}"）"""
+    position = chunk['chunk_id'].rsplit('_', 1)[-1]
+    return int(position) if position.isdigit() else None
+
+
+def overlap_length(previous, following, min_length=5):
+    """
+    相邻文档块的重叠长度：following 的最长前缀同时是 previous 的后缀（前缀函数，线性时间）
+    :param min_length: 短于此长度的重叠视为巧合，不裁剪
+    """
+    length = min(len(previous), len(following))
+    if length < min_length:
+        return 0
+    text = following[:length] + '\0' + previous[-length:]
+    prefix = [0] * len(text)
+    for i in range(1, len(text)):
+        k = prefix[i - 1]
+        while k and text[i] != text[k]:
+            k = prefix[k - 1]
+        if text[i] == text[k]:
+            k += 1
+        prefix[i] = k
+    return prefix[-1] if prefix[-1] >= min_length else 0
+
+
+def _merge_blocks(chunks, header_tokens):
+    """
+    把同一文件中序号相邻的文档块合并为连续片段，并裁掉重叠部分
+    跨集合检索时不同集合中的同名文件是不同的文档，按 (集合, 文件名) 分组，不会合并
+    """
+    groups = {}
+    for rank, chunk in enumerate(chunks):
+        groups.setdefault((chunk.get('collection'), chunk['filename']), []).append((rank, chunk))
+
+    blocks = []
+    for (collection, filename), members in groups.items():
+        members.sort(key=lambda member: (_chunk_position(member[1]) is None, _chunk_position(member[1]) or 0))
+        block = None
+        for rank, chunk in members:
+            position = _chunk_position(chunk)
+            if block is not None and position is not None and block['end'] == position - 1:
+                trimmed = overlap_length(block['content'], chunk['content'])
+                joiner = '' if trimmed else '\n'
+                block['content'] += joiner + chunk['content'][trimmed:]
+                block['token_count'] += chunk_tokens(chunk) - estimate_tokens(chunk['content'][:trimmed])
+                block['chunk_ids'].append(chunk['chunk_id'])
+                block['rank'] = min(block['rank'], rank)
+                block['relevance_score'] = max(block['relevance_score'], chunk.get('relevance_score', 0.0))
+                block['end'] = position
+                continue
+            block = {
+                'filename': filename,
+                'collection': collection,
+                'content': chunk['content'],
+                'chunk_ids': [chunk['chunk_id']],
+                'token_count': chunk_tokens(chunk) + header_tokens,
+                'relevance_score': chunk.get('relevance_score', 0.0),
+                'rank': rank,
+                'end': position
+            }
+            blocks.append(block)
+
+    # 片段按其中最相关的文档块排序
+    blocks.sort(key=lambda block: block['rank'])
+    return blocks
+
+
+def _truncate(text, budget):
+    """截取不超过预算的最长前缀（二分查找）"""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+def pack_context(chunks, budget=None, header_tokens=16):
+    """
+    在token预算内组装检索上下文
+    按相关性依次贪心加入文档块，同一文件中序号相邻的文档块合并为一个片段并裁掉重叠文本，
+    合并节省的token可以容纳更多文档块；放不下的文档块跳过，继续尝试后面更短的文档块
+    :param chunks: 按相关性降序的文档块列表
+    :param budget: token预算，为None时不限制（仍会合并相邻文档块）
+    :param header_tokens: 每个片段标题（序号、来源）占用的token数
+    :return: 片段列表，每个片段包含 filename/collection/content/chunk_ids/token_count/relevance_score，
+             collection 为文档块所属的集合（未标注时为None）
+    """
+    selected = []
+    blocks = []
+    for chunk in chunks:
+        trial = _merge_blocks(selected + [chunk], header_tokens)
+        if budget is None or sum(block['token_count'] for block in trial) <= budget:
+            selected.append(chunk)
+            blocks = trial
+
+    if not selected and chunks and budget is not None and budget > header_tokens:
+        # 最相关的文档块单独也放不下时截断它，而不是返回空上下文
+        chunk = dict(chunks[0])
+        chunk['content'] = _truncate(chunk['content'], budget - header_tokens)
+        chunk['token_count'] = estimate_tokens(chunk['content'])
+        blocks = _merge_blocks([chunk], header_tokens)
+
+    for block in blocks:
+        del block['rank'], block['end']
+    return blocks
@@ -0,0 +1,137 @@
+import hashlib
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+_MASK = (1 << 64) - 1
+
+
+def _to_signed(value):
+    """64位无符号整数转为有符号整数，便于存入 int64 数组"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def bytes_fingerprint(data):
+    """文件内容的指纹（BLAKE2b-128十六进制串）"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_fingerprint(file, block_size=1024 * 1024):
+    """逐块读取文件计算内容指纹（与 bytes_fingerprint 结果一致），完成后把文件指针移回开头"""
+    digest = hashlib.blake2b(digest_size=16)
+    file.seek(0)
+    while True:
+        block = file.read(block_size)
+        if not block:
+            break
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def content_hash(text):
+    """文档块正文的64位哈希（忽略空白差异），用于精确去重"""
+    normalized = ''.join(text.split()).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(normalized, digest_size=8).digest(), 'little', signed=True)
+
+
+@lru_cache(maxsize=65536)
+def _term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def simhash(term_freqs):
+    """
+    按词频加权的64位SimHash：内容相近的文档块指纹的汉明距离也小
+    :param term_freqs: 词项 -> 词频
+    :return: 有符号64位整数
+    """
+    if not term_freqs:
+        return 0
+    hashes = np.array([_term_hash(term) for term in term_freqs], dtype=np.uint64)
+    weights = np.array(list(term_freqs.values()), dtype=np.float64)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    votes = weights @ (bits.astype(np.float64) * 2 - 1)
+    fingerprint = np.packbits(votes > 0, bitorder='little').view('<u8')[0]
+    return _to_signed(int(fingerprint))
+
+
+def chunk_fingerprints(chunk):
+    """文档块的 (正文哈希, SimHash)，优先使用分块时已算好的值"""
+    digest = chunk.get('content_hash')
+    if digest is None:
+        digest = content_hash(chunk['content'])
+    fingerprint = chunk.get('simhash')
+    if fingerprint is None:
+        fingerprint = simhash(chunk.get('term_freqs') or Counter(chunk['keywords']))
+    return digest, fingerprint
+
+
+def hamming_distance(a, b):
+    return ((a ^ b) & _MASK).bit_count()
+
+
+def shingle_similarity(a, b, size=3):
+    """两段文本字符 size-gram 集合的Jaccard相似度，用于确认SimHash找到的候选确实相近"""
+    a, b = ''.join(a.split()), ''.join(b.split())
+    shingles_a = {a[i:i + size] for i in range(max(1, len(a) - size + 1))}
+    shingles_b = {b[i:i + size] for i in range(max(1, len(b) - size + 1))}
+    return len(shingles_a & shingles_b) / len(shingles_a | shingles_b)
+
+
+class DuplicateDetector:
+    """
+    重复文档块检测：正文哈希精确匹配，SimHash分段索引查找近似重复
+    64位指纹分成 max_distance + 1 段，汉明距离不超过 max_distance 的两个指纹至少有一段完全相同（抽屉原理），
+    因此只需比较至少一段相同的候选
+    """
+
+    def __init__(self, max_distance=3):
+        """
+        :param max_distance: 判定为近似重复的最大汉明距离，为0时只做精确去重
+        """
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.band_bits = 64 // self.bands
+        self.exact = {}  # 正文哈希 -> 文档ID
+        self.fingerprints = {}  # 文档ID -> (正文哈希, SimHash)
+        self.band_index = [{} for _ in range(self.bands)] if max_distance else []  # 分段值 -> 文档ID列表
+
+    def _band_keys(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [((fingerprint & _MASK) >> (band * self.band_bits)) & mask for band in range(self.bands)]
+
+    def add(self, doc_id, digest, fingerprint):
+        self.exact.setdefault(digest, doc_id)
+        self.fingerprints[doc_id] = (digest, fingerprint)
+        if self.max_distance:
+            for index, key in zip(self.band_index, self._band_keys(fingerprint)):
+                index.setdefault(key, []).append(doc_id)
+
+    def remove(self, doc_id):
+        entry = self.fingerprints.pop(doc_id, None)
+        if entry is None:
+            return
+        digest, fingerprint = entry
+        if self.exact.get(digest) == doc_id:
+            del self.exact[digest]
+        if self.max_distance:
+            for index, key in zip(self.band_index, self._band_keys(fingerprint)):
+                doc_ids = index[key]
+                doc_ids.remove(doc_id)
+                if not doc_ids:
+                    del index[key]
+
+    def find_exact(self, digest):
+        return self.exact.get(digest)
+
+    def near_candidates(self, fingerprint):
+        """汉明距离不超过 max_distance 的候选文档ID，按距离升序"""
+        if not self.max_distance:
+            return []
+        candidates = set()
+        for index, key in zip(self.band_index, self._band_keys(fingerprint)):
+            candidates.update(index.get(key, ()))
+        scored = [(hamming_distance(fingerprint, self.fingerprints[doc_id][1]), doc_id) for doc_id in candidates]
+        return [doc_id for distance, doc_id in sorted(scored) if distance <= self.max_distance]
@@ -0,0 +1,136 @@
+from modules.rag_tokenizer import get_tokenizer
+
+
+def reciprocal_rank_fusion(result_lists, k=60, weights=None):
+    """
+    倒数排名融合（RRF）：得分为各检索结果列表中 weight / (k + 名次) 之和，与各路得分的量纲无关
+    :param result_lists: 检索方式 -> 按相关性降序的文档块列表
+    :param k: 平滑常数，越大越弱化头部名次的优势
+    :param weights: 检索方式 -> 权重，默认均为1
+    :return: 融合后按得分降序的文档块列表
+    """
+    weights = weights or {}
+    fused = {}
+    for name, chunks in result_lists.items():
+        weight = weights.get(name, 1.0)
+        for rank, chunk in enumerate(chunks, start=1):
+            _merge(fused, name, chunk)['relevance_score'] += weight / (k + rank)
+    return sorted(fused.values(), key=lambda chunk: chunk['relevance_score'], reverse=True)
+
+
+def weighted_fusion(result_lists, weights=None):
+    """
+    加权融合：各路得分先按最小-最大值归一化到[0, 1]，再按权重求和
+    :param result_lists: 检索方式 -> 按相关性降序的文档块列表
+    :param weights: 检索方式 -> 权重，默认均为1
+    :return: 融合后按得分降序的文档块列表
+    """
+    weights = weights or {}
+    fused = {}
+    for name, chunks in result_lists.items():
+        if not chunks:
+            continue
+        weight = weights.get(name, 1.0)
+        scores = [chunk['relevance_score'] for chunk in chunks]
+        low, high = min(scores), max(scores)
+        for chunk, score in zip(chunks, scores):
+            normalized = (score - low) / (high - low) if high > low else 1.0
+            _merge(fused, name, chunk)['relevance_score'] += weight * normalized
+    return sorted(fused.values(), key=lambda chunk: chunk['relevance_score'], reverse=True)
+
+
+def _merge(fused, name, chunk):
+    """按chunk_id合并各路结果，retrieval_scores 中保留每一路的原始得分"""
+    entry = fused.get(chunk['chunk_id'])
+    if entry is None:
+        entry = dict(chunk)
+        entry['relevance_score'] = 0.0
+        entry['retrieval_scores'] = {}
+        fused[chunk['chunk_id']] = entry
+    entry['retrieval_scores'][name] = chunk['relevance_score']
+    return entry
+
+
+FUSION_METHODS = ("rrf", "weighted")
+
+
+def fuse_results(method, result_lists, **kwargs):
+    """
+    融合多路检索结果
+    :param method: 融合方式，支持"rrf"和"weighted"
+    :param result_lists: 检索方式 -> 按相关性降序的文档块列表
+    :param kwargs: 其他参数，将传递给相应的融合函数
+    :return: 融合后按得分降序的文档块列表
+    """
+    method = method.lower()
+    if method == "rrf":
+        return reciprocal_rank_fusion(result_lists, **kwargs)
+    elif method == "weighted":
+        return weighted_fusion(result_lists, **kwargs)
+    else:
+        raise ValueError(f"不支持的融合方式: {method}")
+
+
+class Reranker:
+    """重排序器基类，定义通用接口"""
+
+    name = ""
+
+    def rerank(self, query, chunks, idf):
+        """
+        对候选文档块重新打分排序
+        :param query: 查询文本
+        :param chunks: 候选文档块列表
+        :param idf: 关键词 -> 逆文档频率
+        :return: 按新得分降序的文档块列表（relevance_score 更新为重排序得分）
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+
+class OverlapReranker(Reranker):
+    """
+    轻量的查询-文档交叉打分：按IDF加权的查询关键词覆盖率，加上查询字符二元组在文档块原文中的命中率
+    同时看查询和文档块全文，能纠正只靠单路检索排序时的偏差，开销与候选数和文档块长度成正比
+    """
+
+    name = "overlap"
+
+    def __init__(self, bigram_weight=0.5):
+        self.bigram_weight = bigram_weight
+
+    def rerank(self, query, chunks, idf):
+        keywords = get_tokenizer().query_keywords(query)
+        total_weight = sum(idf.get(keyword, 0.0) for keyword in keywords)
+        compact_query = ''.join(query.split())
+        bigrams = {compact_query[i:i + 2] for i in range(len(compact_query) - 1)}
+
+        reranked = []
+        for chunk in chunks:
+            content = chunk['content']
+            coverage = 0.0
+            if total_weight:
+                coverage = sum(idf.get(keyword, 0.0) for keyword in keywords if keyword in content) / total_weight
+            bigram_hits = sum(1 for bigram in bigrams if bigram in content) / len(bigrams) if bigrams else 0.0
+
+            chunk = dict(chunk)
+            chunk['retrieval_scores'] = dict(chunk.get('retrieval_scores', {}), fused=chunk['relevance_score'])
+            chunk['relevance_score'] = coverage + self.bigram_weight * bigram_hits
+            reranked.append(chunk)
+
+        # 得分相同时保持融合后的顺序
+        reranked.sort(key=lambda chunk: chunk['relevance_score'], reverse=True)
+        return reranked
+
+
+# 工厂函数，用于创建重排序器实例
+def create_reranker(reranker_type="overlap", **kwargs):
+    """
+    创建重排序器
+    :param reranker_type: 重排序器类型，目前支持"overlap"
+    :param kwargs: 其他参数，将传递给相应的构造函数
+    :return: 重排序器实例
+    """
+    if reranker_type.lower() == "overlap":
+        return OverlapReranker(**kwargs)
+    else:
+        raise ValueError(f"不支持的重排序器: {reranker_type}")
@@ -0,0 +1,130 @@
+"""
+批量导入目录中的文档到RAG索引
+
+用法：
+    python -m modules.rag_ingest <目录> [--workers N] [--index-dir rag_index] [--batch-size 100] [--user-id 1] [--collection default]
+
+文件解析和分词在多个进程中并行执行，每批结果在一次写锁和一次持久化中合并进索引。
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+from modules.rag_module import RAGCollections, DEFAULT_COLLECTION, DEFAULT_USER_ID, UploadedBytes, create_ingest_pool
+from modules.rag_vector import default_embedder
+
+# 扩展名 -> read_file 识别的MIME类型，其余文件按文本处理
+FILE_TYPES = {
+    ".txt": "text/plain",
+    ".md": "text/plain",
+    ".pdf": "application/pdf",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+}
+
+LARGE_FILE_BYTES = 32 * 1024 * 1024  # 超过该大小的文件不进入进程池，在主进程中流式读取和分块
+
+
+class DiskFile(io.FileIO):
+    """以二进制方式打开的本地文件，附带 read_file/iter_file_text 需要的文件名和类型"""
+
+    def __init__(self, path, name, type):
+        super().__init__(path, 'rb')
+        self.name = name
+        self.type = type
+
+
+def find_files(directory, extensions=None):
+    """
+    递归查找目录中支持的文件
+    :param directory: 目录路径
+    :param extensions: 需要导入的扩展名集合，默认为 FILE_TYPES 中的全部类型
+    :return: 排序后的文件路径列表
+    """
+    extensions = extensions or set(FILE_TYPES)
+    paths = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if os.path.splitext(name)[1].lower() in extensions:
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def file_type(path):
+    return FILE_TYPES.get(os.path.splitext(path)[1].lower(), "text/plain")
+
+
+def load_file(path, directory):
+    """读取文件为 UploadedBytes，文件名使用相对于导入目录的路径，避免不同子目录中的同名文件互相覆盖"""
+    with open(path, "rb") as f:
+        data = f.read()
+    return UploadedBytes(data, os.path.relpath(path, directory), file_type(path))
+
+
+def ingest_directory(directory, index_dir="rag_index", workers=None, batch_size=100, shards=None,
+                     user_id=DEFAULT_USER_ID, collection=DEFAULT_COLLECTION):
+    """
+    并行导入目录中的全部文档到用户的集合
+    :param directory: 文档目录
+    :param index_dir: 索引根目录
+    :param workers: 工作进程数，默认为CPU核数
+    :param batch_size: 每批提交到索引的文件数，限制同时驻留内存的文件内容
+    :param shards: 索引分片数，为空时沿用集合已有的布局
+    :param user_id: 用户ID
+    :param collection: 集合名称
+    :return: [(文件名, 是否成功, 消息)]
+    """
+    paths = find_files(directory)
+    # 设置了 RAG_EMBEDDING_MODEL 时同时计算向量
+    collections = RAGCollections(index_dir, embedder=default_embedder(), shards=shards)
+    rag_system = collections.get(user_id, collection)
+    report = []
+
+    # 大文件整体读入内存再跨进程传递代价太高，直接从磁盘流式导入
+    large_paths = [path for path in paths if os.path.getsize(path) > LARGE_FILE_BYTES]
+    paths = [path for path in paths if os.path.getsize(path) <= LARGE_FILE_BYTES]
+    for path in large_paths:
+        name = os.path.relpath(path, directory)
+        with DiskFile(path, name, file_type(path)) as f:
+            success, message = rag_system.add_document(f, name)
+        report.append((name, success, message))
+        print(f"已处理大文件 {name}", file=sys.stderr)
+
+    with create_ingest_pool(workers) as pool:
+        for start in range(0, len(paths), batch_size):
+            batch = [load_file(path, directory) for path in paths[start:start + batch_size]]
+            report.extend(rag_system.add_documents(batch, executor=pool))
+            print(f"已处理 {min(start + batch_size, len(paths))}/{len(paths)} 个文件", file=sys.stderr)
+    rag_system.index.compact()
+    collections.close()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量导入目录中的文档到RAG索引")
+    parser.add_argument("directory", help="文档目录")
+    parser.add_argument("--workers", type=int, default=None, help="工作进程数，默认为CPU核数")
+    parser.add_argument("--index-dir", default="rag_index", help="索引根目录")
+    parser.add_argument("--user-id", default=DEFAULT_USER_ID, help="导入到该用户的集合")
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION, help="集合名称")
+    parser.add_argument("--batch-size", type=int, default=100, help="每批提交到索引的文件数")
+    parser.add_argument("--shards", type=int, default=None, help="索引分片数，默认沿用集合已有的布局")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    report = ingest_directory(args.directory, args.index_dir, args.workers, args.batch_size, args.shards,
+                              args.user_id, args.collection)
+    elapsed = time.perf_counter() - started
+
+    failed = [(filename, message) for filename, success, message in report if not success]
+    for filename, message in failed:
+        print(f"失败: {filename}: {message}")
+    print(f"导入完成：{len(report) - len(failed)} 个成功，{len(failed)} 个失败，耗时 {elapsed:.1f} 秒")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
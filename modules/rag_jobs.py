@@ -0,0 +1,284 @@
+import itertools
+import queue
+import threading
+import time
+
+import streamlit as st
+
+from modules.rag_module import UploadedBytes, get_rag_collections, session_user_id
+
+# 任务状态
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+STATUS_LABELS = {PENDING: "排队中", RUNNING: "处理中", DONE: "已完成", FAILED: "失败"}
+
+
+class IngestJob:
+    """
+    一个文档导入任务
+    任务保存上传文件的内容，失败后可以直接重试而无需重新上传；成功后释放文件内容
+    """
+
+    def __init__(self, job_id, user_id, collection, filename, data, file_type, chunk_size=None):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.collection = collection
+        self.filename = filename
+        self.data = data
+        self.file_type = file_type
+        self.chunk_size = chunk_size
+        self.total_bytes = len(data)
+        self.status = PENDING
+        self.message = ""
+        self.attempts = 0
+        self.bytes_parsed = 0
+        self.chunks_indexed = 0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def reset(self):
+        """重新排队前清空上一次执行的进度"""
+        self.status = PENDING
+        self.message = ""
+        self.bytes_parsed = 0
+        self.chunks_indexed = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def update(self, bytes_parsed, chunks_indexed):
+        """进度回调（见 RAGSystem.add_document），解析库跳读文件时已读取字节数可能回退，只取最大值"""
+        self.bytes_parsed = min(max(self.bytes_parsed, bytes_parsed), self.total_bytes)
+        self.chunks_indexed = chunks_indexed
+
+    def fraction(self):
+        """完成比例（0~1），按已读取的字节数估算"""
+        if self.status == DONE:
+            return 1.0
+        return self.bytes_parsed / self.total_bytes if self.total_bytes else 0.0
+
+    def eta(self):
+        """按目前的读取速度估算的剩余秒数，尚无进度时返回None"""
+        if self.status != RUNNING or not self.bytes_parsed:
+            return None
+        elapsed = time.time() - self.started_at
+        return elapsed * (self.total_bytes - self.bytes_parsed) / self.bytes_parsed
+
+    def snapshot(self):
+        """任务状态的字典副本，供界面展示"""
+        return {
+            'job_id': self.job_id,
+            'filename': self.filename,
+            'collection': self.collection,
+            'status': self.status,
+            'message': self.message,
+            'attempts': self.attempts,
+            'retryable': self.status == FAILED and self.data is not None,
+            'total_bytes': self.total_bytes,
+            'bytes_parsed': self.bytes_parsed,
+            'chunks_indexed': self.chunks_indexed,
+            'fraction': self.fraction(),
+            'eta': self.eta(),
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at
+        }
+
+
+class IngestQueue:
+    """
+    后台文档导入队列：界面提交任务后立即返回，工作线程依次解析文件并写入对应用户集合的索引
+    写入索引本身持有集合的写锁串行执行，解析和分词又受GIL限制，默认一个工作线程即可
+    """
+
+    def __init__(self, collections, workers=1, max_finished=100, max_retryable=5):
+        """
+        :param collections: RAGCollections 实例
+        :param workers: 工作线程数
+        :param max_finished: 每个用户最多保留的已结束（完成或失败）任务数，超出时丢弃最早结束的
+        :param max_retryable: 每个用户最多为多少个失败任务保留文件内容以便重试，更早失败的任务释放文件内容，需重新上传
+        """
+        self.collections = collections
+        self.workers = workers
+        self.max_finished = max_finished
+        self.max_retryable = max_retryable
+        self._jobs = {}  # 任务ID -> IngestJob，按提交顺序
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._threads = []
+
+    def _ensure_workers(self):
+        """首次提交任务时启动工作线程"""
+        if not self._threads:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"rag-ingest-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, user_id, collection, file_obj, chunk_size=None):
+        """
+        提交导入任务
+        :param file_obj: 上传的文件，需提供 name、type 和 read()；内容在提交时读入任务
+        :param chunk_size: 文档块大小，为空时使用默认值
+        :return: 任务ID
+        """
+        file_obj.seek(0)
+        with self._lock:
+            job = IngestJob(next(self._ids), user_id, collection, file_obj.name, file_obj.read(), file_obj.type,
+                            chunk_size)
+            self._jobs[job.job_id] = job
+            self._ensure_workers()
+        self._queue.put(job)
+        return job.job_id
+
+    def retry(self, job_id):
+        """重新排队失败的任务，返回是否成功排队"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != FAILED or job.data is None:
+                return False
+            job.reset()
+        self._queue.put(job)
+        return True
+
+    def jobs(self, user_id):
+        """用户的任务状态列表，按提交顺序"""
+        with self._lock:
+            return [job.snapshot() for job in self._jobs.values() if job.user_id == user_id]
+
+    def has_active(self, user_id):
+        """用户是否有排队中或处理中的任务"""
+        with self._lock:
+            return any(job.user_id == user_id and job.status in (PENDING, RUNNING) for job in self._jobs.values())
+
+    def clear_finished(self, user_id):
+        """移除用户已完成和失败的任务"""
+        with self._lock:
+            for job_id in [job.job_id for job in self._jobs.values()
+                           if job.user_id == user_id and job.status in (DONE, FAILED)]:
+                del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                self._process(job)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, job):
+        with self._lock:
+            if self._jobs.get(job.job_id) is not job:
+                # 排队期间已被移除
+                return
+            job.status = RUNNING
+            job.attempts += 1
+            job.started_at = time.time()
+
+        try:
+            rag_system = self.collections.get(job.user_id, job.collection)
+            success, message = rag_system.add_document(UploadedBytes(job.data, job.filename, job.file_type),
+                                                       job.filename, chunk_size=job.chunk_size,
+                                                       progress=job.update)
+        except Exception as e:
+            success, message = False, f"处理失败：{e}"
+
+        with self._lock:
+            job.status = DONE if success else FAILED
+            job.message = message
+            job.finished_at = time.time()
+            if success:
+                job.bytes_parsed = job.total_bytes
+                job.data = None  # 成功后不再需要重试，释放文件内容
+            self._trim_finished(job.user_id)
+
+    def _trim_finished(self, user_id):
+        """
+        只保留用户最近结束的 max_finished 个任务，只有最近失败的 max_retryable 个任务保留文件内容（需持有锁）
+        失败的任务可能一直不重试，不限制的话上传的文件内容会在进程生命周期内一直占用内存
+        """
+        finished = sorted((job for job in self._jobs.values()
+                           if job.user_id == user_id and job.status in (DONE, FAILED)),
+                          key=lambda job: job.finished_at)
+        for job in finished[:-self.max_finished or None]:
+            del self._jobs[job.job_id]
+        failed = [job for job in finished[-self.max_finished:] if job.status == FAILED and job.data is not None]
+        for job in failed[:len(failed) - self.max_retryable]:
+            job.data = None
+
+    def join(self):
+        """等待队列中的任务全部完成"""
+        self._queue.join()
+
+    def close(self):
+        """处理完已排队的任务后停止工作线程"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+@st.cache_resource
+def get_ingest_queue():
+    """进程内共享的导入队列，写入 get_rag_collections() 中的集合"""
+    return IngestQueue(get_rag_collections())
+
+
+def _format_eta(seconds):
+    if seconds is None:
+        return "估算中"
+    if seconds < 60:
+        return f"约 {seconds:.0f} 秒"
+    return f"约 {seconds / 60:.1f} 分钟"
+
+
+def _show_jobs():
+    ingest_queue = get_ingest_queue()
+    user_id = session_user_id()
+    jobs = ingest_queue.jobs(user_id)
+    if not jobs:
+        return
+
+    st.subheader("⏳ 导入任务")
+    for job in jobs:
+        label = f"{job['filename']} → {job['collection']}（{STATUS_LABELS[job['status']]}）"
+        if job['status'] == RUNNING:
+            st.progress(job['fraction'], text=f"{label} 已读取 {job['bytes_parsed'] / 1024:.0f}/"
+                                             f"{job['total_bytes'] / 1024:.0f} KB，"
+                                             f"已索引 {job['chunks_indexed']} 个文档块，剩余{_format_eta(job['eta'])}")
+        elif job['status'] == FAILED:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                st.error(f"{label}：{job['message']}")
+            with col2:
+                if job['retryable'] and st.button("重试", key=f"retry_job_{job['job_id']}"):
+                    ingest_queue.retry(job['job_id'])
+                    st.rerun()
+        elif job['status'] == DONE:
+            st.success(job['message'])
+        else:
+            st.write(f"🕒 {label}")
+
+    if not ingest_queue.has_active(user_id) and st.button("清除已结束的任务"):
+        ingest_queue.clear_finished(user_id)
+        st.rerun()
+
+    # 有任务结束时整页刷新，更新文档列表和统计，并停止定时刷新
+    finished = sum(job['status'] in (DONE, FAILED) for job in jobs)
+    if finished != st.session_state.get('ingest_jobs_finished', finished):
+        st.session_state['ingest_jobs_finished'] = finished
+        st.rerun()
+    st.session_state['ingest_jobs_finished'] = finished
+
+
+def show_ingest_jobs():
+    """导入任务面板：有未完成的任务时每秒只刷新这一部分，页面其余部分保持可操作"""
+    active = get_ingest_queue().has_active(session_user_id())
+    st.fragment(_show_jobs, run_every=1 if active else None)()
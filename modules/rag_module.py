@@ -1,14 +1,51 @@
+import hashlib
+import heapq
+import io
 import json
+import multiprocessing
 import os
 import re
-import jieba
-from collections import defaultdict, Counter
-import hashlib
-from datetime import datetime
+import shutil
+import threading
+import time
+from array import array
+from collections import ChainMap, Counter, namedtuple
+from itertools import chain, islice
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 import streamlit as st
-from modules.file_processing import read_file
-from langchain.docstore.document import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from modules.file_processing import iter_file_text
+from modules.rag_scoring import create_scorer, bm25_idf
+from modules.rag_fusion import fuse_results, create_reranker
+from modules.rag_cache import QueryCache
+from modules.rag_context import estimate_tokens, pack_context, context_budget
+from modules.rag_splitter import split_text_stream, batched
+from modules.rag_dedup import (
+    DuplicateDetector, content_hash, simhash, chunk_fingerprints, shingle_similarity, bytes_fingerprint,
+    file_fingerprint
+)
+from modules.rag_tokenizer import get_tokenizer
+from modules.rag_vector import VectorIndex, default_embedder
+from modules.rag_storage import (
+    PostingList, PostingTable, ChunkStore, ChunkRefs, Segment,
+    read_manifest, write_manifest, remove_stale_files, append_log, read_log, merge_segment,
+    remove_index_files, read_shard_count, write_shard_count, move_index
+)
+
+# 语料的全局统计量：文档块总数、长度之和、关键词 -> 文档频率。分片索引用它让各分片按整个语料打分
+CorpusStats = namedtuple('CorpusStats', ['total_chunks', 'total_length', 'document_frequencies'])
+
+
+def sum_corpus_stats(stats_list):
+    """多个索引的统计量之和，即它们合在一起的语料的统计量"""
+    total_chunks = total_length = 0
+    frequencies = Counter()
+    for stats in stats_list:
+        total_chunks += stats.total_chunks
+        total_length += stats.total_length
+        frequencies.update(stats.document_frequencies)
+    return CorpusStats(total_chunks, total_length, {keyword: df for keyword, df in frequencies.items() if df})
 
 class DocumentProcessor:
     """文档处理类：负责文档分块、关键词提取和索引构建"""
@@ -16,269 +53,1626 @@ class DocumentProcessor:
     def __init__(self, chunk_size=500, overlap=50):
         self.chunk_size = chunk_size  # 文档块大小
         self.overlap = overlap  # 重叠字符数
+        self.tokenizer = get_tokenizer()  # 进程内共享的分词器
         self.stop_words = self._load_stop_words()
 
     def _load_stop_words(self):
         """加载停用词列表"""
-        # 常见中文停用词
-        stop_words = {
-            '的', '了', '在', '是', '我', '有', '和', '就', '不', '人', '一', '上', '也', '很', '到', '说', '要', '去',
-            '你', '会', '着', '没有', '看', '好', '自己', '这', '那', '什么', '如果', '可以', '但是', '因为', '所以',
-            '这个', '那个', '他们', '我们', '它们', '这些', '那些', '已经', '还是', '只是', '应该', '可能', '或者',
-            '虽然', '然后', '不过', '而且', '因此', '如何', '为什么', '哪里', '什么时候', '怎么样', '比如', '例如',
-            '首先', '其次', '最后', '另外', '此外', '总之', '总的来说'
-        }
-        return stop_words
+        return self.tokenizer.stop_words
 
     def split_document(self, content, filename):
         """
-        使用 langchain 的 RecursiveCharacterTextSplitter 分割文档
+        分割整段文档内容
         :param content: 文档内容
         :param filename: 文件名
         :return: 分割后的块列表
         """
         if not content or len(content.strip()) == 0:
             return []
+        return list(self.iter_chunks([content], filename))
 
-        # 将字符串内容包装成 Document 对象
-        document = Document(page_content=content)
-
-        # 初始化 RecursiveCharacterTextSplitter
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=200,
-            chunk_overlap=100,
-            separators=["。", "！", "？", "；", "：", "\n"],  # 增加其他分隔符
-            keep_separator='end'
-        )
-
-        # 使用 langchain 的 RecursiveCharacterTextSplitter 分割内容
-        chunks = text_splitter.split_documents([document])
-
-        # 构造返回的块列表
-        result_chunks = []
-        for chunk_id, chunk in enumerate(chunks):
-            chunk_content = chunk.page_content.strip()
-            if chunk_content:
-                result_chunks.append({
-                    'chunk_id': f"{filename}_{chunk_id}",
-                    'filename': filename,
-                    'content': chunk_content,
-                    'keywords': self.extract_keywords(chunk_content)  # 假设有一个提取关键词的方法
-                })
-
-        return result_chunks
+    def iter_chunks(self, pieces, filename, skip=None):
+        """
+        流式分割文档：逐段消费文本并逐块产出，内存中只保留一个窗口的文本
+        :param pieces: 文本片段的可迭代对象，如 iter_file_text 的结果
+        :param filename: 文件名
+        :param skip: 可选的判断函数 skip(chunk_id, 正文哈希)，返回True的文档块不分词也不产出（如未变化的文档块）
+        :return: 文档块的生成器
+        """
+        for position, chunk_content in enumerate(split_text_stream(pieces, self.chunk_size, self.overlap)):
+            chunk_id = f"{filename}_{position}"
+            digest = content_hash(chunk_content)
+            if skip is not None and skip(chunk_id, digest):
+                continue
+            tokens = self.tokenize(chunk_content)
+            word_count = Counter(tokens)
+            yield {
+                'chunk_id': chunk_id,
+                'filename': filename,
+                'content': chunk_content,
+                'keywords': [word for word, count in word_count.most_common(20)],
+                'term_freqs': dict(word_count),  # 全部词项的真实词频，供BM25使用
+                'length': len(tokens),  # 文档块长度（词项数）
+                'content_hash': digest,  # 正文哈希，用于精确去重
+                'simhash': simhash(word_count),  # SimHash指纹，用于近似去重
+                'token_count': estimate_tokens(chunk_content)  # 估算的token数，用于按模型上下文预算组装提示词
+            }
 
     def extract_keywords(self, text):
-        """从文本中提取关键词"""
-        # 使用jieba分词
-        words = jieba.cut(text)
-
-        # 过滤停用词和短词
-        keywords = []
-        for word in words:
-            word = word.strip()
-            if (len(word) >= 2 and
-                    word not in self.stop_words and
-                    not word.isspace() and
-                    not word.isdigit() and
-                    re.match(r'^[a-zA-Z\u4e00-\u9fa5]+$', word)):
-                keywords.append(word)
-
-        # 统计词频并返回前20个关键词
-        word_count = Counter(keywords)
-        return [word for word, count in word_count.most_common(20)]
+        """从文本中提取关键词（词频前20个）"""
+        return self.tokenizer.extract_keywords(text)
+
+    def tokenize(self, text):
+        """分词并过滤停用词和短词，保留重复词项"""
+        return self.tokenizer.tokenize(text)
 
 
 class DocumentIndex:
-    """文档索引类：负责构建和维护关键词索引"""
+    """
+    文档索引类：负责构建和维护关键词倒排索引
+    索引持久化在 index_dir 中：一个通过mmap按需读取的二进制基础段，加上记录其后增删操作的追加日志。
+    加载时打开基础段并重放日志；日志过大时合并为新的基础段。
+    """
 
-    def __init__(self, index_file="document_index.json"):
-        self.index_file = index_file
-        self.keyword_index = defaultdict(list)  # 关键词 -> 文档块列表
-        self.document_chunks = {}  # 文档块ID -> 文档块内容
+    compact_min_log_bytes = 4 * 1024 * 1024  # 日志至少达到该大小才触发合并
+    compact_log_ratio = 0.5  # 日志超过基础段大小的该比例时触发合并
+    deduplicate = True  # 入库时是否去重
+    # SimHash汉明距离不超过该值视为近似重复并共享存储，为0时只做精确去重（默认）
+    # 近似重复的文档块只保留先入库的内容，如只改了价格的新版本文档会检索到旧版本的文本，只适合确实可以互相替代的语料
+    near_duplicate_distance = 0
+    near_duplicate_min_terms = 8  # 词项少于该数量的文档块不做近似去重（指纹不可靠）
+    near_duplicate_similarity = 0.9  # 近似重复还需满足的字符三元组Jaccard相似度
+
+    def __init__(self, index_dir="rag_index", legacy_file="document_index.json", background_compaction=True):
+        self.index_dir = index_dir  # 索引目录（清单文件 + 段文件 + 日志文件）
+        self.legacy_file = legacy_file  # 旧版JSON索引文件，存在时首次加载会自动迁移
+        self.background_compaction = background_compaction  # 自动合并是否在后台线程中执行
+        self._manifest_lock = threading.Lock()  # 保护清单文件的读改写
+        self._pending = []  # 尚未写入日志的增删操作
+        self._log_bytes = 0  # 当前日志的总字节数
+        self._compaction = None  # 正在执行的后台合并线程
+        self._compacted = False  # 后台合并已完成，内存索引尚未切换到新段
+        self.file_fingerprints = {}  # 文件名 -> {fingerprint, chunk_size, overlap}，保存在清单中
+        self._fingerprints_dirty = False
+        self._open_segment(None)
         self.load_index()
 
+    def _open_segment(self, segment):
+        """以给定的段文件（None表示空索引）重建内存中的索引结构"""
+        self.segment = segment
+        self.terms = segment.terms() if segment else []  # 词项ID -> 关键词
+        self.term_ids = {term: term_id for term_id, term in enumerate(self.terms)}  # 关键词 -> 词项ID
+        self.postings = PostingTable(segment)  # 词项ID -> 倒排列表
+        self.document_chunks = ChunkStore(segment, self.terms)  # 文档块ID -> 文档块内容
+        self.doc_lengths = segment.doc_lengths() if segment else array('i')  # 文档块整数ID -> 文档块长度（词项数）
+        self.total_length = segment.total_length if segment else 0  # 现存文档块长度之和
+        self._idf = None  # 词项ID -> BM25逆文档频率，索引变化后置空并在查询时重算
+        # 去重引用：重复的文档块只存一份，其他文件通过引用共享
+        self.chunk_refs = segment.refs(self.document_chunks.chunk_ids, self.document_chunks.filenames) \
+            if segment else ChunkRefs()
+        self._duplicates = None  # 重复检测器，首次入库时建立
+
+    @property
+    def doc_ids(self):
+        """chunk_id -> 文档块整数ID"""
+        return self.document_chunks.doc_ids
+
+    @property
+    def doc_chunk_ids(self):
+        """文档块整数ID -> chunk_id（已删除的为None）"""
+        return self.document_chunks.chunk_ids
+
+    def _term_id(self, keyword):
+        """获取关键词的词项ID，不存在时分配新ID"""
+        term_id = self.term_ids.get(keyword)
+        if term_id is None:
+            term_id = len(self.terms)
+            self.term_ids[keyword] = term_id
+            self.terms.append(keyword)
+            self.postings.append(PostingList())
+        return term_id
+
+    def _remove_docs(self, doc_ids):
+        """
+        从倒排列表和文档块存储中移除一批文档块，只改写这些文档块包含的词项的倒排列表
+        仍被其他文件引用的文档块转交给第一个引用者（以引用者的chunk_id重新加入）
+        :return: 转交记录 [(原chunk_id, 新chunk_id, 新文件名)]
+        """
+        if not doc_ids:
+            return []
+        transferred = []
+        for doc_id in doc_ids:
+            transfer = self.chunk_refs.detach(self.doc_chunk_ids[doc_id])
+            if transfer:
+                new_id, new_filename = transfer
+                chunk = self.document_chunks.chunk(doc_id)
+                chunk['chunk_id'], chunk['filename'] = new_id, new_filename
+                transferred.append((self.doc_chunk_ids[doc_id], chunk))
+
+        affected_terms = set()
+        for doc_id in doc_ids:
+            affected_terms.update(self.document_chunks.term_ids(doc_id))
+        for term_id in affected_terms:
+            self.postings[term_id].remove(doc_ids)
+        for doc_id in doc_ids:
+            self.document_chunks.remove(doc_id)
+            self.total_length -= self.doc_lengths[doc_id]
+            self.doc_lengths[doc_id] = 0
+            if self._duplicates is not None:
+                self._duplicates.remove(doc_id)
+        self._idf = None
+
+        self._apply_add([chunk for old_id, chunk in transferred])
+        return [(old_id, chunk['chunk_id'], chunk['filename']) for old_id, chunk in transferred]
+
+    def _duplicate_detector(self):
+        """重复检测器，第一次入库时为现存文档块建立"""
+        if self._duplicates is None:
+            detector = DuplicateDetector(self.near_duplicate_distance)
+            for doc_id in self.document_chunks.live_doc_ids():
+                detector.add(doc_id, *self.document_chunks.fingerprints(doc_id))
+            self._duplicates = detector
+        return self._duplicates
+
+    def _find_duplicate(self, chunk, detector):
+        """查找与文档块内容相同（开启近似去重时也包括近似）的现存文档块，返回其文档ID"""
+        digest, fingerprint = chunk_fingerprints(chunk)
+        doc_id = detector.find_exact(digest)
+        if doc_id is not None:
+            return doc_id
+        if not self.near_duplicate_distance or \
+                len(chunk.get('term_freqs') or chunk['keywords']) < self.near_duplicate_min_terms:
+            return None
+        for candidate in detector.near_candidates(fingerprint):
+            candidate_content = self.document_chunks.content(candidate)
+            if shingle_similarity(chunk['content'], candidate_content) >= self.near_duplicate_similarity:
+                return candidate
+        return None
+
     def add_document_chunks(self, chunks):
-        """添加文档块到索引"""
+        """
+        添加文档块到索引（调用save_index后写入日志）
+        与现存文档块内容相同的块不再存储，只记录对已有文档块的引用（近似重复见 near_duplicate_distance）
+        :return: 实际存储的文档块列表
+        """
+        stored = []
+        refs = {}  # 文件名 -> {本文件的chunk_id: 被引用的chunk_id}
+        detector = self._duplicate_detector() if self.deduplicate else None
+        for chunk in chunks:
+            # 覆盖同ID文档块时按原样存储
+            if detector is not None and chunk['chunk_id'] not in self.doc_ids:
+                doc_id = self._find_duplicate(chunk, detector)
+                if doc_id is not None:
+                    refs.setdefault(chunk['filename'], {})[chunk['chunk_id']] = self.doc_chunk_ids[doc_id]
+                    continue
+            self._apply_add([chunk])
+            stored.append(chunk)
+
+        if stored:
+            self._pending.append({'op': 'add', 'chunks': stored})
+        for filename, file_refs in refs.items():
+            self.chunk_refs.add(filename, file_refs)
+            self._pending.append({'op': 'ref', 'filename': filename, 'refs': file_refs})
+        return stored
+
+    def _apply_add(self, chunks):
+        """将文档块加入内存索引"""
         for chunk in chunks:
             chunk_id = chunk['chunk_id']
-            self.document_chunks[chunk_id] = chunk
-
-            # 为每个关键词建立索引
-            for keyword in chunk['keywords']:
-                if chunk_id not in [item['chunk_id'] for item in self.keyword_index[keyword]]:
-                    self.keyword_index[keyword].append({
-                        'chunk_id': chunk_id,
-                        'filename': chunk['filename'],
-                        'relevance': chunk['keywords'].count(keyword)  # 关键词在该块中的频次
-                    })
-
-    def search_by_keywords(self, query, top_k=5):
-        """基于关键词搜索相关文档块"""
-        # 提取查询关键词
-        processor = DocumentProcessor()
-        query_keywords = processor.extract_keywords(query)
-
-        if not query_keywords:
-            return []
+            if chunk_id in self.doc_ids:
+                # 同ID的文档块被覆盖，先移除旧的倒排记录
+                self._remove_docs({self.doc_ids[chunk_id]})
+
+            # 旧索引中的文档块没有完整词频，退化为关键词列表
+            term_freqs = chunk.get('term_freqs') or Counter(chunk['keywords'])
+            length = chunk.get('length') or sum(term_freqs.values())
+            # 正排列表按词频降序（同频保持首次出现顺序），与段文件一致
+            forward = [(self._term_id(keyword), freq)
+                       for keyword, freq in sorted(term_freqs.items(), key=lambda item: -item[1])]
+
+            doc_id = self.document_chunks.add(chunk, forward)
+            self.doc_lengths.append(length)
+            self.total_length += length
+            if self._duplicates is not None:
+                self._duplicates.add(doc_id, *self.document_chunks.fingerprints(doc_id))
+
+            # 为每个词项建立索引，词频为词项在该块中的频次
+            for term_id, freq in forward:
+                self.postings[term_id].add(doc_id, freq)
+        self._idf = None
+
+    def vocabulary_size(self):
+        """当前仍有文档块引用的关键词数量"""
+        return sum(1 for term_id in range(len(self.postings)) if self.postings.document_frequency(term_id))
+
+    def live_keywords(self):
+        """当前仍有文档块引用的关键词"""
+        return (term for term_id, term in enumerate(self.terms) if self.postings.document_frequency(term_id))
+
+    def sample_keywords(self, limit=10):
+        """前 limit 个现存关键词，用于调试展示"""
+        return list(islice(self.live_keywords(), limit))
+
+    def document_frequency(self, term_id):
+        return self.postings.document_frequency(term_id)
+
+    def get_chunk(self, chunk_id, term_freqs=True):
+        """按chunk_id解码文档块，不存在（或只是去重引用）时返回None"""
+        doc_id = self.doc_ids.get(chunk_id)
+        if doc_id is None:
+            return None
+        return self.document_chunks.chunk(doc_id, term_freqs=term_freqs)
+
+    def has_chunk(self, chunk_id):
+        return chunk_id in self.doc_ids
+
+    def live_chunk_ids(self):
+        """现存（实际存储的）文档块的chunk_id列表"""
+        return list(self.doc_ids)
+
+    def export_chunks(self):
+        """
+        导出全部文档块，用于迁移到新的索引布局
+        先导出实际存储的文档块，再把去重引用以引用者的chunk_id和文件名导出，重新入库时会再次去重
+        """
+        for doc_id in self.document_chunks.live_doc_ids():
+            yield self.document_chunks.chunk(doc_id)
+        for filename, local_id, target_id in list(self.chunk_refs.items()):
+            chunk = self.document_chunks.chunk(self.doc_ids[target_id])
+            chunk['chunk_id'], chunk['filename'] = local_id, filename
+            yield chunk
+
+    def file_counts(self):
+        """每个文件的文档块数量（包括去重后引用的文档块）"""
+        counts = self.document_chunks.file_counts()
+        for filename, count in self.chunk_refs.file_counts().items():
+            counts[filename] = counts.get(filename, 0) + count
+        return counts
+
+    def dedup_stats(self):
+        """去重统计：被引用而未重复存储的文档块数量及节省的正文字节数"""
+        saved_bytes = 0
+        for filename, local_id, target_id in self.chunk_refs.items():
+            doc_id = self.doc_ids.get(target_id)
+            if doc_id is not None:
+                saved_bytes += self.document_chunks.content_bytes(doc_id)
+        return {'duplicate_chunks': len(self.chunk_refs), 'saved_bytes': saved_bytes}
+
+    def live_chunk_count(self):
+        """现存文档块数量"""
+        return len(self.document_chunks)
+
+    def average_chunk_length(self):
+        """现存文档块的平均长度"""
+        total_chunks = self.live_chunk_count()
+        return self.total_length / total_chunks if total_chunks else 0.0
+
+    def idf_table(self):
+        """按词项ID预计算的BM25逆文档频率表，索引变化后首次查询时重建"""
+        if self._idf is None:
+            total_chunks = self.live_chunk_count()
+            self._idf = array('d', (bm25_idf(total_chunks, self.postings.document_frequency(term_id))
+                                    for term_id in range(len(self.postings))))
+        return self._idf
+
+    def keyword_idf(self, keywords):
+        """关键词 -> BM25逆文档频率，索引中不存在的关键词不返回"""
+        idf_table = self.idf_table()
+        return {keyword: idf_table[self.term_ids[keyword]] for keyword in keywords if keyword in self.term_ids}
+
+    def corpus_stats(self, keywords):
+        """本索引的统计量（见 CorpusStats），分片索引把各分片的结果相加得到全局统计量"""
+        return CorpusStats(
+            self.live_chunk_count(),
+            self.total_length,
+            {keyword: self.postings.document_frequency(self.term_ids[keyword])
+             for keyword in keywords if keyword in self.term_ids}
+        )
 
-        # 计算每个文档块的相关性得分
-        chunk_scores = defaultdict(float)
+    def search_by_keywords(self, query, top_k=5, engine="bm25"):
+        """
+        基于关键词搜索相关文档块
+        :param query: 查询文本
+        :param top_k: 返回的文档块数量
+        :param engine: 打分引擎，支持"bm25"、"bm25+"和"tfidf"
+        :return: 按相关性降序排列的文档块列表
+        """
+        # 提取查询关键词（共享分词器带LRU缓存，重复查询不再分词）
+        return self.search_keywords(get_tokenizer().query_keywords(query), top_k, engine)
 
-        for keyword in query_keywords:
-            if keyword in self.keyword_index:
-                for item in self.keyword_index[keyword]:
-                    chunk_id = item['chunk_id']
-                    # 简单的TF-IDF近似：词频 * 逆文档频率
-                    tf = item['relevance']
-                    idf = len(self.document_chunks) / len(self.keyword_index[keyword])
-                    chunk_scores[chunk_id] += tf * idf
+    def search_keywords(self, keywords, top_k=5, engine="bm25", stats=None):
+        """
+        按已提取的关键词检索
+        :param stats: 全局统计量（CorpusStats），为空时使用本索引自身的统计量
+        :return: 按相关性降序排列的文档块列表
+        """
+        term_ids = [self.term_ids[keyword] for keyword in keywords if keyword in self.term_ids]
+        if not term_ids:
+            return []
 
-        # 按得分排序并返回top_k个结果
-        sorted_chunks = sorted(chunk_scores.items(), key=lambda x: x[1], reverse=True)
+        # 计算每个文档块的相关性得分，并用堆选出top_k个结果
+        scorer = create_scorer(engine)
+        top_chunks = scorer.top_k(self if stats is None else GlobalStatsView(self, stats), term_ids, top_k)
 
         results = []
-        for chunk_id, score in sorted_chunks[:top_k]:
-            if chunk_id in self.document_chunks:
-                chunk = self.document_chunks[chunk_id].copy()
+        for doc_id, score in top_chunks:
+            if self.doc_chunk_ids[doc_id] is not None:
+                # 只为最终的top_k个结果解码文档块内容
+                chunk = self.document_chunks.chunk(doc_id, term_freqs=False)
                 chunk['relevance_score'] = score
                 results.append(chunk)
 
         return results
 
-    def save_index(self):
-        """保存索引到文件"""
-        index_data = {
-            'keyword_index': dict(self.keyword_index),
-            'document_chunks': self.document_chunks,
-            'last_updated': datetime.now().isoformat()
-        }
+    def _ensure_manifest(self):
+        """首次写入时创建索引目录和清单，返回当前清单"""
+        manifest = read_manifest(self.index_dir)
+        if manifest is None:
+            os.makedirs(self.index_dir, exist_ok=True)
+            manifest = {'generation': 1, 'segment': None, 'logs': []}
+        if not manifest.get('logs'):
+            manifest['logs'] = [f"log_{manifest['generation']:06d}.log"]
+            write_manifest(self.index_dir, manifest)
+        return manifest
+
+    def _flush_pending(self):
+        """把尚未持久化的增删操作追加到当前日志，再更新清单中的文件指纹（顺序保证指纹不会先于内容落盘）"""
+        if not self._pending and not self._fingerprints_dirty:
+            return
+        with self._manifest_lock:
+            manifest = self._ensure_manifest()
+            if self._pending:
+                log_path = os.path.join(self.index_dir, manifest['logs'][-1])
+                self._log_bytes += append_log(log_path, self._pending)
+            if self._fingerprints_dirty:
+                manifest['files'] = self.file_fingerprints
+                write_manifest(self.index_dir, manifest)
+        self._pending = []
+        self._fingerprints_dirty = False
+
+    def _compaction_threshold(self):
+        """触发合并的日志大小阈值"""
+        segment_bytes = self.segment.size if self.segment else 0
+        return max(self.compact_min_log_bytes, segment_bytes * self.compact_log_ratio)
 
-        with open(self.index_file, 'w', encoding='utf-8') as f:
-            json.dump(index_data, f, ensure_ascii=False, indent=2)
-
-    def load_index(self):
-        """从文件加载索引"""
-        if os.path.exists(self.index_file):
+    def save_index(self):
+        """持久化索引：只把新增的增删操作追加到日志，日志过大时触发合并"""
+        self._flush_pending()
+        if self._compacted:
+            self._reload()
+        if self._log_bytes > self._compaction_threshold():
+            self.compact(background=self.background_compaction)
+
+    def compact(self, background=False):
+        """
+        将基础段与日志合并为新的基础段
+        合并开始时写入切换到新日志，因此后台合并期间可以继续增删文档
+        :param background: 是否在后台线程中执行
+        """
+        if self._compaction and self._compaction.is_alive():
+            return
+        self._flush_pending()
+
+        with self._manifest_lock:
+            manifest = self._ensure_manifest()
+            generation = manifest['generation'] + 1
+            merged_logs = list(manifest['logs'])
+            base_segment = manifest.get('segment')
+            manifest['generation'] = generation
+            manifest['logs'] = merged_logs + [f"log_{generation:06d}.log"]
+            write_manifest(self.index_dir, manifest)
+            self._log_bytes = 0
+
+        def run():
+            segment_name = f"segment_{generation:06d}.seg"
             try:
-                with open(self.index_file, 'r', encoding='utf-8') as f:
-                    index_data = json.load(f)
-                    self.keyword_index = defaultdict(list, index_data.get('keyword_index', {}))
-                    self.document_chunks = index_data.get('document_chunks', {})
+                merge_segment(
+                    os.path.join(self.index_dir, base_segment) if base_segment else None,
+                    [os.path.join(self.index_dir, log) for log in merged_logs],
+                    os.path.join(self.index_dir, segment_name)
+                )
+                with self._manifest_lock:
+                    current = read_manifest(self.index_dir)
+                    current['segment'] = segment_name
+                    current['logs'] = [log for log in current['logs'] if log not in merged_logs]
+                    write_manifest(self.index_dir, current)
+                    remove_stale_files(self.index_dir, current)
+                self._compacted = True
             except Exception as e:
-                print(f"加载索引失败: {e}")
-                self.keyword_index = defaultdict(list)
-                self.document_chunks = {}
+                # 清单仍指向旧段和全部日志，索引保持一致，下次再合并
+                print(f"索引合并失败: {e}")
+
+        if background:
+            self._compaction = threading.Thread(target=run, name="rag-index-compaction", daemon=True)
+            self._compaction.start()
+        else:
+            run()
+            if self._compacted:
+                self._reload()
+
+    def _reload(self):
+        """按清单重新打开基础段并重放日志，用于切换到合并后的新段以释放内存"""
+        self._compacted = False
+        old_segment = self.segment
+        self._open_manifest(read_manifest(self.index_dir))
+        if old_segment:
+            old_segment.close()
+
+    def _open_manifest(self, manifest):
+        """打开清单中的基础段并按顺序重放日志"""
+        self.file_fingerprints = dict(manifest.get('files', {}))
+        segment_name = manifest.get('segment')
+        self._open_segment(Segment(os.path.join(self.index_dir, segment_name)) if segment_name else None)
+        self._log_bytes = 0
+        for log in manifest.get('logs', []):
+            log_path = os.path.join(self.index_dir, log)
+            for record in read_log(log_path):
+                if record['op'] == 'add':
+                    self._apply_add(record['chunks'])
+                elif record['op'] == 'ref':
+                    self.chunk_refs.add(record['filename'], record['refs'])
+                elif record['op'] == 'delete':
+                    self._apply_delete(record['filename'])
+                elif record['op'] == 'remove':
+                    self._apply_remove(record['filename'], record['chunk_ids'])
+            if os.path.exists(log_path):
+                self._log_bytes += os.path.getsize(log_path)
+
+    def load_index(self):
+        """从索引目录加载索引；只有旧版JSON文件时执行一次性迁移"""
+        try:
+            manifest = read_manifest(self.index_dir)
+            if manifest:
+                self._open_manifest(manifest)
+            elif self.legacy_file and os.path.exists(self.legacy_file):
+                migrate_json_index(self.legacy_file, self)
+        except Exception as e:
+            print(f"加载索引失败: {e}")
+            self._open_segment(None)
+
+    def load_json_index(self, json_file):
+        """从旧版JSON索引文件加载文档块（忽略其中的keyword_index，由文档块重建倒排索引）"""
+        with open(json_file, 'r', encoding='utf-8') as f:
+            index_data = json.load(f)
+        self.add_document_chunks(index_data.get('document_chunks', {}).values())
+
+    def close(self):
+        """等待后台合并结束并关闭段文件"""
+        if self._compaction and self._compaction.is_alive():
+            self._compaction.join()
+        if self.segment:
+            self.segment.close()
 
     def delete_document(self, filename):
-        """删除指定文件的所有文档块"""
-        # 找到要删除的chunk_ids
-        chunks_to_delete = [chunk_id for chunk_id, chunk in self.document_chunks.items()
-                            if chunk['filename'] == filename]
+        """
+        删除指定文件的所有文档块（调用save_index后写入日志）
+        :return: 因仍被其他文件引用而转交的文档块 [(原chunk_id, 新chunk_id, 新文件名)]
+        """
+        transfers = self._apply_delete(filename)
+        self._pending.append({'op': 'delete', 'filename': filename})
+        if self.file_fingerprints.pop(filename, None) is not None:
+            self._fingerprints_dirty = True
+        return transfers
+
+    def remove_chunks(self, filename, chunk_ids):
+        """
+        删除文件中的部分文档块（包括去重引用），用于文件内容变化后只替换变化的文档块
+        :return: 转交记录 [(原chunk_id, 新chunk_id, 新文件名)]
+        """
+        chunk_ids = list(chunk_ids)
+        transfers = self._apply_remove(filename, chunk_ids)
+        self._pending.append({'op': 'remove', 'filename': filename, 'chunk_ids': chunk_ids})
+        return transfers
+
+    def _apply_remove(self, filename, chunk_ids):
+        self.chunk_refs.drop_file(filename, chunk_ids)
+        docs_to_delete = {self.doc_ids[chunk_id] for chunk_id in chunk_ids
+                          if chunk_id in self.doc_ids and self.document_chunks.filename(self.doc_ids[chunk_id]) == filename}
+        return self._remove_docs(docs_to_delete)
+
+    def set_file_fingerprint(self, filename, fingerprint, chunk_size, overlap):
+        """记录文件内容指纹及分块参数（调用save_index后写入清单）"""
+        self.file_fingerprints[filename] = {'fingerprint': fingerprint, 'chunk_size': chunk_size, 'overlap': overlap}
+        self._fingerprints_dirty = True
+
+    def has_file(self, filename):
+        return bool(self.document_chunks.file_doc_ids(filename)) or filename in self.chunk_refs.file_refs
+
+    def file_chunk_hashes(self, filename):
+        """文件的 chunk_id -> 正文哈希（包括去重引用的文档块）"""
+        hashes = {}
+        for doc_id in self.document_chunks.file_doc_ids(filename):
+            hashes[self.doc_chunk_ids[doc_id]] = self.document_chunks.fingerprints(doc_id)[0]
+        for local_id, target_id in self.chunk_refs.file_refs.get(filename, {}).items():
+            hashes[local_id] = self.document_chunks.fingerprints(self.doc_ids[target_id])[0]
+        return hashes
+
+    def _apply_delete(self, filename):
+        """从内存索引中删除指定文件的所有文档块及其引用"""
+        self.chunk_refs.drop_file(filename)
+
+        # 通过文件 -> 文档块的反向映射找到要删除的文档块
+        docs_to_delete = set(self.document_chunks.file_doc_ids(filename))
+
+        # 从倒排索引和文档块存储中删除
+        return self._remove_docs(docs_to_delete)
+
+
+class GlobalStatsView:
+    """
+    分片的打分视图：倒排列表和文档长度来自分片，文档块总数、平均长度和IDF来自全局统计量，
+    使各分片的得分可以直接比较和合并
+    """
 
-        # 从document_chunks中删除
-        for chunk_id in chunks_to_delete:
-            del self.document_chunks[chunk_id]
+    def __init__(self, shard, stats):
+        self.postings = shard.postings
+        self.doc_lengths = shard.doc_lengths
+        self.stats = stats
+        self._frequencies = {shard.term_ids[keyword]: frequency
+                             for keyword, frequency in stats.document_frequencies.items() if keyword in shard.term_ids}
+        self._idf = {term_id: bm25_idf(stats.total_chunks, frequency) for term_id, frequency in self._frequencies.items()}
 
-        # 从keyword_index中删除
-        for keyword in list(self.keyword_index.keys()):
-            self.keyword_index[keyword] = [item for item in self.keyword_index[keyword]
-                                           if item['chunk_id'] not in chunks_to_delete]
-            # 如果某个关键词没有对应的文档块了，删除该关键词
-            if not self.keyword_index[keyword]:
-                del self.keyword_index[keyword]
+    def live_chunk_count(self):
+        return self.stats.total_chunks
 
+    def average_chunk_length(self):
+        return self.stats.total_length / self.stats.total_chunks if self.stats.total_chunks else 0.0
+
+    def document_frequency(self, term_id):
+        return self._frequencies[term_id]
+
+    def idf_table(self):
+        return self._idf
+
+
+class ShardedIndex:
+    """
+    分片索引：文档块按文件名哈希分到N个 DocumentIndex，每个分片有独立的段文件、日志和后台合并
+    查询时各分片在线程池中并行检索，打分使用全局统计量（总块数、平均长度、文档频率），各分片的top_k合并即为全局top_k
+    去重只在分片内进行；同一文件的文档块总在同一分片中
+    """
+
+    def __init__(self, index_dir, shard_count):
+        """
+        :param index_dir: 分片所在目录，每个分片一个子目录
+        :param shard_count: 分片数
+        """
+        self.index_dir = index_dir
+        self.shards = [DocumentIndex(os.path.join(index_dir, f"shard_{i:03d}"), legacy_file=None)
+                       for i in range(shard_count)]
+        self._pool = ThreadPoolExecutor(max_workers=shard_count, thread_name_prefix="rag-shard")
+
+    @property
+    def shard_count(self):
+        return len(self.shards)
+
+    def shard_number(self, filename):
+        """文件所在分片的编号（与进程无关的稳定哈希）"""
+        digest = hashlib.blake2b(filename.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') % len(self.shards)
+
+    def shard_for(self, filename):
+        return self.shards[self.shard_number(filename)]
+
+    @property
+    def file_fingerprints(self):
+        """文件名 -> 内容指纹记录（各分片的只读合并视图）"""
+        return ChainMap(*(shard.file_fingerprints for shard in self.shards))
+
+    def corpus_stats(self, keywords):
+        """全局统计量：各分片统计量之和"""
+        return sum_corpus_stats(shard.corpus_stats(keywords) for shard in self.shards)
+
+    def search_by_keywords(self, query, top_k=5, engine="bm25"):
+        """分散到各分片并行检索，按全局统计量打分后合并各分片的top_k"""
+        return self.search_keywords(get_tokenizer().query_keywords(query), top_k, engine)
+
+    def search_keywords(self, keywords, top_k=5, engine="bm25", stats=None):
+        """
+        按已提取的关键词检索
+        :param stats: 全局统计量（CorpusStats），为空时使用各分片合计的统计量
+        """
+        if stats is None:
+            stats = self.corpus_stats(keywords)
+        if not stats.document_frequencies:
+            return []
+        results = self._pool.map(lambda shard: shard.search_keywords(keywords, top_k, engine, stats), self.shards)
+        return heapq.nlargest(top_k, chain.from_iterable(results), key=itemgetter('relevance_score'))
+
+    def keyword_idf(self, keywords):
+        stats = self.corpus_stats(keywords)
+        return {keyword: bm25_idf(stats.total_chunks, frequency)
+                for keyword, frequency in stats.document_frequencies.items()}
+
+    def add_document_chunks(self, chunks):
+        """按文件名把文档块分发到各分片，返回实际存储的文档块"""
+        groups = {}
+        for chunk in chunks:
+            groups.setdefault(self.shard_number(chunk['filename']), []).append(chunk)
+        stored = []
+        for number, group in groups.items():
+            stored.extend(self.shards[number].add_document_chunks(group))
+        return stored
+
+    def delete_document(self, filename):
+        return self.shard_for(filename).delete_document(filename)
+
+    def remove_chunks(self, filename, chunk_ids):
+        return self.shard_for(filename).remove_chunks(filename, chunk_ids)
+
+    def set_file_fingerprint(self, filename, fingerprint, chunk_size, overlap):
+        self.shard_for(filename).set_file_fingerprint(filename, fingerprint, chunk_size, overlap)
+
+    def has_file(self, filename):
+        return self.shard_for(filename).has_file(filename)
+
+    def file_chunk_hashes(self, filename):
+        return self.shard_for(filename).file_chunk_hashes(filename)
+
+    def get_chunk(self, chunk_id, term_freqs=True):
+        for shard in self.shards:
+            chunk = shard.get_chunk(chunk_id, term_freqs)
+            if chunk is not None:
+                return chunk
+        return None
+
+    def has_chunk(self, chunk_id):
+        return any(shard.has_chunk(chunk_id) for shard in self.shards)
+
+    def live_chunk_ids(self):
+        return [chunk_id for shard in self.shards for chunk_id in shard.live_chunk_ids()]
+
+    def live_chunk_count(self):
+        return sum(shard.live_chunk_count() for shard in self.shards)
+
+    def vocabulary_size(self):
+        return len(set(chain.from_iterable(shard.live_keywords() for shard in self.shards)))
+
+    def sample_keywords(self, limit=10):
+        return list(islice(dict.fromkeys(chain.from_iterable(shard.live_keywords() for shard in self.shards)), limit))
+
+    def file_counts(self):
+        counts = {}
+        for shard in self.shards:
+            counts.update(shard.file_counts())
+        return counts
+
+    def dedup_stats(self):
+        totals = Counter()
+        for shard in self.shards:
+            totals.update(shard.dedup_stats())
+        return {'duplicate_chunks': totals['duplicate_chunks'], 'saved_bytes': totals['saved_bytes']}
+
+    def export_chunks(self):
+        return chain.from_iterable(shard.export_chunks() for shard in self.shards)
+
+    def save_index(self):
+        for shard in self.shards:
+            shard.save_index()
+
+    def compact(self, background=False):
+        for shard in self.shards:
+            shard.compact(background=background)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self._pool.shutdown(wait=False)
+
+
+def _shard_dir(index_dir, shard_count):
+    """分片布局所在目录：单一索引直接使用索引目录（与未分片时的布局兼容），否则为 shards_N 子目录"""
+    return index_dir if shard_count == 1 else os.path.join(index_dir, f"shards_{shard_count}")
+
+
+def _open_layout(index_dir, shard_count, legacy_file="document_index.json"):
+    if shard_count == 1:
+        return DocumentIndex(index_dir, legacy_file=legacy_file)
+    return ShardedIndex(_shard_dir(index_dir, shard_count), shard_count)
+
+
+def open_index(index_dir, shard_count=None, legacy_file="document_index.json"):
+    """
+    打开索引目录，分片数与已有布局不同时先迁移
+    :param index_dir: 索引目录
+    :param shard_count: 分片数，为空时沿用已有布局（新目录为单一索引）
+    :param legacy_file: 旧版JSON索引文件，单一索引首次加载时迁移，为None时不迁移
+    :return: DocumentIndex 或 ShardedIndex
+    """
+    current = read_shard_count(index_dir)
+    index = _open_layout(index_dir, current, legacy_file=legacy_file)
+    if shard_count is not None and shard_count != current:
+        index = reshard_index(index, index_dir, shard_count)
+    return index
+
+
+def reshard_index(index, index_dir, shard_count, batch_size=1000):
+    """
+    把索引中的全部文档块和文件指纹复制到新的分片布局，记录新分片数后删除旧布局
+    复制完成之前旧布局保持有效，中途失败不影响原索引
+    :return: 新布局的索引
+    """
+    if shard_count < 1:
+        raise ValueError("分片数必须大于0")
+    old_count = read_shard_count(index_dir)
+    index.save_index()
+    target_dir = _shard_dir(index_dir, shard_count)
+    if shard_count == 1:
+        # 之前的迁移中途失败时根目录可能残留未启用的文件
+        remove_index_files(index_dir)
+    elif os.path.exists(target_dir):
+        shutil.rmtree(target_dir)
+
+    target = _open_layout(index_dir, shard_count, legacy_file=None)
+    for batch in batched(index.export_chunks(), batch_size):
+        target.add_document_chunks(batch)
+    for filename, record in dict(index.file_fingerprints).items():
+        target.set_file_fingerprint(filename, record['fingerprint'], record['chunk_size'], record['overlap'])
+    target.save_index()
+    target.compact()
+
+    write_shard_count(index_dir, shard_count)
+    index.close()
+    if old_count == 1:
+        remove_index_files(index_dir)
+    else:
+        shutil.rmtree(_shard_dir(index_dir, old_count), ignore_errors=True)
+    return target
+
+
+def migrate_json_index(json_file, index):
+    """
+    将旧版 document_index.json 一次性迁移为二进制段格式
+    迁移完成后原文件重命名为 .bak，避免重复迁移
+    :param json_file: 旧版JSON索引文件路径
+    :param index: 目标 DocumentIndex 实例
+    """
+    index.load_json_index(json_file)
+    index.compact()
+    os.replace(json_file, json_file + ".bak")
+    print(f"已将 {json_file} 迁移到 {index.index_dir}")
 
-class RAGSystem:
-    """RAG系统主类：整合文档处理、索引和检索功能"""
+
+class ReadWriteLock:
+    """读写锁：多个读者可以并发，写者独占；有写者等待时新读者排队，避免写者饥饿"""
 
     def __init__(self):
-        self.processor = DocumentProcessor()
-        self.index = DocumentIndex()
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class UploadedBytes(io.BytesIO):
+    """与 Streamlit 的 UploadedFile 接口一致的内存文件，用于在进程间传递文件内容"""
+
+    def __init__(self, data, name, type):
+        super().__init__(data)
+        self.name = name
+        self.type = type
+
+
+def split_file_payload(payload):
+    """
+    进程池工作函数：解析并分割单个文件
+    :param payload: (文件名, MIME类型, 文件字节, 文档块大小, 重叠字符数)
+    :return: (文件名, 文档块列表或None, 错误信息或None)
+    """
+    filename, file_type, data, chunk_size, overlap = payload
+    processor = DocumentProcessor(chunk_size, overlap)
+    try:
+        chunks = list(processor.iter_chunks(iter_file_text(UploadedBytes(data, filename, file_type)), filename))
+    except Exception as e:
+        return filename, None, f"读取文件失败：{e}"
+    if not chunks:
+        return filename, None, "无法读取文件内容"
+    return filename, chunks, None
 
-    def add_document(self, file_obj, filename=None):
-        """添加文档到RAG系统"""
-        if filename is None:
-            filename = getattr(file_obj, 'name', 'unknown_file')
 
-        # 读取文件内容
-        content = read_file(file_obj)
-        if not content:
-            return False, "无法读取文件内容"
+def create_ingest_pool(max_workers=None):
+    """创建文档解析进程池；使用spawn方式，避免在多线程的Streamlit进程中fork"""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
 
-        # 删除同名文件的旧索引（如果存在）
-        self.index.delete_document(filename)
 
-        # 分割文档
-        chunks = self.processor.split_document(content, filename)
-        if not chunks:
-            return False, "文档分割失败"
+@contextmanager
+def stage_timer(timings, stage):
+    """把代码块的耗时（毫秒）记录到 timings[stage]"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = (time.perf_counter() - started) * 1000
 
-        # 添加到索引
-        self.index.add_document_chunks(chunks)
 
-        # 保存索引
-        self.index.save_index()
+def _block_source(block):
+    """片段标题中的来源：文件名，文档块带集合信息时附上集合名"""
+    if block.get('collection'):
+        return f"{block['filename']}，集合: {block['collection']}"
+    return block['filename']
 
-        return True, f"成功处理文档 {filename}，分割成 {len(chunks)} 个文档块"
 
-    def search_documents(self, query, top_k=3):
-        """搜索相关文档"""
-        return self.index.search_by_keywords(query, top_k)
+class RAGSystem:
+    """
+    RAG系统主类：整合文档处理、索引和检索功能
+    同一进程内的所有会话共享一个实例（见 get_shared_rag_system），检索持读锁，增删文档持写锁
+    """
 
-    def generate_rag_prompt(self, query, context_chunks):
-        """生成包含上下文的提示词"""
-        if not context_chunks:
-            return query
+    RETRIEVERS = ("keyword", "vector", "hybrid")
+    ingest_batch_size = 500  # 流式导入时每批写入索引的文档块数
+    hybrid_candidates = 4  # 混合检索时每一路召回 top_k 的倍数
+    rerank_top_n = 20  # 参与重排序的融合结果数量
 
-        context_text = "\n\n".join([
-            f"文档片段 {i + 1} (来源: {chunk['filename']}):\n{chunk['content']}"
-            for i, chunk in enumerate(context_chunks)
-        ])
+    def __init__(self, engine="bm25", index_dir="rag_index", embedder=None, shards=None,
+                 legacy_file="document_index.json"):
+        """
+        :param engine: 默认的关键词打分引擎
+        :param index_dir: 索引目录
+        :param embedder: 向量化实例（见 modules.rag_vector），为空时不启用向量检索
+        :param shards: 索引分片数，为空时沿用索引目录已有的布局；与已有布局不同时自动迁移
+        :param legacy_file: 旧版JSON索引文件，索引目录为空时迁移，为None时不迁移
+        """
+        self.processor = DocumentProcessor()
+        self.index_dir = index_dir
+        self.index = open_index(index_dir, shards, legacy_file=legacy_file)
+        self.engine = engine  # 默认检索打分引擎
+        self.embedder = embedder
+        self.vector_index = VectorIndex(os.path.join(index_dir, "vectors"), embedder) if embedder else None
+        self.reranker = create_reranker()
+        self.lock = ReadWriteLock()
+        self.generation = 0  # 索引代数，每次增删文档后加一，使检索缓存失效
+        self.query_cache = QueryCache()
+        self._search_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-search")  # 混合检索的并发召回
+        # 后台预加载jieba词典，第一次查询无需等待
+        self.processor.tokenizer.warm_up(background=True)
+
+    def _processor(self, chunk_size=None, overlap=None):
+        """按会话的分块参数获取文档处理器，参数与默认值相同时复用共享实例"""
+        chunk_size = chunk_size or self.processor.chunk_size
+        overlap = self.processor.overlap if overlap is None else overlap
+        if (chunk_size, overlap) == (self.processor.chunk_size, self.processor.overlap):
+            return self.processor
+        return DocumentProcessor(chunk_size, overlap)
+
+    def _previous_version(self, filename, fingerprint, processor):
+        """
+        对比文件指纹，判断文件相对已入库版本的变化
+        :return: (内容是否未变化, 旧版本的 chunk_id -> 正文哈希)；分块参数变化或没有旧版本时旧文档块不可复用，返回空字典
+        """
+        record = self.index.file_fingerprints.get(filename)
+        if record is None or not self.index.has_file(filename):
+            return False, {}
+        if (record['chunk_size'], record['overlap']) != (processor.chunk_size, processor.overlap):
+            return False, {}
+        if record['fingerprint'] == fingerprint:
+            return True, {}
+        return False, self.index.file_chunk_hashes(filename)
+
+    def add_document(self, file_obj, filename=None, chunk_size=None, overlap=None, progress=None):
+        """
+        添加文档到RAG系统
+        文件按片段流式读取和分块，每 ingest_batch_size 个文档块写入一次索引，大文件也只占用有限内存。
+        内容指纹与已入库版本相同时直接跳过；内容变化时只替换同位置正文不同的文档块。
+        替换已入库的文件时，有变化的文档块先暂存在内存中，全部读取成功后在一次写锁内替换，
+        读取失败时旧版本保持不变；新文件仍按批写入，失败时删除已写入的部分。
+        :param file_obj: 文件对象，需提供 type 和 read()/seek()/tell()
+        :param filename: 文件名，为空时使用 file_obj.name
+        :param chunk_size: 文档块大小，为空时使用默认值
+        :param overlap: 相邻文档块重叠字符数，为空时使用默认值
+        :param progress: 进度回调 progress(已读取字节数, 已写入索引的文档块数)，每写入一批文档块调用一次；
+                         PDF、Office等格式的解析库会前后跳读文件，已读取字节数只是近似值
+        :return: (是否成功, 消息)
+        """
+        if filename is None:
+            filename = getattr(file_obj, 'name', 'unknown_file')
 
-        rag_prompt = f"""请基于以下文档内容回答问题。
+        processor = self._processor(chunk_size, overlap)
+        fingerprint = file_fingerprint(file_obj)
+        with self.lock.read_lock():
+            unchanged, old_hashes = self._previous_version(filename, fingerprint, processor)
+            replacing = self.index.has_file(filename)
+        if unchanged:
+            return True, f"文档 {filename} 未变化，跳过处理"
+
+        # 同位置正文未变化的文档块不再分词，也不重新写入索引
+        seen_ids = set()
+
+        def skip(chunk_id, digest):
+            seen_ids.add(chunk_id)
+            return old_hashes.get(chunk_id) == digest
+
+        # 读取、分割和计算向量都在锁外进行，不阻塞其他会话的检索
+        chunks = processor.iter_chunks(iter_file_text(file_obj), filename, skip=skip)
+        changed_chunks = 0
+        staged = []  # 替换已入库文件时暂存的 (文档块, 向量)
+        try:
+            for batch in batched(chunks, self.ingest_batch_size):
+                vectors = self._embed_chunks(batch)
+                if replacing:
+                    staged.append((batch, vectors))
+                else:
+                    with self.lock.write_lock():
+                        self._replace_chunks_locked(filename, batch, vectors, old_hashes, first=not changed_chunks)
+                changed_chunks += len(batch)
+                if progress is not None:
+                    progress(file_obj.tell(), changed_chunks)
+        except Exception as e:
+            if changed_chunks and not replacing:
+                # 不保留读取到一半的新文件
+                self.delete_document(filename)
+            return False, f"读取文件失败：{e}"
+
+        if not seen_ids:
+            return False, "无法读取文件内容"
+
+        with self.lock.write_lock():
+            for number, (batch, vectors) in enumerate(staged):
+                self._replace_chunks_locked(filename, batch, vectors, old_hashes, first=not number, save=False)
+            self._finish_file_locked(filename, seen_ids, old_hashes, fingerprint, processor)
+
+        if old_hashes:
+            return True, f"成功更新文档 {filename}，共 {len(seen_ids)} 个文档块，其中 {changed_chunks} 个有变化"
+        return True, f"成功处理文档 {filename}，分割成 {len(seen_ids)} 个文档块"
+
+    def add_documents(self, file_objs, max_workers=None, executor=None, chunk_size=None, overlap=None):
+        """
+        批量添加文档：解析和分词在进程池中并行执行（jieba分词受GIL限制），结果在一次提交中写入索引
+        内容未变化的文件不提交给进程池；内容变化的文件只替换正文不同的文档块
+        :param file_objs: 文件对象列表，需提供 name、type 和 getvalue()
+        :param max_workers: 进程数，默认为CPU核数；为1时在当前进程中处理
+        :param executor: 复用已有的进程池（如命令行批量导入），为空时临时创建
+        :param chunk_size: 文档块大小，为空时使用默认值
+        :param overlap: 相邻文档块重叠字符数，为空时使用默认值
+        :return: [(文件名, 是否成功, 消息)]
+        """
+        processor = self._processor(chunk_size, overlap)
+        report = []
+        payloads = []
+        versions = {}  # 文件名 -> (内容指纹, 旧版本的 chunk_id -> 正文哈希)
+        with self.lock.read_lock():
+            for file_obj in file_objs:
+                data = file_obj.getvalue()
+                fingerprint = bytes_fingerprint(data)
+                unchanged, old_hashes = self._previous_version(file_obj.name, fingerprint, processor)
+                if unchanged:
+                    report.append((file_obj.name, True, f"文档 {file_obj.name} 未变化，跳过处理"))
+                    continue
+                versions[file_obj.name] = (fingerprint, old_hashes)
+                payloads.append((file_obj.name, file_obj.type, data, processor.chunk_size, processor.overlap))
+
+        if executor is not None:
+            results = list(executor.map(split_file_payload, payloads))
+        elif max_workers == 1 or len(payloads) <= 1:
+            results = [split_file_payload(payload) for payload in payloads]
+        else:
+            with create_ingest_pool(max_workers) as pool:
+                results = list(pool.map(split_file_payload, payloads))
+
+        # 只为正文有变化的文档块计算向量
+        changes = {}
+        for filename, chunks, error in results:
+            if chunks:
+                old_hashes = versions[filename][1]
+                changed = [chunk for chunk in chunks if old_hashes.get(chunk['chunk_id']) != chunk['content_hash']]
+                changes[filename] = (chunks, changed, self._embed_chunks(changed) if changed else None)
+
+        if not changes:
+            return report + [(filename, False, error) for filename, chunks, error in results]
+
+        with self.lock.write_lock():
+            for filename, chunks, error in results:
+                if not chunks:
+                    report.append((filename, False, error))
+                    continue
+                chunks, changed, vectors = changes[filename]
+                fingerprint, old_hashes = versions[filename]
+                if changed:
+                    self._replace_chunks_locked(filename, changed, vectors, old_hashes, first=True, save=False)
+                self._finish_file_locked(filename, {chunk['chunk_id'] for chunk in chunks}, old_hashes,
+                                         fingerprint, processor, save=False)
+                if old_hashes:
+                    message = f"成功更新文档 {filename}，共 {len(chunks)} 个文档块，其中 {len(changed)} 个有变化"
+                else:
+                    message = f"成功处理文档 {filename}，分割成 {len(chunks)} 个文档块"
+                report.append((filename, True, message))
+            self.index.save_index()
+            self._save_vectors()
+            self.generation += 1
+
+        return report
+
+    def _replace_chunks_locked(self, filename, chunks, vectors, old_hashes, first, save=True):
+        """
+        写入文件的一批新文档块（需持有写锁）
+        没有可复用的旧版本时，写入第一批之前删除整个旧文件；否则只删除与新文档块同ID的旧文档块
+        """
+        if first and not old_hashes:
+            # 新文件无需删除；向量索引按文件删除需要扫描全部行，批量导入大量小文件时不能每个文件都扫一遍
+            if self.index.has_file(filename):
+                self._remove_file(filename)
+        else:
+            self._remove_chunks(filename, [chunk['chunk_id'] for chunk in chunks if chunk['chunk_id'] in old_hashes])
+        self._index_chunks(chunks, vectors)
+        if save:
+            self.index.save_index()
+            self._save_vectors()
+            self.generation += 1
+
+    def _finish_file_locked(self, filename, seen_ids, old_hashes, fingerprint, processor, save=True):
+        """删除新版本中已不存在的旧文档块并记录文件指纹（需持有写锁）"""
+        stale_ids = [chunk_id for chunk_id in old_hashes if chunk_id not in seen_ids]
+        if stale_ids:
+            self._remove_chunks(filename, stale_ids)
+        self.index.set_file_fingerprint(filename, fingerprint, processor.chunk_size, processor.overlap)
+        if save:
+            self.index.save_index()
+            self._save_vectors()
+            self.generation += 1
+
+    def _remove_file(self, filename):
+        """从关键词索引和向量索引中删除文件（需持有写锁，不持久化）"""
+        transfers = self.index.delete_document(filename)
+        if self.vector_index is not None:
+            # 转交给其他文件的文档块保留向量，只改名
+            for old_id, new_id, new_filename in transfers:
+                self.vector_index.rename(old_id, new_id, new_filename)
+            self.vector_index.delete_document(filename)
+
+    def _remove_chunks(self, filename, chunk_ids):
+        """从关键词索引和向量索引中删除文件的部分文档块（需持有写锁，不持久化）"""
+        if not chunk_ids:
+            return
+        transfers = self.index.remove_chunks(filename, chunk_ids)
+        if self.vector_index is not None:
+            for old_id, new_id, new_filename in transfers:
+                self.vector_index.rename(old_id, new_id, new_filename)
+            self.vector_index.remove_chunks(chunk_ids)
+
+    def _index_chunks(self, chunks, vectors):
+        """把一批文档块写入索引，只为去重后实际存储的文档块保存向量（需持有写锁，不持久化）"""
+        stored = self.index.add_document_chunks(chunks)
+        if self.vector_index is not None and vectors is not None and stored:
+            rows = {chunk['chunk_id']: row for row, chunk in enumerate(chunks)}
+            self.vector_index.add(stored, vectors[[rows[chunk['chunk_id']] for chunk in stored]])
+
+    def _delete_locked(self, filename):
+        """从关键词索引和向量索引中删除文件并持久化（需持有写锁）"""
+        self._remove_file(filename)
+        self.index.save_index()
+        self._save_vectors()
+        self.generation += 1
+
+    def _embed_chunks(self, chunks):
+        """计算文档块向量；未启用向量检索或向量服务不可用时返回None（之后可用 sync_vector_index 补齐）"""
+        if self.vector_index is None:
+            return None
+        try:
+            return self.embedder.embed([chunk['content'] for chunk in chunks])
+        except Exception as e:
+            print(f"计算文档向量失败: {e}")
+            return None
+
+    def _save_vectors(self):
+        if self.vector_index is not None:
+            self.vector_index.save()
+
+    def sync_vector_index(self, batch_size=256):
+        """
+        为还没有向量的文档块补算向量（如启用向量检索之前导入的文档）
+        :param batch_size: 每批计算的文档块数
+        :return: 新增的向量数量
+        """
+        if self.vector_index is None:
+            return 0
+        with self.lock.read_lock():
+            missing = [chunk_id for chunk_id in self.index.live_chunk_ids() if chunk_id not in self.vector_index]
+
+        added = 0
+        for start in range(0, len(missing), batch_size):
+            with self.lock.read_lock():
+                chunks = [chunk for chunk in map(self.index.get_chunk, missing[start:start + batch_size])
+                          if chunk is not None]
+            vectors = self.embedder.embed([chunk['content'] for chunk in chunks])
+            with self.lock.write_lock():
+                # 计算期间被删除或覆盖的文档块不再写入
+                keep = [i for i, chunk in enumerate(chunks)
+                        if self.index.has_chunk(chunk['chunk_id']) and chunk['chunk_id'] not in self.vector_index]
+                self.vector_index.add([chunks[i] for i in keep], vectors[keep])
+                self.vector_index.save()
+                self.generation += 1
+            added += len(keep)
+        return added
+
+    def search_documents(self, query, top_k=3, engine=None, retriever="keyword", fusion="rrf", rerank=False,
+                         timings=None):
+        """
+        搜索相关文档
+        :param query: 查询文本
+        :param top_k: 返回的文档块数量
+        :param engine: 打分引擎，为空时使用系统默认引擎
+        :param retriever: 检索方式，"keyword"为关键词检索，"vector"为向量检索，"hybrid"为两者并发召回后融合
+        :param fusion: 混合检索的融合方式，"rrf"或"weighted"
+        :param rerank: 混合检索时是否对融合结果的前 rerank_top_n 个做重排序
+        :param timings: 传入字典时记录各阶段耗时（毫秒），如 keyword、embed、vector、fusion、rerank、total
+        :return: 相关文档块列表
+        """
+        timings = {} if timings is None else timings
+        with stage_timer(timings, "total"):
+            # 先取代数再检索：检索期间索引发生变化时，写入的缓存条目在下次读取时即失效
+            generation = self.generation
+            cache_key = self._cache_key(query, top_k, engine, retriever, fusion, rerank)
+            results = self.query_cache.get(cache_key, generation)
+            if results is not None:
+                return results
+
+            if retriever == "keyword":
+                results = self._search_keywords(query, top_k, engine, timings)
+            elif retriever == "vector":
+                results = self._search_vectors(query, top_k, timings)
+            elif retriever == "hybrid":
+                results = self._search_hybrid(query, top_k, engine, fusion, rerank, timings)
+            else:
+                raise ValueError(f"不支持的检索方式: {retriever}")
+
+            self.query_cache.put(cache_key, generation, results)
+            return results
+
+    def _cache_key(self, query, top_k, engine, retriever, fusion, rerank):
+        """
+        检索缓存键：关键词检索以排序后的查询关键词代替原文，措辞、标点或语序略有不同的相同问题共享缓存，
+        没有可用关键词的查询退化为去除空白后的原文；
+        向量和混合检索的结果取决于整句的向量，关键词相同的不同问题结果也不同，只按合并空白后的原文共享缓存
+        """
+        if retriever == "keyword":
+            fusion, rerank = None, False
+            query_key = tuple(sorted(get_tokenizer().query_keywords(query))) or (''.join(query.split()),)
+        else:
+            query_key = (' '.join(query.split()),)
+        return query_key, top_k, engine or self.engine, retriever, fusion, rerank
+
+    def _search_keywords(self, query, top_k, engine, timings):
+        with stage_timer(timings, "keyword"), self.lock.read_lock():
+            return self.index.search_by_keywords(query, top_k, engine=engine or self.engine)
+
+    def _search_hybrid(self, query, top_k, engine, fusion, rerank, timings):
+        """关键词和向量两路并发召回，融合后可选重排序"""
+        if self.vector_index is None:
+            raise ValueError("未启用向量检索，请设置 RAG_EMBEDDING_MODEL 环境变量或在创建RAGSystem时提供embedder")
+        candidates = max(top_k * self.hybrid_candidates, self.rerank_top_n if rerank else 0)
+
+        # 关键词检索是纯Python计算，向量检索主要等待向量服务和NumPy运算（释放GIL），两者可以重叠
+        vector_future = self._search_pool.submit(self._search_vectors, query, candidates, timings)
+        result_lists = {"keyword": self._search_keywords(query, candidates, engine, timings)}
+        try:
+            result_lists["vector"] = vector_future.result()
+        except Exception as e:
+            # 向量服务不可用时退化为关键词检索
+            print(f"向量检索失败，仅使用关键词检索结果: {e}")
+
+        with stage_timer(timings, "fusion"):
+            fused = fuse_results(fusion, result_lists)
+
+        if rerank and fused:
+            with stage_timer(timings, "rerank"):
+                head = fused[:self.rerank_top_n]
+                with self.lock.read_lock():
+                    idf = self.index.keyword_idf(get_tokenizer().query_keywords(query))
+                fused = self.reranker.rerank(query, head, idf) + fused[self.rerank_top_n:]
+
+        return fused[:top_k]
+
+    def _search_vectors(self, query, top_k, timings=None):
+        """向量检索，relevance_score 为余弦相似度"""
+        if self.vector_index is None:
+            raise ValueError("未启用向量检索，请设置 RAG_EMBEDDING_MODEL 环境变量或在创建RAGSystem时提供embedder")
+        timings = {} if timings is None else timings
+        with stage_timer(timings, "embed"):
+            query_vector = self.embedder.embed([query])[0]
+
+        with stage_timer(timings, "vector"), self.lock.read_lock():
+            results = []
+            for chunk_id, score in self.vector_index.search(query_vector, top_k):
+                chunk = self.index.get_chunk(chunk_id, term_freqs=False)
+                if chunk is None:
+                    continue
+                chunk['relevance_score'] = score
+                results.append(chunk)
+            return results
+
+    RAG_PROMPT_TEMPLATE = """请基于以下文档内容回答问题。
 
 相关文档内容：
-{context_text}
+{context}
 
 用户问题：{query}
 
 请根据上述文档内容回答问题。如果文档中没有相关信息，请明确说明。"""
 
-        return rag_prompt
+    def generate_rag_prompt(self, query, context_chunks, model=None, token_budget=None):
+        """
+        生成包含上下文的提示词
+        同一文件中相邻的文档块合并为一个片段并去掉重叠文本；指定模型或预算时按token预算取舍文档块
+        :param query: 用户问题
+        :param context_chunks: 按相关性降序的文档块列表
+        :param model: 目标模型名称，用于确定上下文预算（如 ernie-lite-8k 远小于 ernie-4.5-turbo-vl-32k）
+        :param token_budget: 提示词的token预算，优先于 model
+        :return: 提示词
+        """
+        if not context_chunks:
+            return query
+
+        if token_budget is None and model is not None:
+            token_budget = context_budget(model)
+        if token_budget is not None:
+            # 扣除问题和模板本身占用的token
+            token_budget -= estimate_tokens(self.RAG_PROMPT_TEMPLATE) + estimate_tokens(query)
+
+        blocks = pack_context(context_chunks, token_budget)
+        if not blocks:
+            return query
+
+        context_text = "\n\n".join([
+            f"文档片段 {i + 1} (来源: {_block_source(block)}):\n{block['content']}"
+            for i, block in enumerate(blocks)
+        ])
+        return self.RAG_PROMPT_TEMPLATE.format(context=context_text, query=query)
 
     def get_document_stats(self):
         """获取文档统计信息"""
-        total_chunks = len(self.index.document_chunks)
-        total_keywords = len(self.index.keyword_index)
+        with self.lock.read_lock():
+            total_chunks = self.index.live_chunk_count()
+            total_keywords = self.index.vocabulary_size()
 
-        # 按文件统计
-        file_stats = defaultdict(int)
-        for chunk in self.index.document_chunks.values():
-            file_stats[chunk['filename']] += 1
+            # 按文件统计
+            file_stats = self.index.file_counts()
+            dedup_stats = self.index.dedup_stats()
 
         return {
             'total_chunks': total_chunks,
             'total_keywords': total_keywords,
-            'files': dict(file_stats)
+            'files': file_stats,
+            'duplicate_chunks': dedup_stats['duplicate_chunks'],  # 去重后以引用共享的文档块数量
+            'dedup_saved_bytes': dedup_stats['saved_bytes'],  # 去重节省的正文字节数
+            'shards': self.shard_count
         }
 
     def delete_document(self, filename):
         """删除指定文档"""
-        self.index.delete_document(filename)
-        self.index.save_index()
+        with self.lock.write_lock():
+            self._delete_locked(filename)
         return f"已删除文档: {filename}"
 
+    @property
+    def shard_count(self):
+        """索引分片数，单一索引为1"""
+        return getattr(self.index, 'shard_count', 1)
+
+    def reshard(self, shard_count):
+        """
+        调整索引分片数：把现有文档块迁移到新的分片布局（期间阻塞其他会话的读写）
+        :return: 消息
+        """
+        if shard_count == self.shard_count:
+            return f"索引已是 {shard_count} 个分片"
+        with self.lock.write_lock():
+            self.index = reshard_index(self.index, self.index_dir, shard_count)
+            self.generation += 1
+        return f"索引已调整为 {shard_count} 个分片"
+
+    def close(self):
+        """关闭索引文件（等待后台合并结束）"""
+        with self.lock.write_lock():
+            self.index.close()
+        self._search_pool.shutdown(wait=False)
+
+
+DEFAULT_USER_ID = 1  # 未登录时使用的用户ID（与对话历史的默认用户一致）
+DEFAULT_COLLECTION = "default"
+_NAMESPACE_NAME = re.compile(r'[\w\-]{1,64}')  # 用户ID和集合名称同时是目录名
+
+
+class RAGCollections:
+    """
+    按用户和集合隔离的文档库：每个集合是一个独立的 RAGSystem（各自的倒排索引、向量索引、检索缓存和读写锁），
+    存放在 {root_dir}/users/{user_id}/{collection}
+    集合在第一次使用时才打开，检索只涉及请求的集合，查询开销与这些集合的数据量成正比，与其他用户的文档无关
+    """
+
+    def __init__(self, root_dir="rag_index", engine="bm25", embedder=None, shards=None,
+                 legacy_owner=DEFAULT_USER_ID):
+        """
+        :param root_dir: 索引根目录
+        :param engine: 各集合默认的关键词打分引擎
+        :param embedder: 向量化实例，所有集合共享
+        :param shards: 各集合的索引分片数，为空时沿用各集合已有的布局
+        :param legacy_owner: 引入集合之前根目录中的共享索引（以及旧版JSON索引）迁移为该用户的默认集合，为None时不迁移
+        """
+        self.root_dir = root_dir
+        self.engine = engine
+        self.embedder = embedder
+        self.shards = shards
+        self.legacy_owner = legacy_owner
+        self._systems = {}  # (用户ID, 集合名称) -> RAGSystem
+        self._lock = threading.Lock()
+        self.query_cache = QueryCache()  # 跨集合检索的结果缓存，单个集合的检索使用集合自己的缓存
+
+    @staticmethod
+    def _check_name(name, kind):
+        name = str(name)
+        if not _NAMESPACE_NAME.fullmatch(name):
+            raise ValueError(f"不合法的{kind}: {name}")
+        return name
+
+    def user_dir(self, user_id):
+        return os.path.join(self.root_dir, "users", self._check_name(user_id, "用户ID"))
+
+    def collection_dir(self, user_id, collection=DEFAULT_COLLECTION):
+        return os.path.join(self.user_dir(user_id), self._check_name(collection, "集合名称"))
+
+    def get(self, user_id, collection=DEFAULT_COLLECTION):
+        """
+        获取集合的RAG系统，首次使用时打开（不存在时创建）
+        :param user_id: 用户ID（Flask后端 /login 返回的 user_id）
+        :param collection: 集合名称，只能包含字母、数字、汉字、下划线和连字符
+        """
+        index_dir = self.collection_dir(user_id, collection)
+        key = (str(user_id), str(collection))
+        with self._lock:
+            system = self._systems.get(key)
+            if system is None:
+                legacy = self.legacy_owner is not None and key == (str(self.legacy_owner), DEFAULT_COLLECTION)
+                if legacy and move_index(self.root_dir, index_dir, extra=("vectors",)):
+                    print(f"已将 {self.root_dir} 中的共享索引迁移到 {index_dir}")
+                system = RAGSystem(self.engine, index_dir, self.embedder, self.shards,
+                                   legacy_file="document_index.json" if legacy else None)
+                self._systems[key] = system
+            return system
+
+    def list_collections(self, user_id):
+        """用户的集合名称列表，默认集合总在第一个"""
+        names = set()
+        user_dir = self.user_dir(user_id)
+        if os.path.isdir(user_dir):
+            names.update(name for name in os.listdir(user_dir) if _NAMESPACE_NAME.fullmatch(name))
+        with self._lock:
+            names.update(collection for owner, collection in self._systems if owner == str(user_id))
+        names.discard(DEFAULT_COLLECTION)
+        return [DEFAULT_COLLECTION] + sorted(names)
+
+    def delete_collection(self, user_id, collection):
+        """删除集合及其全部索引文件"""
+        index_dir = self.collection_dir(user_id, collection)
+        with self._lock:
+            system = self._systems.pop((str(user_id), str(collection)), None)
+        if system is not None:
+            system.close()
+        shutil.rmtree(index_dir, ignore_errors=True)
+        self.query_cache.clear()
+        return f"已删除集合: {collection}"
+
+    def search_documents(self, user_id, query, collections=None, top_k=3, engine=None, retriever="keyword",
+                         fusion="rrf", rerank=False, timings=None):
+        """
+        在用户的一个或多个集合中检索，结果带 collection 字段
+        关键词检索按所选集合合计的统计量打分，等同于在这些集合合并成的语料上检索；
+        向量检索和混合检索在各集合分别进行后按得分合并（余弦相似度和RRF得分在集合之间可以直接比较）
+        :param collections: 集合名称列表，为空时只检索默认集合
+        :return: 相关文档块列表，其余参数见 RAGSystem.search_documents
+        """
+        collections = list(dict.fromkeys(collections or [DEFAULT_COLLECTION]))
+        systems = [self.get(user_id, collection) for collection in collections]
+        if len(systems) == 1:
+            results = systems[0].search_documents(query, top_k, engine, retriever, fusion, rerank, timings)
+            for chunk in results:
+                chunk['collection'] = collections[0]
+            return results
+
+        timings = {} if timings is None else timings
+        with stage_timer(timings, "total"):
+            generation = tuple(system.generation for system in systems)
+            cache_key = (str(user_id), tuple(collections)) + \
+                systems[0]._cache_key(query, top_k, engine, retriever, fusion, rerank)
+            results = self.query_cache.get(cache_key, generation)
+            if results is not None:
+                return results
+
+            if retriever == "keyword":
+                results = self._search_keywords(systems, collections, query, top_k, engine or self.engine, timings)
+            else:
+                results = []
+                for system, collection in zip(systems, collections):
+                    for chunk in system.search_documents(query, top_k, engine, retriever, fusion, rerank):
+                        chunk['collection'] = collection
+                        results.append(chunk)
+                results = heapq.nlargest(top_k, results, key=itemgetter('relevance_score'))
+
+            self.query_cache.put(cache_key, generation, results)
+            return results
+
+    def _search_keywords(self, systems, collections, query, top_k, engine, timings):
+        """在多个集合的索引上按合计的统计量检索，合并各集合的top_k"""
+        keywords = get_tokenizer().query_keywords(query)
+        results = []
+        with stage_timer(timings, "keyword"), ExitStack() as stack:
+            # 按集合名称的固定顺序加读锁：读写锁偏向写者，不同查询以不同顺序加锁时，
+            # 等待中的写者会让两个查询互相等待对方已持有的锁
+            for _, system in sorted(zip(collections, systems), key=itemgetter(0)):
+                stack.enter_context(system.lock.read_lock())
+            stats = sum_corpus_stats(system.index.corpus_stats(keywords) for system in systems)
+            if not stats.document_frequencies:
+                return []
+            for system, collection in zip(systems, collections):
+                for chunk in system.index.search_keywords(keywords, top_k, engine, stats):
+                    chunk['collection'] = collection
+                    results.append(chunk)
+        return heapq.nlargest(top_k, results, key=itemgetter('relevance_score'))
+
+    def close(self):
+        with self._lock:
+            systems, self._systems = list(self._systems.values()), {}
+        for system in systems:
+            system.close()
+
+
+@st.cache_resource
+def get_rag_collections():
+    """
+    进程内共享的集合管理器：所有会话共用，同一集合只加载一份索引
+    RAG_INDEX_SHARDS 环境变量指定各集合的分片数，未设置时沿用各集合已有的布局
+    """
+    shards = os.environ.get("RAG_INDEX_SHARDS")
+    return RAGCollections(embedder=default_embedder(), shards=int(shards) if shards else None)
+
+
+def get_shared_rag_system(user_id=DEFAULT_USER_ID, collection=DEFAULT_COLLECTION):
+    """进程内共享的某个用户集合的RAG系统"""
+    return get_rag_collections().get(user_id, collection)
+
+
+def session_user_id():
+    """当前会话的用户ID：show_user_login 登录后保存在会话中（Flask后端 /login 返回），未登录时为默认用户"""
+    return st.session_state.get('user_id', DEFAULT_USER_ID)
+
+
+def set_session_user(user_id):
+    """切换本会话的用户，当前集合和检索范围回到该用户的默认集合"""
+    if user_id is None:
+        st.session_state.pop('user_id', None)
+    else:
+        st.session_state['user_id'] = user_id
+    st.session_state['rag_collection'] = DEFAULT_COLLECTION
+    st.session_state['search_collections'] = [DEFAULT_COLLECTION]
+    st.session_state['rag_system'] = get_shared_rag_system(session_user_id(), DEFAULT_COLLECTION)
+
+
+def show_user_login():
+    """登录表单：调用Flask后端 /login，把返回的 user_id 保存在会话中，之后的文档集合按该用户隔离"""
+    if 'user_id' in st.session_state:
+        st.write(f"👤 当前用户ID: {st.session_state['user_id']}")
+        if st.button("退出登录"):
+            set_session_user(None)
+            st.rerun()
+        return
+
+    with st.form("rag_login"):
+        st.caption(f"未登录时使用默认用户（ID {DEFAULT_USER_ID}）的文档集合")
+        username = st.text_input("用户名")
+        password = st.text_input("密码", type="password")
+        submitted = st.form_submit_button("登录")
+    if not submitted:
+        return
+
+    import requests
+    try:
+        response = requests.post("http://127.0.0.1:5000/login", json={"username": username, "password": password},
+                                 timeout=10)
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        st.error(f"无法连接登录服务: {e}")
+        return
+    if response.status_code == 200 and data.get('status') == 'success':
+        set_session_user(data['user_id'])
+        st.rerun()
+    else:
+        st.error(data.get('message', "登录失败"))
+
+
+def search_session_documents(query, top_k=3, timings=None):
+    """
+    在本会话选择的检索范围内，按本会话的检索参数搜索文档
+    :param timings: 可选的字典，写入各检索阶段的耗时（毫秒）
+    """
+    collections = st.session_state.get('search_collections') or \
+        [st.session_state.get('rag_collection', DEFAULT_COLLECTION)]
+    return get_rag_collections().search_documents(
+        session_user_id(),
+        query,
+        collections=collections,
+        top_k=top_k,
+        retriever=st.session_state.get('retriever', 'keyword'),
+        fusion=st.session_state.get('fusion', 'rrf'),
+        rerank=st.session_state.get('rerank', False),
+        timings=timings
+    )
+
+
+def show_collection_selector():
+    """选择上传和管理的集合，以及检索范围；切换集合后更新本会话的 rag_system"""
+    collections = get_rag_collections()
+    user_id = session_user_id()
+    names = collections.list_collections(user_id)
+    current = st.session_state.get('rag_collection', DEFAULT_COLLECTION)
+    if current not in names:
+        current = DEFAULT_COLLECTION
+
+    col1, col2 = st.columns([3, 2])
+    with col1:
+        selected = st.selectbox("文档集合", names, index=names.index(current),
+                                help="每个用户的文档按集合分开存储和检索，互不影响")
+    with col2:
+        new_name = st.text_input("新建集合", placeholder="集合名称")
+        if new_name and st.button("➕ 创建集合"):
+            try:
+                collections.get(user_id, new_name.strip())
+                selected = new_name.strip()
+                names = collections.list_collections(user_id)
+            except ValueError as e:
+                st.error(str(e))
+
+    st.session_state.rag_collection = selected
+    st.session_state.rag_system = collections.get(user_id, selected)
+    scope = [name for name in st.session_state.get('search_collections', [selected]) if name in names]
+    st.session_state['search_collections'] = st.multiselect(
+        "检索范围", names, default=scope or [selected],
+        help="提问时只检索选中的集合"
+    )
+
+    if selected != DEFAULT_COLLECTION and st.button(f"🗑️ 删除集合 {selected}"):
+        st.session_state.rag_system = collections.get(user_id, DEFAULT_COLLECTION)
+        st.session_state.rag_collection = DEFAULT_COLLECTION
+        st.session_state['search_collections'] = [DEFAULT_COLLECTION]
+        st.success(collections.delete_collection(user_id, selected))
+        st.rerun()
+
 
 # Streamlit界面组件
 def show_rag_management():
     """显示RAG文档管理界面"""
     st.subheader("📚 私有文档管理")
 
-    # 初始化RAG系统
-    if 'rag_system' not in st.session_state:
-        st.session_state.rag_system = RAGSystem()
+    # rag_jobs 依赖本模块，在此处导入以避免循环导入
+    from modules.rag_jobs import get_ingest_queue, show_ingest_jobs
 
+    # 选择集合（集合的RAG系统在进程内共享）
+    show_collection_selector()
     rag_system = st.session_state.rag_system
 
     # 文档上传
@@ -290,30 +1684,39 @@ def show_rag_management():
     )
 
     if uploaded_files:
+        # 文档交给后台导入队列处理，提交后立即返回，进度在下方的导入任务面板中显示
+        ingest_queue = get_ingest_queue()
+        user_id, collection = session_user_id(), st.session_state.rag_collection
+
+        if len(uploaded_files) > 1 and st.button(f"全部处理 ({len(uploaded_files)} 个文档)", key="process_all"):
+            for uploaded_file in uploaded_files:
+                ingest_queue.submit(user_id, collection, uploaded_file, chunk_size=st.session_state.get('chunk_size'))
+            st.rerun()
+
         for uploaded_file in uploaded_files:
             col1, col2 = st.columns([3, 1])
             with col1:
                 st.write(f"📄 {uploaded_file.name}")
             with col2:
                 if st.button(f"处理", key=f"process_{uploaded_file.name}"):
-                    with st.spinner("正在处理文档..."):
-                        success, message = rag_system.add_document(uploaded_file, uploaded_file.name)
-                        if success:
-                            st.success(message)
-                        else:
-                            st.error(message)
-                        st.rerun()
+                    ingest_queue.submit(user_id, collection, uploaded_file, chunk_size=st.session_state.get('chunk_size'))
+                    st.rerun()
+
+    show_ingest_jobs()
 
     # 显示文档统计
     stats = rag_system.get_document_stats()
 
-    col1, col2, col3 = st.columns(3)
+    col1, col2, col3, col4 = st.columns(4)
     with col1:
         st.metric("文档块数量", stats['total_chunks'])
     with col2:
         st.metric("关键词数量", stats['total_keywords'])
     with col3:
         st.metric("文档数量", len(stats['files']))
+    with col4:
+        st.metric("去重节省", f"{stats['dedup_saved_bytes'] / 1024:.1f} KB",
+                  help=f"{stats['duplicate_chunks']} 个重复文档块只存储一份")
 
     # 显示已处理的文档列表
     if stats['files']:
@@ -328,22 +1731,37 @@ def show_rag_management():
                     st.success(f"已删除: {filename}")
                     st.rerun()
 
+        # 手动合并：把追加日志并入基础段，合并在后台进行
+        if st.button("🗜️ 合并索引", help="将增量日志合并到索引文件中，减少加载时间"):
+            with rag_system.lock.write_lock():
+                rag_system.index.compact(background=True)
+            st.info("索引合并已在后台开始")
 
-def enhance_query_with_rag(query, use_rag=True):
-    """使用RAG增强查询"""
+        if rag_system.vector_index is not None and len(rag_system.vector_index) < stats['total_chunks']:
+            if st.button("🧭 补算向量", help="为启用向量检索之前导入的文档块计算向量"):
+                with st.spinner("正在计算文档向量..."):
+                    added = rag_system.sync_vector_index()
+                st.success(f"已为 {added} 个文档块计算向量")
+
+
+def enhance_query_with_rag(query, use_rag=True, model=None):
+    """
+    使用RAG增强查询
+    :param model: 目标模型名称，用于按其上下文窗口控制提示词长度
+    """
     if not use_rag or 'rag_system' not in st.session_state:
         return query, []
 
     rag_system = st.session_state.rag_system
 
-    # 搜索相关文档
-    relevant_chunks = rag_system.search_documents(query, top_k=3)
+    # 在本会话选择的集合中搜索相关文档
+    relevant_chunks = search_session_documents(query, top_k=3)
 
     if not relevant_chunks:
         return query, []
 
     # 生成增强的提示词
-    enhanced_prompt = rag_system.generate_rag_prompt(query, relevant_chunks)
+    enhanced_prompt = rag_system.generate_rag_prompt(query, relevant_chunks, model=model)
 
     return enhanced_prompt, relevant_chunks
 
@@ -362,16 +1780,7 @@ def test_rag_system():
     """
 
     # 模拟文件对象
-    class MockFile:
-        def __init__(self, content, name):
-            self.content = content
-            self.name = name
-            self.type = "text/plain"
-
-        def getvalue(self):
-            return self.content.encode('utf-8')
-
-    mock_file = MockFile(test_content, "ai_knowledge.txt")
+    mock_file = UploadedBytes(test_content.encode('utf-8'), "ai_knowledge.txt", "text/plain")
 
     # 添加文档
     success, message = rag_system.add_document(mock_file)
@@ -0,0 +1,108 @@
+import heapq
+import math
+from operator import itemgetter
+
+
+class Scorer:
+    """检索打分器基类，定义通用接口"""
+
+    name = ""
+
+    def score(self, index, term_ids):
+        """
+        计算命中文档块的相关性得分
+        :param index: DocumentIndex 实例（或提供相同统计接口的分片视图）
+        :param term_ids: 查询词项ID列表
+        :return: 文档块整数ID -> 得分
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def top_k(self, index, term_ids, top_k=5):
+        """用大小为top_k的堆选出得分最高的文档块，避免对全部候选排序"""
+        scores = self.score(index, term_ids)
+        return heapq.nlargest(top_k, scores.items(), key=itemgetter(1))
+
+
+class TfIdfScorer(Scorer):
+    """原有的近似TF-IDF打分：词频 * (文档块总数 / 文档频率)"""
+
+    name = "tfidf"
+
+    def score(self, index, term_ids):
+        chunk_scores = {}
+        total_chunks = index.live_chunk_count()
+        for term_id in term_ids:
+            posting = index.postings[term_id]
+            if not posting:
+                continue
+            # 分片索引中文档频率取全局值，与本分片的倒排列表长度不同
+            idf = total_chunks / index.document_frequency(term_id)
+            for doc_id, tf in posting:
+                chunk_scores[doc_id] = chunk_scores.get(doc_id, 0.0) + tf * idf
+        return chunk_scores
+
+
+class BM25Scorer(Scorer):
+    """
+    BM25 / BM25+ 打分
+    delta 为 0 时即标准 BM25，delta > 0 时为 BM25+（为长文档块保留词频下界）
+    """
+
+    name = "bm25"
+
+    def __init__(self, k1=1.2, b=0.75, delta=0.0):
+        self.k1 = k1
+        self.b = b
+        self.delta = delta
+
+    def score(self, index, term_ids):
+        chunk_scores = {}
+        idf_table = index.idf_table()
+        doc_lengths = index.doc_lengths
+        avg_length = index.average_chunk_length() or 1.0
+        k1 = self.k1
+        # 长度归一化因子 k1 * (1 - b + b * dl / avgdl) 中与文档无关的部分提前算好
+        norm_base = k1 * (1 - self.b)
+        norm_scale = k1 * self.b / avg_length
+        delta = self.delta
+
+        for term_id in term_ids:
+            posting = index.postings[term_id]
+            if not posting:
+                continue
+            idf = idf_table[term_id]
+            for doc_id, tf in posting:
+                norm = norm_base + norm_scale * doc_lengths[doc_id]
+                weight = tf * (k1 + 1) / (tf + norm) + delta
+                chunk_scores[doc_id] = chunk_scores.get(doc_id, 0.0) + idf * weight
+        return chunk_scores
+
+
+def bm25_idf(total_chunks, document_frequency):
+    """BM25 的逆文档频率（Lucene 形式，恒为正）"""
+    return math.log(1 + (total_chunks - document_frequency + 0.5) / (document_frequency + 0.5))
+
+
+SCORING_ENGINES = ("bm25", "bm25+", "tfidf")
+
+
+# 工厂函数，用于创建打分器实例
+def create_scorer(engine="bm25", **kwargs):
+    """
+    创建检索打分器
+    :param engine: 打分引擎，支持"bm25"、"bm25+"和"tfidf"
+    :param kwargs: 其他参数，将传递给相应的打分器构造函数
+    :return: 打分器实例
+    """
+    engine = engine.lower()
+    if engine == "bm25":
+        return BM25Scorer(**kwargs)
+    elif engine == "bm25+":
+        kwargs.setdefault("delta", 1.0)
+        scorer = BM25Scorer(**kwargs)
+        scorer.name = "bm25+"
+        return scorer
+    elif engine == "tfidf":
+        return TfIdfScorer()
+    else:
+        raise ValueError(f"不支持的打分引擎: {engine}")
@@ -0,0 +1,63 @@
+from itertools import islice
+
+# 分割点的优先级：段落 > 换行 > 中文句末标点 > 分句标点 > 空格，分隔符保留在前一个文档块末尾
+SEPARATORS = ("\n\n", "\n", "。", "！", "？", "；", "：", "，", " ")
+
+
+def _find_cut(buffer, start, limit, separators):
+    """在 buffer[start:limit] 的后半段中找优先级最高的分隔符，返回切分位置；找不到时在 limit 处硬切"""
+    lower = start + max(1, (limit - start) // 2)
+    for separator in separators:
+        position = buffer.rfind(separator, lower, limit)
+        if position != -1:
+            return position + len(separator)
+    return limit
+
+
+def split_text_stream(pieces, chunk_size=500, overlap=50, separators=SEPARATORS):
+    """
+    流式分块：逐段消费文本，按 chunk_size 和 overlap 产出文档块
+    内存中只保留当前片段和不超过一个文档块的未处理文本，适合超大文件
+    :param pieces: 文本片段的可迭代对象（如按块读取的文件内容、PDF的每一页）
+    :param chunk_size: 文档块最大字符数
+    :param overlap: 相邻文档块重叠的字符数
+    :param separators: 按优先级排列的分隔符
+    :return: 文档块文本的生成器（已去除首尾空白，不含空块）
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk_size 必须大于0")
+    if not 0 <= overlap < chunk_size:
+        raise ValueError("overlap 必须不小于0且小于 chunk_size")
+
+    buffer = ""
+    emitted = False
+    for piece in pieces:
+        if not piece:
+            continue
+        buffer += piece
+        # 用游标在缓冲区内前进，每个片段处理完后才截断一次，避免逐块复制整个缓冲区
+        start = 0
+        while len(buffer) - start > chunk_size:
+            end = _find_cut(buffer, start, start + chunk_size, separators)
+            chunk = buffer[start:end].strip()
+            if chunk:
+                yield chunk
+                emitted = True
+            start = max(end - overlap, start + 1)
+        buffer = buffer[start:]
+
+    # 剩余文本只有上一块的重叠部分时不再单独成块
+    if not emitted or len(buffer) > overlap:
+        chunk = buffer.strip()
+        if chunk:
+            yield chunk
+
+
+def batched(iterable, size):
+    """按 size 个一组切分可迭代对象"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
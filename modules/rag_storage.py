@@ -0,0 +1,818 @@
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+from datetime import datetime
+
+from modules.rag_context import chunk_tokens
+from modules.rag_dedup import chunk_fingerprints
+
+SEGMENT_MAGIC = b'RAGSEG01'
+SEGMENT_VERSION = 3
+MANIFEST_FILE = "manifest.json"
+SHARDS_FILE = "shards.json"
+_SHARD_LAYOUT_DIR = re.compile(r"shards_\d+")
+
+# 段文件中各数据区的顺序，头部按此顺序登记每个数据区的 (偏移, 字节长度)
+SECTIONS = (
+    'terms',  # 词项字典：UTF-8编码，以\0分隔，下标即词项ID
+    'posting_offsets',  # int64[term_count + 1]：每个词项倒排列表在posting_*中的起止位置
+    'posting_docs',  # int32[]：倒排列表中的文档ID
+    'posting_freqs',  # int32[]：倒排列表中的词频
+    'chunk_ids',  # 文档块ID：UTF-8编码，以\0分隔，下标即文档ID
+    'filenames',  # 文件名表：UTF-8编码，以\0分隔
+    'doc_file_ids',  # int32[doc_count]：文档块所属文件在文件名表中的下标
+    'doc_lengths',  # int32[doc_count]：文档块长度（词项数）
+    'text_offsets',  # int64[doc_count + 1]：文档块正文在text中的字节偏移
+    'text',  # 文档块正文：UTF-8编码
+    'forward_offsets',  # int64[doc_count + 1]：正排列表在forward_*中的起止位置
+    'forward_terms',  # int32[]：文档块包含的词项ID，按词频降序
+    'forward_freqs',  # int32[]：对应词频
+    # 以下为第2版新增
+    'content_hashes',  # int64[doc_count]：文档块正文哈希（精确去重）
+    'simhashes',  # int64[doc_count]：文档块SimHash（近似去重）
+    'ref_local_ids',  # 去重后未存储的文档块ID：UTF-8编码，以\0分隔
+    'ref_file_ids',  # int32[ref_count]：引用所属文件在文件名表中的下标
+    'ref_targets',  # int32[ref_count]：被引用的文档ID
+    # 以下为第3版新增
+    'token_counts',  # int32[doc_count]：文档块的估算token数（组装上下文时按预算取舍）
+)
+_VERSION_SECTIONS = {1: SECTIONS[:13], 2: SECTIONS[:18], 3: SECTIONS}  # 各版本段文件包含的数据区
+_HEADER = struct.Struct('<8sIIIQ')  # magic, version, term_count, doc_count, total_length
+_SECTION = struct.Struct('<QQ')
+_ALIGNMENT = 8
+
+
+class PostingList:
+    """倒排列表：以紧凑数组保存文档块整数ID及其词频"""
+
+    __slots__ = ('docs', 'freqs')
+
+    def __init__(self, docs=None, freqs=None):
+        # 从段文件加载时为指向mmap的只读memoryview，首次修改时才复制为数组
+        self.docs = docs if docs is not None else array('i')  # 文档块整数ID（单调递增）
+        self.freqs = freqs if freqs is not None else array('i')  # 对应的词频
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return zip(self.docs, self.freqs)
+
+    def __contains__(self, doc_id):
+        # 文档块ID按入库顺序单调递增，入库时只需比较末尾元素即可 O(1) 判断
+        if self.docs and self.docs[-1] == doc_id:
+            return True
+        pos = bisect_left(self.docs, doc_id)
+        return pos < len(self.docs) and self.docs[pos] == doc_id
+
+    def _make_writable(self):
+        """将mmap上的只读视图复制为可修改的数组"""
+        if not isinstance(self.docs, array):
+            self.docs = _to_array(self.docs)
+            self.freqs = _to_array(self.freqs)
+
+    def add(self, doc_id, freq):
+        """追加一条倒排记录，同一文档块重复追加时累加词频"""
+        self._make_writable()
+        if self.docs and self.docs[-1] == doc_id:
+            self.freqs[-1] += freq
+        else:
+            self.docs.append(doc_id)
+            self.freqs.append(freq)
+
+    def remove(self, doc_ids):
+        """移除属于doc_ids集合的倒排记录"""
+        keep = [i for i, doc_id in enumerate(self.docs) if doc_id not in doc_ids]
+        if len(keep) != len(self.docs):
+            self.docs = array('i', [self.docs[i] for i in keep])
+            self.freqs = array('i', [self.freqs[i] for i in keep])
+
+
+class PostingTable:
+    """词项ID -> 倒排列表；段文件中的倒排列表在首次访问时才从mmap中切出"""
+
+    def __init__(self, segment=None):
+        self.segment = segment
+        self._lists = [None] * segment.term_count if segment else []
+
+    def __len__(self):
+        return len(self._lists)
+
+    def __getitem__(self, term_id):
+        posting = self._lists[term_id]
+        if posting is None:
+            posting = self._lists[term_id] = self.segment.posting(term_id)
+        return posting
+
+    def __iter__(self):
+        for term_id in range(len(self._lists)):
+            yield self[term_id]
+
+    def append(self, posting):
+        self._lists.append(posting)
+
+    def document_frequency(self, term_id):
+        """词项的文档频率，未访问过的倒排列表直接由偏移表计算，不触碰倒排数据"""
+        posting = self._lists[term_id]
+        if posting is None:
+            return self.segment.document_frequency(term_id)
+        return len(posting)
+
+
+class ChunkRefs:
+    """
+    去重产生的文档块引用：与已有文档块重复的块不再存储，文件只记录 本文件的chunk_id -> 被引用的chunk_id
+    被引用的文档块所属文件删除时，文档块转交给第一个引用者，其余引用者改为引用新ID
+    """
+
+    def __init__(self):
+        self.file_refs = {}  # 文件名 -> {本文件的chunk_id: 被引用的chunk_id}
+        self.referrers = {}  # 被引用的chunk_id -> {引用者的chunk_id: 引用者文件名}
+
+    def __len__(self):
+        return sum(len(refs) for refs in self.file_refs.values())
+
+    def add(self, filename, refs):
+        """记录文件对其他文档块的引用"""
+        self.file_refs.setdefault(filename, {}).update(refs)
+        for local_id, target_id in refs.items():
+            self.referrers.setdefault(target_id, {})[local_id] = filename
+
+    def drop_file(self, filename, local_ids=None):
+        """
+        删除文件的引用
+        :param local_ids: 只删除这些本文件的chunk_id对应的引用，为空时删除全部
+        """
+        refs = self.file_refs.get(filename)
+        if not refs:
+            return
+        local_ids = list(refs) if local_ids is None else [local_id for local_id in local_ids if local_id in refs]
+        for local_id in local_ids:
+            target_id = refs.pop(local_id)
+            holders = self.referrers[target_id]
+            del holders[local_id]
+            if not holders:
+                del self.referrers[target_id]
+        if not refs:
+            del self.file_refs[filename]
+
+    def detach(self, target_id):
+        """
+        被引用的文档块即将删除，把它交给第一个引用者
+        :return: (新chunk_id, 新文件名)，没有引用者时返回None
+        """
+        holders = self.referrers.pop(target_id, None)
+        if not holders:
+            return None
+        (new_id, new_filename), *rest = holders.items()
+        refs = self.file_refs[new_filename]
+        del refs[new_id]
+        if not refs:
+            del self.file_refs[new_filename]
+        for local_id, filename in rest:
+            self.file_refs[filename][local_id] = new_id
+        if rest:
+            self.referrers[new_id] = dict(rest)
+        return new_id, new_filename
+
+    def file_counts(self):
+        """每个文件引用的文档块数量"""
+        return {filename: len(refs) for filename, refs in self.file_refs.items()}
+
+    def items(self):
+        """遍历 (文件名, 本文件的chunk_id, 被引用的chunk_id)"""
+        for filename, refs in self.file_refs.items():
+            for local_id, target_id in refs.items():
+                yield filename, local_id, target_id
+
+
+class ChunkColumns:
+    """
+    追加写入的列式文档块存储，布局与段文件相同：正文拼接为一个UTF-8字节串并用偏移数组定位，
+    词项以词项ID数组保存，指纹和token数保存为定长整数数组；不为每个文档块保留字典
+    """
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.text_offsets = array('q', [0])
+        self.forward_offsets = array('q', [0])
+        self.forward_terms = array('i')
+        self.forward_freqs = array('i')
+        self.content_hashes = array('q')
+        self.simhashes = array('q')
+        self.token_counts = array('i')
+
+    def __len__(self):
+        return len(self.content_hashes)
+
+    def append(self, chunk, forward):
+        """
+        追加一个文档块
+        :param forward: 按词频降序的 [(词项ID, 词频)]
+        """
+        self.blob += chunk['content'].encode('utf-8')
+        self.text_offsets.append(len(self.blob))
+        for term_id, freq in forward:
+            self.forward_terms.append(term_id)
+            self.forward_freqs.append(freq)
+        self.forward_offsets.append(len(self.forward_terms))
+        digest, fingerprint = chunk_fingerprints(chunk)
+        self.content_hashes.append(digest)
+        self.simhashes.append(fingerprint)
+        self.token_counts.append(chunk_tokens(chunk))
+
+    def text(self, row):
+        return self.blob[self.text_offsets[row]:self.text_offsets[row + 1]].decode('utf-8')
+
+    def text_size(self, row):
+        return self.text_offsets[row + 1] - self.text_offsets[row]
+
+    def forward(self, row, limit=None):
+        start, end = self.forward_offsets[row], self.forward_offsets[row + 1]
+        if limit is not None:
+            end = min(end, start + limit)
+        return self.forward_terms[start:end], self.forward_freqs[start:end]
+
+    def fingerprints(self, row):
+        return self.content_hashes[row], self.simhashes[row]
+
+    def token_count(self, row):
+        return self.token_counts[row]
+
+
+class ChunkStore(Mapping):
+    """
+    文档块存储：对外表现为 chunk_id -> 文档块字典 的映射
+    段文件中的文档块从mmap中读取，打开段文件之后新增的文档块保存在列式存储中，
+    两者都只在访问时才解码出正文和词项（通常只有最终的top_k个结果）
+    """
+
+    def __init__(self, segment=None, terms=None):
+        self.segment = segment
+        self.terms = terms if terms is not None else []  # 与DocumentIndex共享的词项表
+        if segment:
+            self.chunk_ids = segment.chunk_ids()  # 文档ID -> chunk_id（已删除的为None）
+            self.filenames = segment.filenames()  # 文件名表（驻留，每个文件名只存一份）
+            self.file_ids = segment.doc_file_ids()  # 文档ID -> 文件名下标
+        else:
+            self.chunk_ids = []
+            self.filenames = []
+            self.file_ids = array('i')
+        self.doc_ids = {chunk_id: doc_id for doc_id, chunk_id in enumerate(self.chunk_ids)}
+        self._filename_ids = {filename: i for i, filename in enumerate(self.filenames)}
+        # 打开段文件之后新增的文档块（文档ID从 _tail_start 开始）；删除的文档块在合并为新段时才回收
+        self._tail = ChunkColumns()
+        self._tail_start = len(self.chunk_ids)
+        self._file_docs = None  # 文件名下标 -> 现存文档ID列表，首次使用时建立
+
+    def __getitem__(self, chunk_id):
+        return self.chunk(self.doc_ids[chunk_id])
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.doc_ids
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def _source(self, doc_id):
+        """文档块所在的存储及其中的行号"""
+        if doc_id >= self._tail_start:
+            return self._tail, doc_id - self._tail_start
+        return self.segment, doc_id
+
+    def chunk(self, doc_id, term_freqs=True):
+        """
+        按文档ID解码文档块字典
+        :param term_freqs: 是否解码全部词频；为False时只解码前20个关键词，用于返回检索结果
+        """
+        source, row = self._source(doc_id)
+        if term_freqs:
+            term_ids, freqs = source.forward(row)
+        else:
+            term_ids, freqs = source.forward(row, limit=20)
+        # 正排列表按词频降序保存，前20个即关键词
+        decoded = {self.terms[term_id]: freq for term_id, freq in zip(term_ids, freqs)}
+        chunk = {
+            'chunk_id': self.chunk_ids[doc_id],
+            'filename': self.filename(doc_id),
+            'content': source.text(row),
+            'keywords': list(decoded)[:20]
+        }
+        if term_freqs:
+            chunk['term_freqs'] = decoded
+            chunk['length'] = sum(decoded.values())
+        fingerprints = source.fingerprints(row)
+        if fingerprints:
+            chunk['content_hash'], chunk['simhash'] = fingerprints
+        token_count = source.token_count(row)
+        if token_count is not None:
+            chunk['token_count'] = token_count
+        return chunk
+
+    def fingerprints(self, doc_id):
+        """文档块的 (正文哈希, SimHash)，旧版段文件中没有保存时现算"""
+        source, row = self._source(doc_id)
+        fingerprints = source.fingerprints(row)
+        if fingerprints:
+            return fingerprints
+        return chunk_fingerprints(self.chunk(doc_id))
+
+    def content(self, doc_id):
+        """只解码文档块正文"""
+        source, row = self._source(doc_id)
+        return source.text(row)
+
+    def content_bytes(self, doc_id):
+        """文档块正文的UTF-8字节数，无需解码正文"""
+        source, row = self._source(doc_id)
+        return source.text_size(row)
+
+    def filename(self, doc_id):
+        """文档块所属文件名，无需解码文档块本身"""
+        return self.filenames[self.file_ids[doc_id]]
+
+    def term_ids(self, doc_id):
+        """文档块包含的词项ID（文档块 -> 词项的反向映射）"""
+        source, row = self._source(doc_id)
+        return source.forward(row)[0]
+
+    def live_doc_ids(self):
+        """按文档ID顺序遍历现存文档块"""
+        return (doc_id for doc_id, chunk_id in enumerate(self.chunk_ids) if chunk_id is not None)
+
+    def _file_doc_map(self):
+        """文件 -> 文档块的反向映射，第一次删除或统计时才扫描一遍建立"""
+        if self._file_docs is None:
+            self._file_docs = defaultdict(list)
+            for doc_id in self.live_doc_ids():
+                self._file_docs[self.file_ids[doc_id]].append(doc_id)
+        return self._file_docs
+
+    def file_doc_ids(self, filename):
+        """指定文件现存文档块的文档ID列表"""
+        file_id = self._filename_ids.get(filename)
+        if file_id is None:
+            return []
+        return list(self._file_doc_map().get(file_id, ()))
+
+    def file_counts(self):
+        """统计每个文件的文档块数量"""
+        return {self.filenames[file_id]: len(doc_ids) for file_id, doc_ids in self._file_doc_map().items()}
+
+    def add(self, chunk, forward):
+        """
+        新增文档块并返回分配的文档ID
+        :param forward: 按词频降序的 [(词项ID, 词频)]
+        """
+        filename = chunk['filename']
+        file_id = self._filename_ids.get(filename)
+        if file_id is None:
+            file_id = self._filename_ids[filename] = len(self.filenames)
+            self.filenames.append(filename)
+
+        doc_id = len(self.chunk_ids)
+        self.chunk_ids.append(chunk['chunk_id'])
+        self.file_ids.append(file_id)
+        self.doc_ids[chunk['chunk_id']] = doc_id
+        self._tail.append(chunk, forward)
+        if self._file_docs is not None:
+            self._file_docs[file_id].append(doc_id)
+        return doc_id
+
+    def remove(self, doc_id):
+        """删除文档块"""
+        chunk_id = self.chunk_ids[doc_id]
+        self.chunk_ids[doc_id] = None
+        self.doc_ids.pop(chunk_id, None)
+        if self._file_docs is not None:
+            file_id = self.file_ids[doc_id]
+            doc_ids = self._file_docs[file_id]
+            doc_ids.remove(doc_id)
+            if not doc_ids:
+                del self._file_docs[file_id]
+
+
+class Segment:
+    """只读的二进制索引段，通过mmap按需读取"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        self.size = len(self._mmap)  # 段文件字节数（文件被合并替换后仍可用）
+
+        magic, version, self.term_count, self.doc_count, self.total_length = _HEADER.unpack_from(self._mmap, 0)
+        if magic != SEGMENT_MAGIC or version not in _VERSION_SECTIONS:
+            raise ValueError(f"不是有效的索引段文件: {path}")
+
+        # 旧版本段文件缺少的数据区视为空
+        self._sections = dict.fromkeys(SECTIONS, (0, 0))
+        pos = _HEADER.size
+        for name in _VERSION_SECTIONS[version]:
+            self._sections[name] = _SECTION.unpack_from(self._mmap, pos)
+            pos += _SECTION.size
+
+        # 偏移表很小，常驻；其余数据区只保留视图，由操作系统按页加载
+        self._posting_offsets = self._ints('posting_offsets', 'q')
+        self._posting_docs = self._ints('posting_docs')
+        self._posting_freqs = self._ints('posting_freqs')
+        self._text_offsets = self._ints('text_offsets', 'q')
+        self._forward_offsets = self._ints('forward_offsets', 'q')
+        self._forward_terms = self._ints('forward_terms')
+        self._forward_freqs = self._ints('forward_freqs')
+        self._content_hashes = self._ints('content_hashes', 'q')
+        self._simhashes = self._ints('simhashes', 'q')
+        self._token_counts = self._ints('token_counts')
+
+    def _bytes(self, name):
+        offset, length = self._sections[name]
+        return self._view[offset:offset + length]
+
+    def _ints(self, name, typecode='i'):
+        view = self._bytes(name).cast(typecode)
+        if sys.byteorder != 'little':
+            # 段文件固定为小端序，大端机器上退化为复制并转换字节序
+            values = array(typecode, view)
+            values.byteswap()
+            return values
+        return view
+
+    def _strings(self, name):
+        data = self._bytes(name)
+        return str(data, 'utf-8').split('\0') if len(data) else []
+
+    def terms(self):
+        return self._strings('terms')
+
+    def chunk_ids(self):
+        return self._strings('chunk_ids')
+
+    def filenames(self):
+        return self._strings('filenames')
+
+    def doc_file_ids(self):
+        return _to_array(self._ints('doc_file_ids'))
+
+    def doc_lengths(self):
+        return _to_array(self._ints('doc_lengths'))
+
+    def document_frequency(self, term_id):
+        return self._posting_offsets[term_id + 1] - self._posting_offsets[term_id]
+
+    def posting(self, term_id):
+        start, end = self._posting_offsets[term_id], self._posting_offsets[term_id + 1]
+        return PostingList(self._posting_docs[start:end], self._posting_freqs[start:end])
+
+    def text(self, doc_id):
+        offset = self._sections['text'][0]
+        start, end = self._text_offsets[doc_id], self._text_offsets[doc_id + 1]
+        return str(self._view[offset + start:offset + end], 'utf-8')
+
+    def text_size(self, doc_id):
+        return self._text_offsets[doc_id + 1] - self._text_offsets[doc_id]
+
+    def forward(self, doc_id, limit=None):
+        start, end = self._forward_offsets[doc_id], self._forward_offsets[doc_id + 1]
+        if limit is not None:
+            end = min(end, start + limit)
+        return self._forward_terms[start:end], self._forward_freqs[start:end]
+
+    def fingerprints(self, doc_id):
+        """文档块的 (正文哈希, SimHash)，旧版段文件返回None"""
+        if not len(self._content_hashes):
+            return None
+        return self._content_hashes[doc_id], self._simhashes[doc_id]
+
+    def token_count(self, doc_id):
+        """文档块的估算token数，旧版段文件返回None"""
+        if not len(self._token_counts):
+            return None
+        return self._token_counts[doc_id]
+
+    def refs(self, chunk_ids=None, filenames=None):
+        """段文件中保存的去重引用"""
+        chunk_ids = chunk_ids if chunk_ids is not None else self.chunk_ids()
+        filenames = filenames if filenames is not None else self.filenames()
+        refs = ChunkRefs()
+        local_ids = self._strings('ref_local_ids')
+        for local_id, file_id, target in zip(local_ids, self._ints('ref_file_ids'), self._ints('ref_targets')):
+            refs.add(filenames[file_id], {local_id: chunk_ids[target]})
+        return refs
+
+    def close(self):
+        """关闭段文件；仍有倒排列表引用mmap时交由垃圾回收处理"""
+        try:
+            self._view.release()
+            self._mmap.close()
+        except (BufferError, ValueError):
+            return
+        self._file.close()
+
+
+def _to_array(values):
+    """将整数视图复制为可修改的数组"""
+    if isinstance(values, array):
+        return array(values.typecode, values)
+    result = array(values.format)
+    result.frombytes(values.cast('B'))
+    return result
+
+
+def write_segment(path, chunks, refs=None):
+    """
+    将文档块写成一个新的索引段，文档ID和词项ID按写入顺序重新编号
+    :param path: 段文件路径
+    :param chunks: 文档块字典的可迭代对象，需包含 chunk_id/filename/content，
+                   以及 term_freqs（旧数据可只有 keywords）
+    :param refs: 去重引用（ChunkRefs），被引用的文档块必须在 chunks 中
+    """
+    term_ids = {}
+    posting_docs = []  # 词项ID -> 文档ID数组
+    posting_freqs = []
+    chunk_ids = []
+    filename_ids = {}
+    doc_file_ids = array('i')
+    doc_lengths = array('i')
+    text = bytearray()
+    text_offsets = array('q', [0])
+    forward_terms = array('i')
+    forward_freqs = array('i')
+    forward_offsets = array('q', [0])
+    content_hashes = array('q')
+    simhashes = array('q')
+    token_counts = array('i')
+    total_length = 0
+
+    for doc_id, chunk in enumerate(chunks):
+        chunk_ids.append(chunk['chunk_id'])
+        digest, fingerprint = chunk_fingerprints(chunk)
+        content_hashes.append(digest)
+        simhashes.append(fingerprint)
+        token_counts.append(chunk_tokens(chunk))
+        doc_file_ids.append(filename_ids.setdefault(chunk['filename'], len(filename_ids)))
+        text += chunk['content'].encode('utf-8')
+        text_offsets.append(len(text))
+
+        term_freqs = chunk.get('term_freqs') or Counter(chunk['keywords'])
+        length = chunk.get('length') or sum(term_freqs.values())
+        doc_lengths.append(length)
+        total_length += length
+
+        # 正排列表按词频降序（同频保持首次出现顺序），与关键词的提取顺序一致
+        for term, freq in sorted(term_freqs.items(), key=lambda item: -item[1]):
+            term_id = term_ids.get(term)
+            if term_id is None:
+                term_id = term_ids[term] = len(term_ids)
+                posting_docs.append(array('i'))
+                posting_freqs.append(array('i'))
+            posting_docs[term_id].append(doc_id)
+            posting_freqs[term_id].append(freq)
+            forward_terms.append(term_id)
+            forward_freqs.append(freq)
+        forward_offsets.append(len(forward_terms))
+
+    posting_offsets = array('q', [0])
+    for docs in posting_docs:
+        posting_offsets.append(posting_offsets[-1] + len(docs))
+
+    ref_local_ids = []
+    ref_file_ids = array('i')
+    ref_targets = array('i')
+    if refs:
+        doc_ids = {chunk_id: doc_id for doc_id, chunk_id in enumerate(chunk_ids)}
+        for filename, local_id, target_id in refs.items():
+            ref_local_ids.append(local_id)
+            ref_file_ids.append(filename_ids.setdefault(filename, len(filename_ids)))
+            ref_targets.append(doc_ids[target_id])
+
+    sections = {
+        'terms': '\0'.join(term_ids).encode('utf-8'),
+        'posting_offsets': _little_endian(posting_offsets),
+        'posting_docs': b''.join(_little_endian(docs) for docs in posting_docs),
+        'posting_freqs': b''.join(_little_endian(freqs) for freqs in posting_freqs),
+        'chunk_ids': '\0'.join(chunk_ids).encode('utf-8'),
+        'filenames': '\0'.join(filename_ids).encode('utf-8'),
+        'doc_file_ids': _little_endian(doc_file_ids),
+        'doc_lengths': _little_endian(doc_lengths),
+        'text_offsets': _little_endian(text_offsets),
+        'text': bytes(text),
+        'forward_offsets': _little_endian(forward_offsets),
+        'forward_terms': _little_endian(forward_terms),
+        'forward_freqs': _little_endian(forward_freqs),
+        'content_hashes': _little_endian(content_hashes),
+        'simhashes': _little_endian(simhashes),
+        'ref_local_ids': '\0'.join(ref_local_ids).encode('utf-8'),
+        'ref_file_ids': _little_endian(ref_file_ids),
+        'ref_targets': _little_endian(ref_targets),
+        'token_counts': _little_endian(token_counts),
+    }
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(term_ids), len(chunk_ids), total_length))
+        pos = _HEADER.size + _SECTION.size * len(SECTIONS)
+        layout = []
+        for name in SECTIONS:
+            pos += -pos % _ALIGNMENT
+            layout.append((pos, len(sections[name])))
+            pos += len(sections[name])
+        for offset, length in layout:
+            f.write(_SECTION.pack(offset, length))
+        for name, (offset, _) in zip(SECTIONS, layout):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(sections[name])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _little_endian(values):
+    """整数数组按小端序输出为字节串"""
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def read_manifest(index_dir):
+    """读取索引目录的清单文件，不存在时返回None"""
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_manifest(index_dir, manifest):
+    """原子地更新清单文件（先写临时文件再替换）"""
+    manifest = dict(manifest, last_updated=datetime.now().isoformat())
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        # json.dumps 整体走C编码器，清单中记录了大量文件指纹时明显快于逐段写出的 json.dump
+        f.write(json.dumps(manifest, ensure_ascii=False))
+    os.replace(tmp_path, manifest_path)
+
+
+def remove_index_files(index_dir):
+    """删除索引目录中的清单、段文件和日志（不含子目录），用于索引迁移到新布局之后"""
+    if not os.path.isdir(index_dir):
+        return
+    remove_stale_files(index_dir, {})
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+
+def has_index(index_dir):
+    """索引目录中是否已有索引（单一索引的清单或分片记录）"""
+    return any(os.path.exists(os.path.join(index_dir, name)) for name in (MANIFEST_FILE, SHARDS_FILE))
+
+
+def move_index(source_dir, target_dir, extra=()):
+    """
+    把 source_dir 中的索引（清单、段文件、日志、分片记录和分片子目录，以及 extra 中列出的文件或目录）
+    移动到尚不存在的 target_dir，source_dir 中的其他内容保持不动
+    先逐项移入 target_dir + ".moving"，全部完成后整体改名；中途失败时再次调用会继续未完成的移动
+    :return: 是否移动了索引
+    """
+    staging = target_dir + ".moving"
+    if os.path.exists(target_dir) or not (has_index(source_dir) or os.path.isdir(staging)):
+        return False
+    os.makedirs(staging, exist_ok=True)
+    for name in os.listdir(source_dir):
+        if (name in (MANIFEST_FILE, SHARDS_FILE) or name in extra or name.endswith(('.seg', '.log'))
+                or _SHARD_LAYOUT_DIR.fullmatch(name)):
+            os.replace(os.path.join(source_dir, name), os.path.join(staging, name))
+    os.replace(staging, target_dir)
+    return True
+
+
+def read_shard_count(index_dir):
+    """索引目录当前的分片数，没有分片记录时为1（单一索引）"""
+    path = os.path.join(index_dir, SHARDS_FILE)
+    if not os.path.exists(path):
+        return 1
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)['shard_count']
+
+
+def write_shard_count(index_dir, shard_count):
+    """原子地记录索引目录的分片数，记录写入即完成布局切换"""
+    os.makedirs(index_dir, exist_ok=True)
+    path = os.path.join(index_dir, SHARDS_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'shard_count': shard_count, 'last_updated': datetime.now().isoformat()}, f)
+    os.replace(tmp_path, path)
+
+
+def remove_stale_files(index_dir, manifest):
+    """清理不再被清单引用的段文件和日志文件（Windows下仍被映射的文件会删除失败，下次再清理）"""
+    referenced = {manifest.get('segment')} | set(manifest.get('logs', []))
+    for name in os.listdir(index_dir):
+        if name.endswith(('.seg', '.log')) and name not in referenced:
+            try:
+                os.remove(os.path.join(index_dir, name))
+            except OSError:
+                pass
+
+
+def append_log(log_path, records):
+    """
+    将增删操作以JSON行的形式追加到日志文件，并落盘
+    :param log_path: 日志文件路径
+    :param records: 操作记录列表，如 {'op': 'add', 'chunks': [...]} 或 {'op': 'delete', 'filename': ...}
+    :return: 追加的字节数
+    """
+    data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+    with open(log_path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(data)
+
+
+def read_log(log_path):
+    """按顺序读取日志中的操作记录；进程崩溃导致的末尾残缺行会被忽略"""
+    if not os.path.exists(log_path):
+        return
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"忽略日志中不完整的记录: {log_path}")
+                return
+
+
+def merge_segment(segment_path, log_paths, output_path):
+    """
+    将基础段与其后的日志合并为一个新段，不依赖内存中的索引，可在后台线程中执行
+    增删和去重引用的处理顺序与 DocumentIndex 重放日志时一致
+    :param segment_path: 基础段路径（None表示没有基础段）
+    :param log_paths: 按顺序排列的日志文件路径
+    :param output_path: 新段路径
+    """
+    segment = Segment(segment_path) if segment_path else None
+    try:
+        base = ChunkStore(segment, segment.terms()) if segment else ChunkStore()
+        refs = segment.refs(base.chunk_ids, base.filenames) if segment else ChunkRefs()
+
+        live = {}  # 现存文档块：chunk_id -> (基础段文档ID或日志中的文档块字典, 文件名)
+        file_chunks = defaultdict(set)  # 文件名 -> chunk_id集合
+        for doc_id in base.live_doc_ids():
+            live[base.chunk_ids[doc_id]] = (doc_id, base.filename(doc_id))
+            file_chunks[base.filename(doc_id)].add(base.chunk_ids[doc_id])
+
+        def remove(chunk_id):
+            source, filename = live.pop(chunk_id)
+            file_chunks[filename].discard(chunk_id)
+            transfer = refs.detach(chunk_id)
+            if transfer:
+                new_id, new_filename = transfer
+                live[new_id] = (source, new_filename)
+                file_chunks[new_filename].add(new_id)
+
+        for log_path in log_paths:
+            for record in read_log(log_path):
+                if record['op'] == 'add':
+                    for chunk in record['chunks']:
+                        if chunk['chunk_id'] in live:
+                            remove(chunk['chunk_id'])
+                        live[chunk['chunk_id']] = (chunk, chunk['filename'])
+                        file_chunks[chunk['filename']].add(chunk['chunk_id'])
+                elif record['op'] == 'ref':
+                    refs.add(record['filename'], record['refs'])
+                elif record['op'] == 'delete':
+                    refs.drop_file(record['filename'])
+                    for chunk_id in list(file_chunks.pop(record['filename'], ())):
+                        remove(chunk_id)
+                elif record['op'] == 'remove':
+                    refs.drop_file(record['filename'], record['chunk_ids'])
+                    for chunk_id in record['chunk_ids']:
+                        if chunk_id in file_chunks[record['filename']]:
+                            remove(chunk_id)
+
+        def merged_chunks():
+            for chunk_id, (source, filename) in live.items():
+                chunk = base.chunk(source) if isinstance(source, int) else source
+                if chunk['chunk_id'] != chunk_id or chunk['filename'] != filename:
+                    chunk = dict(chunk, chunk_id=chunk_id, filename=filename)
+                yield chunk
+
+        write_segment(output_path, merged_chunks(), refs)
+    finally:
+        if segment:
+            segment.close()
@@ -0,0 +1,81 @@
+import os
+import re
+import threading
+from collections import Counter
+from functools import lru_cache
+
+import jieba
+
+# 常见中文停用词
+STOP_WORDS = frozenset({
+    '的', '了', '在', '是', '我', '有', '和', '就', '不', '人', '一', '上', '也', '很', '到', '说', '要', '去',
+    '你', '会', '着', '没有', '看', '好', '自己', '这', '那', '什么', '如果', '可以', '但是', '因为', '所以',
+    '这个', '那个', '他们', '我们', '它们', '这些', '那些', '已经', '还是', '只是', '应该', '可能', '或者',
+    '虽然', '然后', '不过', '而且', '因此', '如何', '为什么', '哪里', '什么时候', '怎么样', '比如', '例如',
+    '首先', '其次', '最后', '另外', '此外', '总之', '总的来说'
+})
+
+# 关键词只保留由中英文字母组成的词（同时排除了空白和纯数字）
+KEYWORD_PATTERN = re.compile(r'^[a-zA-Z\u4e00-\u9fa5]+$')
+
+
+class Tokenizer:
+    """共享分词组件：jieba词典在进程内只加载一次，查询的关键词提取结果用LRU缓存"""
+
+    def __init__(self, stop_words=STOP_WORDS, cache_file=None, query_cache_size=4096):
+        """
+        :param stop_words: 停用词集合
+        :param cache_file: 预先序列化的jieba词典缓存文件路径，为空时使用jieba默认的临时目录缓存
+        :param query_cache_size: 查询关键词LRU缓存的容量
+        """
+        self.stop_words = stop_words
+        self._jieba = jieba.dt
+        if cache_file:
+            self._jieba.cache_file = os.path.abspath(cache_file)
+        self._warm_up_thread = None
+        self.query_keywords = lru_cache(maxsize=query_cache_size)(self._query_keywords)
+
+    def warm_up(self, background=False):
+        """
+        预先加载jieba词典，避免第一次查询承担数秒的加载时间
+        :param background: 是否在后台线程中加载
+        """
+        if not background:
+            self._jieba.initialize()
+        elif self._warm_up_thread is None:
+            self._warm_up_thread = threading.Thread(target=self._jieba.initialize, name="jieba-warm-up", daemon=True)
+            self._warm_up_thread.start()
+
+    def tokenize(self, text):
+        """分词并过滤停用词和短词，保留重复词项"""
+        stop_words = self.stop_words
+        is_keyword = KEYWORD_PATTERN.match
+        keywords = []
+        for word in self._jieba.cut(text):
+            word = word.strip()
+            if len(word) >= 2 and word not in stop_words and is_keyword(word):
+                keywords.append(word)
+        return keywords
+
+    def extract_keywords(self, text, top_n=20):
+        """按词频提取前top_n个关键词"""
+        word_count = Counter(self.tokenize(text))
+        return [word for word, count in word_count.most_common(top_n)]
+
+    def _query_keywords(self, query):
+        """查询的关键词（元组，便于缓存共享），通过 self.query_keywords 调用"""
+        return tuple(self.extract_keywords(query))
+
+
+_shared_tokenizer = None
+_shared_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """进程内共享的分词器；可通过 JIEBA_CACHE_FILE 环境变量指定预序列化的词典缓存文件"""
+    global _shared_tokenizer
+    if _shared_tokenizer is None:
+        with _shared_tokenizer_lock:
+            if _shared_tokenizer is None:
+                _shared_tokenizer = Tokenizer(cache_file=os.environ.get("JIEBA_CACHE_FILE"))
+    return _shared_tokenizer
@@ -0,0 +1,394 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from modules.rag_tokenizer import get_tokenizer
+
+VECTOR_FILE = "vectors.f32"  # 连续存放的float32向量矩阵（行优先，无文件头）
+VECTOR_META_FILE = "vectors.json"  # 维度、行数以及行号 -> chunk_id 的映射
+
+
+class Embedder:
+    """文本向量化基类，定义通用接口"""
+
+    name = ""
+
+    def embed(self, texts):
+        """
+        计算一批文本的向量
+        :param texts: 文本列表
+        :return: 形状为 (len(texts), 维度) 的float32矩阵
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+
+class OllamaEmbedder(Embedder):
+    """通过本地Ollama服务计算向量"""
+
+    def __init__(self, host="http://127.0.0.1:11434", model="nomic-embed-text", batch_size=32):
+        """
+        :param host: Ollama服务器地址
+        :param model: 向量模型名称
+        :param batch_size: 每次请求发送的文本数
+        """
+        try:
+            import ollama
+            self.client = ollama.Client(host=host)
+        except ImportError:
+            raise ImportError("请安装ollama包: pip install ollama")
+        self.model = model
+        self.batch_size = batch_size
+        self.name = f"ollama:{model}"
+
+    def embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            response = self.client.embed(model=self.model, input=list(texts[start:start + self.batch_size]))
+            vectors.extend(response['embeddings'])
+        return np.asarray(vectors, dtype=np.float32)
+
+
+class HashEmbedder(Embedder):
+    """
+    确定性的哈希向量化：把分词结果按哈希映射到固定维度并带符号累加
+    不依赖模型服务，结果跨进程稳定，用于测试和基准
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f"hash:{dim}"
+        self.tokenizer = get_tokenizer()
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in self.tokenizer.tokenize(text):
+                digest = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+                matrix[row, digest % self.dim] += 1.0 if (digest >> 63) else -1.0
+        return matrix
+
+
+EMBEDDERS = ("ollama", "hash")
+
+
+# 工厂函数，用于创建向量化实例
+def create_embedder(embedder_type="ollama", **kwargs):
+    """
+    创建文本向量化实例
+    :param embedder_type: 类型，支持"ollama"和"hash"
+    :param kwargs: 其他参数，将传递给相应的构造函数
+    :return: 向量化实例
+    """
+    embedder_type = embedder_type.lower()
+    if embedder_type == "ollama":
+        return OllamaEmbedder(**kwargs)
+    elif embedder_type == "hash":
+        return HashEmbedder(**kwargs)
+    else:
+        raise ValueError(f"不支持的向量化类型: {embedder_type}")
+
+
+def default_embedder():
+    """按环境变量 RAG_EMBEDDING_MODEL（及 OLLAMA_HOST）创建Ollama向量化实例，未设置时不启用向量检索"""
+    model = os.environ.get("RAG_EMBEDDING_MODEL")
+    if not model:
+        return None
+    return OllamaEmbedder(host=os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434"), model=model)
+
+
+def normalize(vectors):
+    """按行做L2归一化，之后内积即余弦相似度"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k_rows(scores, top_k):
+    """从一维得分中选出得分最高的top_k个位置，按得分降序"""
+    if len(scores) > top_k:
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+class IVFIndex:
+    """
+    倒排文件（IVF）近似最近邻索引：用球面k-means把向量分到 nlist 个簇，
+    查询时只扫描与查询最相近的 nprobe 个簇
+    """
+
+    def __init__(self, matrix, live, nlist=None, iterations=8, sample_size=None, seed=0):
+        """
+        :param matrix: 已归一化的向量矩阵
+        :param live: 行是否有效的布尔数组
+        :param nlist: 簇数量，默认约为有效行数的平方根
+        :param iterations: k-means迭代次数
+        :param sample_size: 训练簇中心使用的样本数，默认为每簇64个
+        :param seed: 随机种子，保证结果可复现
+        """
+        rows = np.flatnonzero(live)
+        self.rows = len(matrix)  # 建索引时的总行数，之后追加的行按暴力方式扫描
+        self.nlist = nlist or max(1, int(np.sqrt(len(rows))))
+        rng = np.random.default_rng(seed)
+
+        sample_size = sample_size or self.nlist * 64
+        sample = matrix[np.sort(rng.choice(rows, min(sample_size, len(rows)), replace=False))]
+        centroids = sample[rng.choice(len(sample), self.nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(self.nlist):
+                members = sample[assignment == cluster]
+                if len(members):
+                    centroids[cluster] = members.sum(axis=0)
+            centroids = normalize(centroids)
+        self.centroids = centroids
+
+        # 分块为全部有效行分配簇，避免一次性生成 行数 x 簇数 的大矩阵
+        assignment = np.empty(len(rows), dtype=np.int32)
+        for start in range(0, len(rows), VectorIndex.block_rows):
+            block = rows[start:start + VectorIndex.block_rows]
+            assignment[start:start + len(block)] = np.argmax(matrix[block] @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(self.nlist + 1))
+        self.lists = [rows[order[bounds[i]:bounds[i + 1]]] for i in range(self.nlist)]
+
+    def candidates(self, query, nprobe):
+        """与查询最相近的 nprobe 个簇中的全部行号"""
+        nearest = _top_k_rows(self.centroids @ query, min(nprobe, self.nlist))
+        return np.concatenate([self.lists[cluster] for cluster in nearest])
+
+
+class VectorIndex:
+    """
+    向量索引：向量按行追加到float32矩阵文件中并通过内存映射读取，行号 -> chunk_id 的映射保存在元数据文件中
+    数据量小于 ann_threshold 时分块做矩阵-向量乘法精确检索，超过后使用 IVF 近似检索
+    """
+
+    ann_threshold = 20000  # 有效向量达到该数量时启用IVF
+    nprobe = 8  # IVF查询时扫描的簇数量
+    block_rows = 65536  # 暴力检索每次参与矩阵乘法的行数，限制临时内存
+
+    def __init__(self, index_dir, embedder):
+        """
+        :param index_dir: 向量文件所在目录
+        :param embedder: 向量化实例，其 name 用于判断已有向量是否可以继续使用
+        """
+        self.index_dir = index_dir
+        self.embedder = embedder
+        self.dim = None  # 向量维度，首次添加时确定
+        self.chunk_ids = []  # 行号 -> chunk_id（已删除的为None）
+        self.filenames = []  # 行号 -> 文件名（已删除的为None）
+        self.row_ids = {}  # chunk_id -> 行号
+        self.live = np.zeros(0, dtype=bool)  # 行号 -> 是否有效
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self._ann = None  # IVF索引，查询时按需构建
+        self.load()
+
+    @property
+    def vector_path(self):
+        return os.path.join(self.index_dir, VECTOR_FILE)
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.index_dir, VECTOR_META_FILE)
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.row_ids
+
+    def load(self):
+        """加载元数据并映射向量文件；向量模型变化时丢弃旧向量"""
+        if not os.path.exists(self.meta_path):
+            return
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except Exception as e:
+            print(f"加载向量索引失败: {e}")
+            return
+        if meta.get('embedder') != self.embedder.name:
+            print(f"向量模型已从 {meta.get('embedder')} 变为 {self.embedder.name}，需要重新计算向量")
+            return
+
+        self.dim = meta['dim']
+        self.chunk_ids = meta['chunk_ids']
+        self.filenames = meta['filenames']
+        self.row_ids = {chunk_id: row for row, chunk_id in enumerate(self.chunk_ids) if chunk_id is not None}
+        self.live = np.array([chunk_id is not None for chunk_id in self.chunk_ids], dtype=bool)
+        self._map_matrix()
+
+    def _map_matrix(self):
+        """按元数据中的行数映射向量文件（文件末尾未写入元数据的行会被忽略）"""
+        rows = len(self.chunk_ids)
+        if rows and self.dim:
+            self.matrix = np.memmap(self.vector_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+        else:
+            self.matrix = np.zeros((0, self.dim or 0), dtype=np.float32)
+
+    def add(self, chunks, vectors):
+        """
+        添加文档块向量，同ID的旧向量会被替换（调用save后写入元数据）
+        :param chunks: 文档块列表
+        :param vectors: 与文档块一一对应的向量矩阵
+        """
+        vectors = normalize(vectors)
+        if not len(vectors):
+            return
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"向量维度不一致: {vectors.shape[1]} != {self.dim}")
+
+        for chunk in chunks:
+            self._remove_row(self.row_ids.get(chunk['chunk_id']))
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._truncate_unreferenced_rows()
+        with open(self.vector_path, 'ab') as f:
+            f.write(vectors.tobytes())
+
+        first_row = len(self.chunk_ids)
+        for offset, chunk in enumerate(chunks):
+            self.row_ids[chunk['chunk_id']] = first_row + offset
+            self.chunk_ids.append(chunk['chunk_id'])
+            self.filenames.append(chunk['filename'])
+        self.live = np.concatenate([self.live, np.ones(len(chunks), dtype=bool)])
+        self._map_matrix()
+
+    def _truncate_unreferenced_rows(self):
+        """上次写入向量后没来得及保存元数据时，向量文件末尾会多出若干行，追加前先截掉"""
+        expected = len(self.chunk_ids) * (self.dim or 0) * 4
+        if os.path.exists(self.vector_path) and os.path.getsize(self.vector_path) > expected:
+            self.matrix = np.zeros((0, self.dim), dtype=np.float32)  # 先释放映射，Windows下才能截断
+            with open(self.vector_path, 'r+b') as f:
+                f.truncate(expected)
+
+    def _remove_row(self, row):
+        if row is None:
+            return
+        del self.row_ids[self.chunk_ids[row]]
+        self.chunk_ids[row] = None
+        self.filenames[row] = None
+        self.live[row] = False
+
+    def rename(self, old_id, new_id, filename):
+        """文档块转交给其他文件后改用新的chunk_id和文件名，向量保持不变"""
+        row = self.row_ids.pop(old_id, None)
+        if row is None:
+            return
+        self.row_ids[new_id] = row
+        self.chunk_ids[row] = new_id
+        self.filenames[row] = filename
+
+    def remove_chunks(self, chunk_ids):
+        """删除指定文档块的向量"""
+        for chunk_id in chunk_ids:
+            self._remove_row(self.row_ids.get(chunk_id))
+
+    def delete_document(self, filename):
+        """删除指定文件的所有向量"""
+        for row, row_filename in enumerate(self.filenames):
+            if row_filename == filename:
+                self._remove_row(row)
+
+    def save(self):
+        """写入元数据；已删除的行超过一半时重写向量文件以回收空间"""
+        if self.dim is None:
+            return
+        dead_rows = len(self.chunk_ids) - len(self.row_ids)
+        if dead_rows > len(self.row_ids) and dead_rows >= 1024:
+            self._rewrite()
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'embedder': self.embedder.name, 'dim': self.dim,
+                       'chunk_ids': self.chunk_ids, 'filenames': self.filenames}, f, ensure_ascii=False)
+        os.replace(temp_path, self.meta_path)
+
+    def _rewrite(self):
+        """只保留有效行重写向量文件，行号随之重新编排"""
+        rows = np.flatnonzero(self.live)
+        temp_path = self.vector_path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            for start in range(0, len(rows), self.block_rows):
+                f.write(np.ascontiguousarray(self.matrix[rows[start:start + self.block_rows]]).tobytes())
+        self.matrix = np.zeros((0, self.dim), dtype=np.float32)  # 释放旧映射后再替换文件
+        os.replace(temp_path, self.vector_path)
+
+        self.chunk_ids = [self.chunk_ids[row] for row in rows]
+        self.filenames = [self.filenames[row] for row in rows]
+        self.row_ids = {chunk_id: row for row, chunk_id in enumerate(self.chunk_ids)}
+        self.live = np.ones(len(rows), dtype=bool)
+        self._ann = None
+        self._map_matrix()
+
+    def _ann_index(self):
+        """有效向量达到阈值时返回IVF索引；建索引后新增的行超过一半时重建"""
+        if len(self.row_ids) < self.ann_threshold:
+            return None
+        if self._ann is None or len(self.chunk_ids) - self._ann.rows > self._ann.rows // 2:
+            self._ann = IVFIndex(self.matrix, self.live)
+        return self._ann
+
+    def _scan(self, queries, rows, top_k):
+        """对给定行（None表示全部行）分块计算内积，返回每个查询的 [(行号, 得分)]"""
+        total = len(self.chunk_ids) if rows is None else len(rows)
+        best = [([], []) for _ in range(len(queries))]
+        for start in range(0, total, self.block_rows):
+            if rows is None:
+                block = np.arange(start, min(start + self.block_rows, total))
+                scores = self.matrix[start:start + len(block)] @ queries.T
+            else:
+                block = rows[start:start + self.block_rows]
+                scores = self.matrix[block] @ queries.T
+            scores[~self.live[block]] = -np.inf
+            for query_index in range(len(queries)):
+                top = _top_k_rows(scores[:, query_index], top_k)
+                best[query_index][0].append(block[top])
+                best[query_index][1].append(scores[top, query_index])
+
+        results = []
+        for block_rows, block_scores in best:
+            if not block_rows:
+                results.append([])
+                continue
+            rows_found = np.concatenate(block_rows)
+            scores = np.concatenate(block_scores)
+            top = _top_k_rows(scores, top_k)
+            results.append([(int(rows_found[i]), float(scores[i])) for i in top if np.isfinite(scores[i])])
+        return results
+
+    def search_many(self, query_vectors, top_k=5):
+        """
+        批量向量检索
+        :param query_vectors: 查询向量矩阵
+        :param top_k: 每个查询返回的结果数量
+        :return: 每个查询的 [(chunk_id, 余弦相似度)]，按相似度降序
+        """
+        if not self.row_ids:
+            return [[] for _ in range(len(query_vectors))]
+        queries = normalize(query_vectors)
+
+        ann = self._ann_index()
+        if ann is None:
+            matches = self._scan(queries, None, top_k)
+        else:
+            # 只扫描最相近的簇，加上建索引之后追加的行
+            tail = np.arange(ann.rows, len(self.chunk_ids))
+            matches = []
+            for query in queries:
+                rows = np.concatenate([ann.candidates(query, self.nprobe), tail])
+                matches.extend(self._scan(query[None, :], rows, top_k))
+
+        return [[(self.chunk_ids[row], score) for row, score in query_matches] for query_matches in matches]
+
+    def search(self, query_vector, top_k=5):
+        """检索与单个查询向量最相似的文档块，返回 [(chunk_id, 余弦相似度)]"""
+        return self.search_many(np.asarray(query_vector, dtype=np.float32)[None, :], top_k)[0]
@@ -1,12 +1,10 @@
 import streamlit as st
-from modules.rag_module import show_rag_management, RAGSystem
-from modules.enhanced_conversation_display import (
-    display_rag_enhanced_conversation,
-    show_rag_debug_info
+from modules.rag_module import (
+    show_rag_management, get_shared_rag_system, search_session_documents, session_user_id, show_user_login
 )
-from modules.file_processing import get_file_content
-from modules.history_module import show_conversation_history
-from modules.model_service import create_model_service, ModelService, QianfanModelService
+from modules.enhanced_conversation_display import show_rag_debug_info
+from modules.model_service import create_model_service
+from modules.model_cache import CachedModelService, default_response_cache
 import os
 
 # 页面配置
@@ -48,8 +46,11 @@ def init_session_state():
     if "use_rag" not in st.session_state:
         st.session_state["use_rag"] = False
 
+    if "rag_collection" not in st.session_state:
+        st.session_state["rag_collection"] = "default"
+
     if "rag_system" not in st.session_state:
-        st.session_state["rag_system"] = RAGSystem()
+        st.session_state["rag_system"] = get_shared_rag_system(session_user_id(), st.session_state["rag_collection"])
 
     if "show_rag_debug" not in st.session_state:
         st.session_state["show_rag_debug"] = False
@@ -64,7 +65,7 @@ def init_session_state():
         st.session_state["selected_model"] = ""
 
     if "use_stream" not in st.session_state:
-        st.session_state["use_stream"] = False
+        st.session_state["use_stream"] = True
 
     if "maxHistoryMessages" not in st.session_state:
         st.session_state["maxHistoryMessages"] = 10
@@ -95,11 +96,11 @@ def init_model_service():
                 st.error("请设置千帆授权令牌")
                 return None
 
-            st.session_state["model_service"] = create_model_service(
+            st.session_state["model_service"] = CachedModelService(create_model_service(
                 "qianfan",
                 authorization=authorization,
                 model=model
-            )
+            ), default_response_cache())
 
 
 
@@ -168,7 +169,8 @@ def show_model_service_config():
 
                         if "choices" in response and len(response["choices"]) > 0:
                             st.success("✅ 千帆服务连接成功！")
-                            st.session_state["model_service"] = service
+                            # 连接测试本身不走缓存，测试通过后保存带缓存的服务
+                            st.session_state["model_service"] = CachedModelService(service, default_response_cache())
                             st.write(f"测试回复: {response['choices'][0]['message']['content']}")
                         else:
                             st.error("❌ 千帆服务响应格式错误")
@@ -237,7 +239,8 @@ def test_rag_system():
 
                     if relevant_chunks:
                         # 生成RAG增强的提示词
-                        enhanced_prompt = rag_system.generate_rag_prompt(test_query, relevant_chunks)
+                        enhanced_prompt = rag_system.generate_rag_prompt(test_query, relevant_chunks,
+                                                                         model=st.session_state["model_service"].model)
 
                         # 构建消息
                         messages = [{"role": "user", "content": enhanced_prompt}]
@@ -289,6 +292,18 @@ def show_system_status():
 
         st.json(service_status)
 
+        # 温度为0的聊天和文档提取结果会被缓存
+        cache_stats = default_response_cache().stats()
+        st.write("**响应缓存:**")
+        st.json({
+            "命中率": f"{cache_stats['hit_rate']:.1%}",
+            "命中次数": cache_stats['hits'],
+            "语义命中次数": cache_stats['semantic_hits'],
+            "未命中次数": cache_stats['misses'],
+            "节省token数": cache_stats['saved_tokens'],
+            "持久化条目数": cache_stats['stored']
+        })
+
     # RAG系统状态
     with col2:
         if 'rag_system' in st.session_state:
@@ -333,10 +348,11 @@ def chat_with_model_service(prompt):
         if use_rag and 'rag_system' in st.session_state:
             with st.spinner("正在搜索相关文档..."):
                 rag_system = st.session_state.rag_system
-                relevant_chunks = rag_system.search_documents(prompt, top_k=st.session_state.get('top_k', 3))
+                relevant_chunks = search_session_documents(prompt, top_k=st.session_state.get('top_k', 3))
 
                 if relevant_chunks:
-                    prompt = rag_system.generate_rag_prompt(prompt, relevant_chunks)
+                    prompt = rag_system.generate_rag_prompt(prompt, relevant_chunks,
+                                                            model=st.session_state["model_service"].model)
                     st.info(f"🔍 找到 {len(relevant_chunks)} 个相关文档片段")
 
         # 处理文件内容
@@ -391,6 +407,10 @@ def main():
         if st.button("← 返回主界面"):
             st.session_state.clear()
             st.switch_page("chatting_test.py")  # 跳回主页面
+        # 用户登录，文档集合按登录用户隔离
+        st.subheader("👤 用户")
+        show_user_login()
+        st.divider()
         # 模型服务配置
         show_model_service_config()
 
@@ -406,7 +426,11 @@ def main():
             help="较低值使回答更确定，较高值使回答更有创造性"
         )
 
-        st.session_state["use_stream"] = False
+        st.session_state["use_stream"] = st.checkbox(
+            "流式输出",
+            value=st.session_state["use_stream"],
+            help="边生成边显示回答，无需等待整个回答生成完毕"
+        )
 
         st.session_state["maxHistoryMessages"] = st.slider(
             "历史消息数量",
@@ -478,12 +502,13 @@ def main():
         test_query = st.chat_input("输入你的问题...")
         if test_query:
             try:
-                # 搜索相关文档
-                relevant_chunks = rag_system.search_documents(test_query, top_k=3)
+                # 在本会话选择的集合中搜索相关文档
+                relevant_chunks = search_session_documents(test_query, top_k=3)
 
                 if relevant_chunks:
                     # 生成RAG增强的提示词
-                    enhanced_prompt = rag_system.generate_rag_prompt(test_query, relevant_chunks)
+                    enhanced_prompt = rag_system.generate_rag_prompt(test_query, relevant_chunks,
+                                                                     model=st.session_state["model_service"].model)
 
                     # 构建消息
                     # 添加用户消息（仅显示提问部分）
@@ -500,13 +525,27 @@ def main():
                         st.chat_message(message["role"]).markdown(content)
 
                     # 使用模型服务生成回答
-                    response = st.session_state["model_service"].chat(st.session_state["message"])
-
-                    if "choices" in response and len(response["choices"]) > 0:
-                        answer = response["choices"][0]["message"]["content"]
-                        st.success("✅ RAG增强回答生成成功！")
-                        st.write("**回答:**")
-                        st.write(answer)
+                    use_stream = st.session_state["use_stream"]
+                    response = st.session_state["model_service"].chat(st.session_state["message"],
+                                                                      temperature=st.session_state["temperature"],
+                                                                      stream=use_stream)
+
+                    if use_stream or ("choices" in response and len(response["choices"]) > 0):
+                        if use_stream:
+                            # 千帆和Ollama的流式响应都是 {"message": {"content": 增量文本}} 结构的增量消息
+                            st.write("**回答:**")
+                            answer = ""
+                            answer_placeholder = st.empty()
+                            for chunk in response:
+                                if chunk.get("message"):
+                                    answer += chunk["message"]["content"]
+                                    answer_placeholder.markdown(answer)
+                            st.success("✅ RAG增强回答生成成功！")
+                        else:
+                            answer = response["choices"][0]["message"]["content"]
+                            st.success("✅ RAG增强回答生成成功！")
+                            st.write("**回答:**")
+                            st.write(answer)
 
                         assistant_message = {"role": "assistant", "content": answer}
                         st.session_state["message"].append(assistant_message)
@@ -566,10 +605,52 @@ def main():
             st.session_state['chunk_size'] = new_chunk_size
             st.session_state['top_k'] = new_top_k
 
-            # 更新RAG系统参数
-            if 'rag_system' in st.session_state:
-                st.session_state.rag_system.processor.chunk_size = new_chunk_size
-                st.info("参数已更新，建议重新处理文档以获得最佳效果")
+            # RAG系统在所有会话间共享，参数只记录在本会话中，处理文档时按本会话的分块大小分块
+            st.info("参数已更新，建议重新处理文档以获得最佳效果")
+
+        # 索引分片：由所有会话共享，调整后立即迁移现有文档块
+        rag_system = st.session_state.rag_system
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            new_shards = st.number_input(
+                "索引分片数",
+                min_value=1,
+                max_value=64,
+                value=rag_system.shard_count,
+                help="文档块按文件分到多个分片，检索时各分片并行查询；适合百万级文档块的语料，小语料保持1即可"
+            )
+        with col2:
+            if new_shards != rag_system.shard_count and st.button("🔀 重新分片"):
+                with st.spinner("正在迁移索引..."):
+                    st.success(rag_system.reshard(int(new_shards)))
+
+        # 检索方式：配置了向量模型（RAG_EMBEDDING_MODEL）时才可选择向量检索
+        if st.session_state.rag_system.vector_index is not None:
+            retrievers = {"keyword": "关键词检索", "vector": "向量检索", "hybrid": "混合检索"}
+            st.session_state['retriever'] = st.selectbox(
+                "检索方式",
+                options=list(retrievers),
+                format_func=retrievers.get,
+                index=list(retrievers).index(st.session_state.get('retriever', 'keyword')),
+                help="向量检索使用本地Ollama向量模型计算语义相似度；混合检索同时使用两者并融合结果"
+            )
+
+            if st.session_state['retriever'] == "hybrid":
+                col1, col2 = st.columns(2)
+                with col1:
+                    fusions = {"rrf": "倒数排名融合 (RRF)", "weighted": "加权融合"}
+                    st.session_state['fusion'] = st.selectbox(
+                        "融合方式",
+                        options=list(fusions),
+                        format_func=fusions.get,
+                        index=list(fusions).index(st.session_state.get('fusion', 'rrf'))
+                    )
+                with col2:
+                    st.session_state['rerank'] = st.checkbox(
+                        "重排序",
+                        value=st.session_state.get('rerank', False),
+                        help="对融合后的候选结果按查询词覆盖率重新排序"
+                    )
 
     with tab3:
 
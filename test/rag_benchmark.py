@@ -0,0 +1,478 @@
+"""
+RAG检索基准测试脚本
+scoring：比较不同打分引擎的查询延迟和排序质量
+load：比较旧版JSON索引与二进制段索引在不同语料规模下的加载耗时和内存占用
+query：测量首次查询（冷启动/预热）和稳态查询（有/无分词缓存）的延迟
+suite：完整评测，在1k/10k/100k规模的合成语料上测量入库吞吐、磁盘与内存占用、加载耗时、
+       查询延迟分位数和带标注查询集上的recall@k，结果写成JSON，便于比较不同引擎、发现性能回退
+
+用法：
+python test/rag_benchmark.py scoring --chunks 5000 --queries 200
+python test/rag_benchmark.py load --sizes 1000 10000 50000
+python test/rag_benchmark.py query --chunks 5000
+python test/rag_benchmark.py suite --sizes 1000 10000 100000 --output rag_bench.json
+python test/rag_benchmark.py suite --sizes 1000 --embedder hash --retrievers keyword vector hybrid
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.rag_module import DocumentIndex, DocumentProcessor, RAGSystem, UploadedBytes, create_ingest_pool
+from modules.rag_scoring import SCORING_ENGINES
+from modules.rag_tokenizer import get_tokenizer
+from modules.rag_vector import HashEmbedder
+
+# 通用词汇：构成文档块的背景噪声
+GENERAL_WORDS = [
+    "系统", "用户", "功能", "问题", "方法", "数据", "信息", "服务", "管理", "工作",
+    "时间", "技术", "产品", "市场", "企业", "发展", "研究", "设计", "质量", "标准",
+    "过程", "结果", "需求", "项目", "团队", "计划", "目标", "方案", "环境", "资源",
+    "能力", "经验", "效果", "成本", "价格", "客户", "平台", "模式", "规则", "流程",
+    "内容", "结构", "变化", "影响", "原因", "条件", "方式", "部分", "阶段", "水平",
+]
+
+# 主题词汇：每个主题有一组区分度较高的词
+TOPIC_WORDS = [
+    ["机器学习", "神经网络", "训练", "模型", "梯度", "参数", "样本", "特征"],
+    ["投影仪", "亮度", "分辨率", "画面", "镜头", "对焦", "幕布", "色彩"],
+    ["数据库", "索引", "事务", "查询", "存储", "表格", "主键", "备份"],
+    ["咖啡", "烘焙", "豆子", "研磨", "萃取", "口感", "酸度", "风味"],
+    ["足球", "比赛", "球员", "教练", "进球", "联赛", "战术", "球迷"],
+    ["股票", "基金", "收益", "风险", "投资", "利率", "债券", "账户"],
+    ["手机", "电池", "屏幕", "芯片", "相机", "续航", "充电", "内存"],
+    ["医院", "医生", "患者", "药物", "治疗", "症状", "手术", "护士"],
+    ["旅游", "酒店", "景点", "门票", "航班", "签证", "行程", "导游"],
+    ["汽车", "发动机", "油耗", "轮胎", "底盘", "变速箱", "驾驶", "刹车"],
+    ["教育", "学生", "老师", "课程", "考试", "学校", "作业", "成绩"],
+    ["天气", "气温", "降雨", "台风", "湿度", "气象", "预报", "寒潮"],
+]
+
+
+def generate_corpus(chunk_count, seed=42):
+    """
+    生成合成中文语料，每个文件恰好对应一个文档块
+    :return: [(文件名, 文本, 主题编号)]
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(chunk_count):
+        topic = rng.randrange(len(TOPIC_WORDS))
+        words = rng.choices(GENERAL_WORDS, k=rng.randint(12, 30))
+        words += rng.choices(TOPIC_WORDS[topic], k=rng.randint(2, 8))
+        rng.shuffle(words)
+        corpus.append((f"doc_{i}.txt", "，".join(words) + "。", topic))
+    return corpus
+
+
+def generate_queries(query_count, seed=7):
+    """
+    生成带主题标签的查询
+    :return: [(查询文本, 查询主题词集合)]
+    """
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(query_count):
+        topic = rng.randrange(len(TOPIC_WORDS))
+        topic_terms = rng.sample(TOPIC_WORDS[topic], 2)
+        words = topic_terms + rng.sample(GENERAL_WORDS, 1)
+        queries.append(("，".join(words), set(topic_terms)))
+    return queries
+
+
+def relevance_labels(index, topic_terms):
+    """文档块包含的查询主题词越多相关度越高，未包含任何主题词的视为不相关"""
+    labels = {}
+    for chunk_id, chunk in index.document_chunks.items():
+        grade = sum(1 for term in topic_terms if term in chunk['term_freqs'])
+        if grade:
+            labels[chunk_id] = grade
+    return labels
+
+
+def ndcg_at_k(ranked_ids, labels, k):
+    """计算nDCG@k"""
+    dcg = sum(labels.get(chunk_id, 0) / math.log2(rank + 2) for rank, chunk_id in enumerate(ranked_ids[:k]))
+    ideal = sorted(labels.values(), reverse=True)[:k]
+    idcg = sum(grade / math.log2(rank + 2) for rank, grade in enumerate(ideal))
+    return dcg / idcg if idcg else 0.0
+
+
+def percentile(values, pct):
+    """计算百分位数"""
+    ordered = sorted(values)
+    pos = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[pos]
+
+
+def build_index(corpus, index_dir):
+    """用合成语料构建索引（仅在内存中，不写盘）"""
+    processor = DocumentProcessor()
+    index = DocumentIndex(index_dir, legacy_file=None)
+    for filename, text, _ in corpus:
+        index.add_document_chunks(processor.split_document(text, filename))
+    return index
+
+
+def benchmark_engines(index, queries, top_k=10, engines=SCORING_ENGINES):
+    """
+    对每个打分引擎测量查询延迟与排序质量
+    :return: 引擎名 -> 指标字典
+    """
+    labeled = [(query, relevance_labels(index, terms)) for query, terms in queries]
+    results = {}
+    for engine in engines:
+        latencies = []
+        ndcg_total = 0.0
+        precision_total = 0.0
+        for query, labels in labeled:
+            start = time.perf_counter()
+            hits = index.search_by_keywords(query, top_k, engine=engine)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+            ranked_ids = [hit['chunk_id'] for hit in hits]
+            ndcg_total += ndcg_at_k(ranked_ids, labels, top_k)
+            # 同时包含两个查询主题词的文档块视为强相关
+            precision_total += sum(1 for chunk_id in ranked_ids if labels.get(chunk_id, 0) >= 2) / top_k
+
+        results[engine] = {
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "mean_ms": sum(latencies) / len(latencies),
+            f"ndcg@{top_k}": ndcg_total / len(labeled),
+            f"precision@{top_k}": precision_total / len(labeled),
+        }
+    return results
+
+
+def write_legacy_json(index, json_file):
+    """按旧版格式（含keyword_index、indent=2）写出JSON索引，作为加载基准的对照"""
+    document_chunks = {}
+    keyword_index = defaultdict(list)
+    for chunk_id in index.document_chunks:
+        chunk = index.document_chunks[chunk_id]
+        document_chunks[chunk_id] = {key: chunk[key] for key in ('chunk_id', 'filename', 'content', 'keywords')}
+        for keyword in chunk['keywords']:
+            keyword_index[keyword].append({'chunk_id': chunk_id, 'filename': chunk['filename'], 'relevance': 1})
+    with open(json_file, 'w', encoding='utf-8') as f:
+        json.dump({'keyword_index': keyword_index, 'document_chunks': document_chunks}, f,
+                  ensure_ascii=False, indent=2)
+
+
+def measure(func):
+    """测量函数的耗时（秒）与Python堆内存峰值（MB），mmap映射的页不计入"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1024 / 1024
+
+
+def run_scoring(args):
+    """打分引擎基准"""
+    corpus = generate_corpus(args.chunks)
+    queries = generate_queries(args.queries)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        index = build_index(corpus, tmp_dir)
+        print(f"构建索引: {args.chunks} 个文档块, 耗时 {time.perf_counter() - start:.2f}s")
+
+        # 预热：触发jieba词典加载和IDF表计算
+        index.search_by_keywords(queries[0][0])
+
+        results = benchmark_engines(index, queries, args.top_k)
+
+    for engine, metrics in results.items():
+        print(f"\n引擎: {engine}")
+        for name, value in metrics.items():
+            print(f"  {name}: {value:.4f}")
+
+
+def run_load(args):
+    """索引加载基准"""
+    queries = generate_queries(20)
+    print(f"{'规模':>8} {'格式':>8} {'文件MB':>8} {'加载s':>8} {'内存MB':>8} {'首查ms':>8}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_dir = os.path.join(tmp_dir, "rag_index")
+            json_file = os.path.join(tmp_dir, "document_index.json")
+            index = build_index(generate_corpus(size), index_dir)
+            write_legacy_json(index, json_file)
+            index.compact()
+            segment_size = os.path.getsize(index.segment.path)
+            del index
+
+            def load_json():
+                legacy = DocumentIndex(os.path.join(tmp_dir, "empty"), legacy_file=None)
+                legacy.load_json_index(json_file)
+                return legacy
+
+            for name, loader, file_size in (
+                    ("json", load_json, os.path.getsize(json_file)),
+                    ("segment", lambda: DocumentIndex(index_dir, legacy_file=None), segment_size)):
+                loaded, elapsed, peak = measure(loader)
+                start = time.perf_counter()
+                loaded.search_by_keywords(queries[0][0])
+                first_query = (time.perf_counter() - start) * 1000
+                print(f"{size:>8} {name:>8} {file_size / 1024 / 1024:>8.2f} {elapsed:>8.3f} {peak:>8.2f} "
+                      f"{first_query:>8.2f}")
+                del loaded
+
+
+# 在新进程中测量第一次查询的耗时，argv[1] 为索引目录，argv[2] 为是否预热
+FIRST_QUERY_SCRIPT = """
+import sys, time
+from modules.rag_module import DocumentIndex
+from modules.rag_tokenizer import get_tokenizer
+index = DocumentIndex(sys.argv[1], legacy_file=None)
+if sys.argv[2] == "warm":
+    get_tokenizer().warm_up()
+start = time.perf_counter()
+index.search_by_keywords("咖啡，烘焙，系统")
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def run_query(args):
+    """首次查询与稳态查询延迟"""
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    queries = generate_queries(args.queries)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = build_index(generate_corpus(args.chunks), tmp_dir)
+        index.compact()
+
+        for mode in ("cold", "warm"):
+            output = subprocess.run(
+                [sys.executable, "-c", FIRST_QUERY_SCRIPT, tmp_dir, mode],
+                cwd=project_dir, capture_output=True, text=True, check=True
+            ).stdout
+            print(f"首次查询({mode}): {float(output.strip().splitlines()[-1]):.2f} ms")
+
+        tokenizer = get_tokenizer()
+        for name, clear_cache in (("无分词缓存", True), ("LRU分词缓存", False)):
+            latencies = []
+            for _ in range(args.rounds):
+                for query, _ in queries:
+                    if clear_cache:
+                        tokenizer.query_keywords.cache_clear()
+                    start = time.perf_counter()
+                    index.search_by_keywords(query, 10)
+                    latencies.append((time.perf_counter() - start) * 1000)
+            print(f"稳态查询({name}): p50 {percentile(latencies, 50):.3f} ms, p95 {percentile(latencies, 95):.3f} ms")
+
+
+def topic_postings(corpus):
+    """主题词 -> 包含该词的文件名集合，作为查询集的标注"""
+    postings = defaultdict(set)
+    for filename, text, topic in corpus:
+        for term in TOPIC_WORDS[topic]:
+            if term in text:
+                postings[term].add(filename)
+    return postings
+
+
+def recall_at_k(ranked_ids, relevant, k):
+    """recall@k：前k个结果覆盖的相关文档比例，相关文档多于k个时以k为分母"""
+    if not relevant:
+        return None
+    return len(set(ranked_ids[:k]) & relevant) / min(k, len(relevant))
+
+
+def directory_size(path):
+    """目录下所有文件的字节数"""
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+# 在新进程中测量索引加载：输出加载耗时、Python堆内存和常驻内存增量（JSON）
+LOAD_SCRIPT = """
+import json, sys, time, tracemalloc
+def rss():
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS'))
+    except OSError:
+        return None
+from modules.rag_module import open_index
+before = rss()
+tracemalloc.start()
+start = time.perf_counter()
+index = open_index(sys.argv[1])
+elapsed = time.perf_counter() - start
+heap = tracemalloc.get_traced_memory()[0]
+tracemalloc.stop()
+after = rss()
+print(json.dumps({'load_s': elapsed, 'heap_bytes': heap,
+                  'rss_bytes': after - before if before is not None else None}))
+"""
+
+
+def ingest_corpus(rag, corpus, workers, batch_files=2000):
+    """通过 add_documents 批量入库，返回耗时（秒）"""
+    files = [UploadedBytes(text.encode('utf-8'), filename, 'text/plain') for filename, text, _ in corpus]
+    start = time.perf_counter()
+    if workers == 1:
+        for i in range(0, len(files), batch_files):
+            rag.add_documents(files[i:i + batch_files], max_workers=1)
+    else:
+        with create_ingest_pool(workers) as pool:
+            for i in range(0, len(files), batch_files):
+                rag.add_documents(files[i:i + batch_files], executor=pool)
+    return time.perf_counter() - start
+
+
+def evaluate_queries(rag, queries, postings, top_k, retriever, engine):
+    """逐个查询测量延迟和recall@k（每次查询前清空结果缓存，测的是实际检索）"""
+    latencies = []
+    recalls = []
+    for query, topic_terms in queries:
+        rag.query_cache.clear()
+        start = time.perf_counter()
+        hits = rag.search_documents(query, top_k=top_k, engine=engine, retriever=retriever)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        # 同时包含两个查询主题词的文档视为相关
+        relevant = set.intersection(*(postings.get(term, set()) for term in topic_terms))
+        recall = recall_at_k([hit['filename'] for hit in hits], relevant, top_k)
+        if recall is not None:
+            recalls.append(recall)
+    return {
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies),
+        f'recall@{top_k}': sum(recalls) / len(recalls) if recalls else None,
+        'labeled_queries': len(recalls),
+    }
+
+
+def run_suite_size(size, args, tmp_dir):
+    """在一个语料规模上执行完整评测"""
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    index_dir = os.path.join(tmp_dir, f"index_{size}")
+    corpus = generate_corpus(size)
+    queries = generate_queries(args.queries)
+    embedder = HashEmbedder() if args.embedder == "hash" else None
+    rag = RAGSystem(index_dir=index_dir, embedder=embedder, shards=args.shards)
+
+    ingest_s = ingest_corpus(rag, corpus, args.workers)
+    rag.index.compact()
+    result = {
+        'chunks': rag.index.live_chunk_count(),
+        'ingest_s': ingest_s,
+        'ingest_chunks_per_s': size / ingest_s,
+        'disk_bytes': directory_size(index_dir),
+    }
+
+    env = dict(os.environ, PYTHONPATH=project_dir)
+    output = subprocess.run([sys.executable, "-c", LOAD_SCRIPT, index_dir], cwd=tmp_dir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    result.update(json.loads(output.strip().splitlines()[-1]))
+
+    # 预热：触发分词器和IDF表计算
+    rag.search_documents(queries[0][0])
+    postings = topic_postings(corpus)
+    result['queries'] = {}
+    for retriever in args.retrievers:
+        if retriever != "keyword" and rag.vector_index is None:
+            continue
+        # 向量检索与打分引擎无关，只测一次
+        for engine in (args.engines if retriever != "vector" else args.engines[:1]):
+            name = retriever if retriever == "vector" else f"{retriever}:{engine}"
+            result['queries'][name] = evaluate_queries(rag, queries, postings, args.top_k, retriever, engine)
+    return result
+
+
+def run_suite(args):
+    """完整评测，结果以JSON输出"""
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=project_dir,
+                            capture_output=True, text=True).stdout.strip()
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {'queries': args.queries, 'top_k': args.top_k, 'workers': args.workers, 'shards': args.shards,
+                   'embedder': args.embedder, 'engines': args.engines, 'retrievers': args.retrievers},
+        'sizes': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # 在临时目录中运行，避免当前目录下的旧版JSON索引被当作迁移来源
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            for size in args.sizes:
+                result = run_suite_size(size, args, tmp_dir)
+                report['sizes'][str(size)] = result
+                print(f"规模 {size}: 入库 {result['ingest_chunks_per_s']:.0f} 块/s, "
+                      f"磁盘 {result['disk_bytes'] / 1024 / 1024:.2f} MB, 加载 {result['load_s']:.3f}s, "
+                      f"堆内存 {result['heap_bytes'] / 1024 / 1024:.2f} MB", file=sys.stderr)
+                for name, metrics in result['queries'].items():
+                    recall = metrics[f'recall@{args.top_k}']
+                    print(f"  {name:<16} p50 {metrics['p50_ms']:.2f} ms, p95 {metrics['p95_ms']:.2f} ms, "
+                          f"p99 {metrics['p99_ms']:.2f} ms, recall@{args.top_k} "
+                          f"{'-' if recall is None else f'{recall:.3f}'}", file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG检索基准测试")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    scoring = subparsers.add_parser("scoring", help="打分引擎的延迟与排序质量")
+    scoring.add_argument("--chunks", type=int, default=5000, help="合成语料的文档块数量")
+    scoring.add_argument("--queries", type=int, default=200, help="查询数量")
+    scoring.add_argument("--top-k", type=int, default=10, help="每次查询返回的文档块数量")
+    scoring.set_defaults(func=run_scoring)
+
+    load = subparsers.add_parser("load", help="索引加载耗时与内存占用")
+    load.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="语料规模（文档块数量）")
+    load.set_defaults(func=run_load)
+
+    query = subparsers.add_parser("query", help="首次查询与稳态查询延迟")
+    query.add_argument("--chunks", type=int, default=5000, help="合成语料的文档块数量")
+    query.add_argument("--queries", type=int, default=100, help="不同查询的数量")
+    query.add_argument("--rounds", type=int, default=5, help="每个查询重复的轮数")
+    query.set_defaults(func=run_query)
+
+    suite = subparsers.add_parser("suite", help="完整评测（吞吐、容量、加载、延迟分位数、recall@k），输出JSON")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="语料规模（文档块数量）")
+    suite.add_argument("--queries", type=int, default=200, help="带标注的查询数量")
+    suite.add_argument("--top-k", type=int, default=10, help="每次查询返回的文档块数量")
+    suite.add_argument("--workers", type=int, default=1, help="入库进程数，1表示在当前进程中处理")
+    suite.add_argument("--shards", type=int, default=1, help="索引分片数")
+    suite.add_argument("--engines", nargs="+", default=list(SCORING_ENGINES), help="参与比较的打分引擎")
+    suite.add_argument("--retrievers", nargs="+", default=["keyword"], choices=RAGSystem.RETRIEVERS,
+                       help="参与比较的检索方式，vector/hybrid 需要 --embedder hash")
+    suite.add_argument("--embedder", choices=["none", "hash"], default="none",
+                       help="向量化方式：hash 为不依赖模型服务的确定性哈希向量")
+    suite.add_argument("--output", help="结果JSON文件路径，为空时输出到标准输出（进度输出到标准错误）")
+    suite.set_defaults(func=run_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+RAG文档更新检查脚本
+检查 RAGSystem.add_document 在重新上传已入库文件时的行为：
+读取中途失败时旧版本保持不变（文档块数量、关键词检索和向量检索结果都与失败前相同），
+成功时只替换有变化的文档块；新文件读取失败时不留下已写入的部分
+
+用法：
+python test/rag_update_check.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.rag_module import RAGSystem, UploadedBytes
+from modules.rag_vector import HashEmbedder
+
+CHUNK_SIZE = 60
+
+OLD_VERSION = ["苹果手机旧款价格一千九百九十九元。", "香蕉平板旧款续航十小时。", "橙子耳机旧款支持降噪。"]
+NEW_VERSION = ["苹果手机新款价格两千九百九十九元。", "香蕉平板新款续航十二小时。", "橙子耳机新款支持空间音频。",
+               "葡萄手表新款支持血氧检测。"]
+
+
+def _text(paragraphs):
+    # 每段补齐到一个文档块的长度，使每段正好对应一个文档块
+    return "".join(paragraph.ljust(CHUNK_SIZE, "。") for paragraph in paragraphs)
+
+
+class FailingUpload(UploadedBytes):
+    """每次最多读出一个文档块的字节数；fail 为True时，第一批文档块处理完后的读取抛出 OSError，模拟读取中途失败"""
+
+    def __init__(self, data, name, type="text/plain", fail=False):
+        super().__init__(data, name, type)
+        self.fail = fail
+        self.armed = False
+
+    def read(self, size=-1):
+        if self.armed:
+            raise OSError("disk error")
+        block = CHUNK_SIZE * 3  # 一个文档块的UTF-8字节数
+        return super().read(block if size is None or size < 0 else min(size, block))
+
+    def progress(self, read, written):
+        self.armed = self.fail
+
+
+def _upload(system, paragraphs, fail=False, name="m.txt"):
+    upload = FailingUpload(_text(paragraphs).encode("utf-8"), name, fail=fail)
+    return system.add_document(upload, chunk_size=CHUNK_SIZE, overlap=0, progress=upload.progress)
+
+
+def _contents(system, query, retriever="keyword"):
+    return [chunk['content'] for chunk in system.search_documents(query, top_k=10, retriever=retriever)]
+
+
+def check_failed_update(system):
+    success, message = _upload(system, OLD_VERSION)
+    assert success, message
+    stats = system.get_document_stats()
+    assert stats['total_chunks'] == len(OLD_VERSION), stats
+    before = {retriever: _contents(system, "旧款", retriever) for retriever in ("keyword", "vector")}
+    assert before['keyword'], "旧版本应能检索到"
+
+    # 第一批文档块处理完后读取失败
+    success, message = _upload(system, NEW_VERSION, fail=True)
+    assert not success and "disk error" in message, message
+    stats = system.get_document_stats()
+    assert stats['total_chunks'] == len(OLD_VERSION), f"更新失败后旧版本被删除: {stats}"
+    for retriever, contents in before.items():
+        assert _contents(system, "旧款", retriever) == contents, f"更新失败后{retriever}检索结果变化"
+    assert not _contents(system, "新款"), "更新失败后不应检索到新版本的内容"
+    print(f"failed update: 返回 {message!r}，旧版本的 {stats['total_chunks']} 个文档块保持不变")
+
+    # 重新上传成功时替换为新版本
+    success, message = _upload(system, NEW_VERSION)
+    assert success, message
+    stats = system.get_document_stats()
+    assert stats['total_chunks'] == len(NEW_VERSION), stats
+    assert not _contents(system, "旧款") and _contents(system, "新款")
+    print(f"update: {message}")
+
+
+def check_failed_new_file(system):
+    success, message = _upload(system, OLD_VERSION, fail=True, name="n.txt")
+    assert not success, message
+    assert "n.txt" not in system.get_document_stats()['files'], "新文件读取失败后不应保留已写入的部分"
+    print(f"failed new file: 返回 {message!r}，没有留下已写入的文档块")
+
+
+def main():
+    with tempfile.TemporaryDirectory() as index_dir:
+        system = RAGSystem(index_dir=index_dir, embedder=HashEmbedder(), legacy_file=None)
+        # 每批一个文档块，失败前已有文档块写入（或暂存）
+        system.ingest_batch_size = 1
+        try:
+            check_failed_update(system)
+            check_failed_new_file(system)
+        finally:
+            system.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+千帆流式输出（SSE）检查脚本
+parser：SSEParser 在任意位置切分的字节流上解析出相同的事件，覆盖被切开的 \\r\\n、注释行、多行 data、event 字段和未结束的事件
+stream：本地模拟千帆接口逐个事件输出，检查 QianfanModelService.chat(stream=True) 边收边产出增量、
+        遇到 [DONE] 结束、结束消息带 finish_reason，以及流中的错误事件抛出 ModelAPIError；
+        分别用分块传输和无长度（关闭连接结束）的响应测试
+
+用法：
+python test/sse_stream_check.py
+python test/sse_stream_check.py parser
+python test/sse_stream_check.py stream --interval 0.2
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.model_service import QianfanModelService, SSEParser, iter_sse_events
+from modules.model_transport import ModelAPIError, TransportConfig
+
+SAMPLE_STREAM = (
+    b": keep-alive\r\n"
+    b"\r\n"
+    b"event: message\r\n"
+    b'data: {"choices":[{"delta":{"content":"\xe4\xbd\xa0\xe5\xa5\xbd"}}]}\r\n'
+    b"\r\n"
+    b"data: line one\n"
+    b"data: line two\n"
+    b"\n"
+    b"event: custom\r"
+    b"data:no-space\r"
+    b"\r"
+    b"data: [DONE]\n"
+    b"\n"
+    b"data: unterminated"
+)
+
+EXPECTED_EVENTS = [
+    ("message", '{"choices":[{"delta":{"content":"你好"}}]}'),
+    ("message", "line one\nline two"),
+    ("custom", "no-space"),
+    ("message", "[DONE]"),
+]
+
+
+def check_parser():
+    """整段输入、逐字节输入以及在每个位置切成两段输入，解析结果都应一致"""
+    assert list(iter_sse_events([SAMPLE_STREAM])) == EXPECTED_EVENTS
+    assert list(iter_sse_events(SAMPLE_STREAM[i:i + 1] for i in range(len(SAMPLE_STREAM)))) == EXPECTED_EVENTS
+    for split in range(1, len(SAMPLE_STREAM)):
+        events = list(iter_sse_events([SAMPLE_STREAM[:split], SAMPLE_STREAM[split:]]))
+        assert events == EXPECTED_EVENTS, f"在第{split}字节处切分时解析结果不同: {events}"
+
+    # 完整事件在收到结束空行时立即产出，不等后续数据
+    parser = SSEParser()
+    assert parser.feed(b"data: a\n") == []
+    assert parser.feed(b"\n") == [("message", "a")]
+    print(f"parser: {len(SAMPLE_STREAM) + 1} 种切分方式的解析结果一致")
+
+
+def _event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+class _QianfanStub(BaseHTTPRequestHandler):
+    """模拟千帆流式接口：每隔 interval 秒输出一个增量事件"""
+
+    protocol_version = "HTTP/1.1"
+    interval = 0.2
+    pieces = ["流式", "输出", "测试"]
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        chunked = self.path != "/close"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+        events = [_event({"choices": [{"delta": {"content": piece}}]}) for piece in self.pieces]
+        if self.path == "/error":
+            events.append(_event({"error": {"code": "rate_limit", "message": "too many requests"}}))
+        events.append(_event({"choices": [{"delta": {}, "finish_reason": "stop"}]}))
+        events.append(b"data: [DONE]\n\n")
+        events.append(_event({"choices": [{"delta": {"content": "不应输出"}}]}))
+        try:
+            for event in events:
+                self._write(event, chunked)
+                time.sleep(self.interval)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 客户端收到 [DONE] 后不再读取，直接关闭连接
+        self.close_connection = True
+
+    def _write(self, data, chunked):
+        if chunked:
+            data = f"{len(data):x}\r\n".encode() + data + b"\r\n"
+        self.wfile.write(data)
+        self.wfile.flush()
+
+
+def check_stream(interval):
+    _QianfanStub.interval = interval
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _QianfanStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    service = QianfanModelService(authorization="Bearer test", transport_config=TransportConfig(max_retries=0))
+    messages = [{"role": "user", "content": "你好"}]
+    try:
+        for path in ("/chunked", "/close"):
+            service.async_service.url = base_url + path
+            start = time.perf_counter()
+            first_token = None
+            chunks = []
+            for chunk in service.chat(messages, stream=True):
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                chunks.append(chunk)
+            total = time.perf_counter() - start
+
+            contents = [chunk["message"]["content"] for chunk in chunks if not chunk["done"]]
+            assert contents == _QianfanStub.pieces, contents
+            assert chunks[-1]["done"] and chunks[-1]["done_reason"] == "stop", chunks[-1]
+            # 第一个增量应在第一个事件到达时产出，而不是等整个响应结束
+            assert first_token < interval * 2, f"首个增量耗时 {first_token:.3f}s"
+            print(f"stream {path}: 首个增量 {first_token * 1000:.0f} ms，整个流 {total * 1000:.0f} ms")
+
+        service.async_service.url = base_url + "/error"
+        try:
+            list(service.chat(messages, stream=True))
+        except ModelAPIError as e:
+            print(f"stream /error: 抛出 {type(e).__name__}: {e}")
+        else:
+            raise AssertionError("流中的错误事件没有抛出异常")
+    finally:
+        service.close()
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="千帆流式输出（SSE）检查")
+    parser.add_argument("check", nargs="?", choices=["parser", "stream", "all"], default="all")
+    parser.add_argument("--interval", type=float, default=0.2, help="模拟接口输出相邻事件的间隔（秒）")
+    args = parser.parse_args()
+
+    if args.check in ("parser", "all"):
+        check_parser()
+    if args.check in ("stream", "all"):
+        check_stream(args.interval)
+
+
+if __name__ == "__main__":
+    main()